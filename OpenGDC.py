@@ -4,7 +4,7 @@ __author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
 __version__ = '0.01'
 __date__ = 'Oct 21, 2020'
 
-import sys, os, time, yaml, utils
+import sys, os, time, yaml, threading, utils, metrics, gdcpolicy
 import argparse as ap
 from pathlib import Path
 
@@ -37,9 +37,56 @@ def read_params():
     p.add_argument( '--convert_dir',
                     type = str,
                     help = 'Path to the folder in which the converted data will be located' )
+    p.add_argument( '--columnar',
+                    action = 'store_true',
+                    default = False,
+                    help = 'Also dump converted files in columnar format (it works for a limited set of data types only)' )
+    p.add_argument( '--compress',
+                    action = 'store_true',
+                    default = False,
+                    help = ( 'Write block-compressed converted files with a genomic region index '
+                             '(it works for a limited set of data types only)' ) )
+    p.add_argument( '--metadata_db',
+                    action = 'store_true',
+                    default = False,
+                    help = ( 'Also collect clinical and biospecimen metadata into a SQLite database '
+                             '(metadata.sqlite in the convert directory)' ) )
+    p.add_argument( '--pipeline',
+                    action = 'store_true',
+                    default = False,
+                    help = 'Convert files as soon as they are downloaded (it requires both --download and --convert)' )
+    p.add_argument( '--workers',
+                    type = int,
+                    default = 1,
+                    help = 'Number of processes used to convert files in parallel (also used to write .meta files in parallel)' )
     p.add_argument( '--matrix',
                     type = str,
-                    help = 'Export converted files to a data matrix (it works for a limited set of data types only)' )
+                    help = ( 'Path prefix of the data matrix with the converted files '
+                             '(<matrix>.npy, <matrix>.rows, <matrix>.columns, and <matrix>.tsv). '
+                             'It works for a limited set of data types only' ) )
+    p.add_argument( '--bulk',
+                    action = 'store_true',
+                    default = False,
+                    help = ( 'Download files in batches of up to gdc/bulk_size MB with a single request per batch '
+                             '(it reduces the overhead of downloading many small files)' ) )
+    p.add_argument( '--offline',
+                    action = 'store_true',
+                    default = False,
+                    help = ( 'Serve GDC queries from the on-disk cache only, without contacting GDC '
+                             '(files that have not been downloaded yet are skipped)' ) )
+    p.add_argument( '--record',
+                    type = str,
+                    help = ( 'Record the GDC queries and the downloaded files to a session directory, '
+                             'which can be replayed with the gdccache.py stand-in server' ) )
+    p.add_argument( '--metrics_out',
+                    type = str,
+                    help = ( 'Path to a JSON file with the metrics of the run (time spent in every stage, rows/s, bytes/s, '
+                             'cache hit ratios, and peak memory)' ) )
+    p.add_argument( '--profile',
+                    type = str,
+                    help = ( 'Profile a stage with cProfile (e.g. download, load_resources, convert, convert_rows, write_bed, '
+                             'metadata, or matrix). The profile is dumped next to the --metrics_out file, or to <stage>.prof '
+                             'in the current directory. Stages running in worker processes are profiled in the main process only' ) )
     p.add_argument( '--settings',
                     type = str,
                     default = './settings.yaml',
@@ -60,6 +107,10 @@ if __name__ == '__main__':
     # init params
     args = read_params()
 
+    if args.metrics_out or args.profile:
+        # Collect metrics of the run
+        metrics.enable( profile=args.profile )
+
     if args.verbose:
         print( "Loading settings" )
     # Load settings
@@ -70,9 +121,34 @@ if __name__ == '__main__':
     settings[ "assets" ][ "ncbi" ][ "history" ] = os.path.abspath( settings[ "assets" ][ "ncbi" ][ "history" ] )
     settings[ "assets" ][ "ncbi" ][ "reference" ] = os.path.abspath( settings[ "assets" ][ "ncbi" ][ "reference" ] )
     settings[ "assets" ][ "hgnc" ] = os.path.abspath( settings[ "assets" ][ "hgnc" ] )
+    if args.columnar:
+        # Columnar outputs are enabled through settings to reach the conversion workers
+        settings.setdefault( "convert", { } )[ "columnar" ] = True
+    if args.compress:
+        settings.setdefault( "convert", { } )[ "compress" ] = True
+    if args.metadata_db:
+        settings.setdefault( "convert", { } )[ "metadata_db" ] = True
+    if settings.get( "cache", { } ).get( "probes" ):
+        settings[ "cache" ][ "probes" ] = os.path.abspath( settings[ "cache" ][ "probes" ] )
+    if args.bulk:
+        settings[ "gdc" ][ "bulk" ] = True
+    if args.offline:
+        settings[ "gdc" ][ "mode" ] = "offline"
+    elif args.record:
+        settings[ "gdc" ][ "mode" ] = "record"
+        settings[ "gdc" ][ "session" ] = args.record
+    for key in [ "cache", "session" ]:
+        if settings[ "gdc" ].get( key ):
+            settings[ "gdc" ][ key ] = os.path.abspath( settings[ "gdc" ][ key ] )
+    # Timeouts, retries, and rate limits of the requests to GDC
+    gdcpolicy.configure( settings[ "gdc" ] )
 
     # Init list of downloaded files
     downloaded = [ ]
+    # Slots bound the number of downloaded files waiting to be converted in pipeline mode
+    slots = None
+    # Info of the files downloaded in pipeline mode
+    files = { }
     if args.download:
         if args.verbose:
             print( "Downloading {} data for {}".format( args.datatype, args.tumor ) )
@@ -81,10 +157,19 @@ if __name__ == '__main__':
         if not os.path.exists( args.download_dir ):
             os.mkdir( args.download_dir )
         datatypes = [ "Clinical Supplement", "Biospecimen Supplement" ] if "clinical" in args.datatype.lower() else [ args.datatype ]
-        for datatype in datatypes:
-            # Start downloading data
-            downloaded = utils.download( args.tumor.upper(), datatype, args.download_dir, 
-                                        after_datetime=args.after, settings=settings, verbose=args.verbose )
+        if args.pipeline and args.convert:
+            # Files are downloaded while converting
+            slots = threading.BoundedSemaphore( settings[ "pipeline" ][ "queue" ] )
+            downloaded = ( data_path for datatype in datatypes 
+                               for _, data_path in utils.iter_download( args.tumor.upper(), datatype, args.download_dir, 
+                                                                        after_datetime=args.after, settings=settings, 
+                                                                        slots=slots, files=files, verbose=args.verbose ) )
+        else:
+            with metrics.timer( "download" ):
+                for datatype in datatypes:
+                    # Start downloading data
+                    downloaded += utils.download( args.tumor.upper(), datatype, args.download_dir, 
+                                                  after_datetime=args.after, settings=settings, verbose=args.verbose )
     else:
         # If the download is not enabled, search for files into the download directory
         if os.path.exists( args.download_dir ):
@@ -103,52 +188,129 @@ if __name__ == '__main__':
         # Create convert directory if it does not exist
         if not os.path.exists( args.convert_dir ):
             os.mkdir( args.convert_dir )
+
+        # Load the manifest of the last run
+        # Only new or changed files are converted
+        run = utils.load_run_manifest( args.convert_dir, args.datatype, settings )
+        # Remove outputs of files that do not exist anymore
+        dropped = utils.drop_missing_inputs( run, verbose=args.verbose )
+        if slots is None:
+            changed = utils.get_changed_inputs( run, downloaded )
+            # Unchanged files are hits of the run manifest
+            metrics.count( "run_manifest.hits", len( downloaded ) - len( changed ) )
+            metrics.count( "run_manifest.misses", len( changed ) )
+            if args.verbose:
+                print( "Files that will be converted: {} ({} unchanged)".format( len( changed ), len( downloaded ) - len( changed ) ) )
+        else:
+            # Unchanged files do not wait for the conversion
+            changed = utils.iter_changed_inputs( run, downloaded, skip=lambda filepath: slots.release() )
+            if args.verbose:
+                print( "Files will be converted as soon as they are downloaded" )
         
         if args.verbose:
-            print( "Files that will be converted: {}".format( len( downloaded ) ) )
             print( "Loading external assets" )
         # Load external resources if required
-        resources = utils.load_resources( args.datatype, settings, verbose=args.verbose )
+        with metrics.timer( "load_resources" ):
+            resources = utils.load_resources( args.datatype, settings, filepaths=changed if slots is None else [ ], verbose=args.verbose )
+        if slots is not None and "Files" in resources:
+            # Files info are retrieved while downloading in pipeline mode
+            resources[ "Files" ] = files
         
         if args.verbose:
             print( "Defining header schema" )
         # Write header.schema file with info about bed file columns
         utils.dump_schema( args.datatype, args.convert_dir )
 
+        # Start converting files in changed list
+        # Resources are shared with the conversion workers
+        # Workers are not warmed up in pipeline mode to fork them before starting the downloads
+        # In pipeline mode, the convert stage also includes the time spent waiting for downloads
+        # Changed inputs are counted while converting, they are not known in advance in pipeline mode
+        changed_count = 0
+        with metrics.timer( "convert" ):
+            for filepath, converted, outfilepath, partial in utils.convert_many( args.datatype, changed, args.convert_dir, settings, 
+                                                                                  resources=resources, workers=args.workers, 
+                                                                                  warmup=slots is None, verbose=args.verbose ):
+                changed_count += 1
+                if slots is not None:
+                    # Make room for the next download
+                    slots.release()
+                if converted:
+                    metrics.count( "convert.files" )
+                    metrics.count( "convert.bytes", os.path.getsize( filepath ) )
+                    if "clinical" in args.datatype.lower():
+                        # "partial" contains clinical and biospecimen partial dictionaries
+                        # They are dumped to the convert directory to rebuild metadata in next runs
+                        partial_filepath = utils.dump_partial( args.convert_dir, filepath, partial )
+                        utils.update_run_manifest( run, filepath, [ partial_filepath ], partial=partial_filepath )
+                    else:
+                        utils.update_run_manifest( run, filepath, utils.get_outputs( args.datatype, outfilepath, settings ) )
         if "clinical" in args.datatype.lower():
-            clinical_map = { }
-            biospecimen_map = { }
-        # Start converting files in downloaded list
-        for filepath in downloaded:
-            print( "Converting {}".format( filepath ) )
-            # Iteratively update resources if required
-            converted, outfilepath, resources = utils.convert( args.datatype, filepath, args.convert_dir, 
-                                                               settings, resources=resources, verbose=args.verbose )
-            if "clinical" in args.datatype.lower():
-                # "resources" contains clinical and biospecimen partial dictionaries
-                if "org_clinical." in os.path.basename( filepath ):
-                    clinical_map = { **clinical_map, **resources }
-                    # Re-initialise resources
-                    resources = { }
-                elif "org_biospecimen." in os.path.basename( filepath ):
-                    biospecimen_map = { **biospecimen_map, **resources }
-                    # Re-initialise resources
-                    resources = { }
-            if converted and "clinical" not in args.datatype.lower():
-                converted_filepaths.append( outfilepath )
-        if "clinical" in args.datatype.lower():
-            metadata.build_metadata( args.convert_dir, clinical_map, biospecimen_map, verbose=args.verbose )
+            if changed_count or dropped:
+                clinical_map = { }
+                biospecimen_map = { }
+                # Partial maps are merged in place, later files win
+                for input_filepath in sorted( run[ "inputs" ] ):
+                    if "org_clinical." in os.path.basename( input_filepath ):
+                        clinical_map.update( utils.load_partial( run[ "inputs" ][ input_filepath ][ "partial" ] ) )
+                    elif "org_biospecimen." in os.path.basename( input_filepath ):
+                        biospecimen_map.update( utils.load_partial( run[ "inputs" ][ input_filepath ][ "partial" ] ) )
+                with metrics.timer( "metadata" ):
+                    metadata_filepaths = [ os.path.abspath( outfilepath ) for outfilepath in 
+                                            metadata.build_metadata( args.convert_dir, clinical_map, biospecimen_map, 
+                                                                     workers=args.workers, 
+                                                                     database=settings.get( "convert", { } ).get( "metadata_db", False ),
+                                                                     verbose=args.verbose ) ]
+                metrics.count( "metadata.files", len( metadata_filepaths ) )
+                # Remove metadata of aliquots that do not exist anymore
+                for outfilepath in set( run[ "outputs" ] ).difference( metadata_filepaths ):
+                    if os.path.exists( outfilepath ):
+                        os.unlink( outfilepath )
+                run[ "outputs" ] = metadata_filepaths
+        else:
+            # Persist resources extended during the conversion
+            utils.dump_resources( args.datatype, settings, resources, verbose=args.verbose )
+            converted_filepaths = [ outfilepath for entry in run[ "inputs" ].values() for outfilepath in entry[ "outputs" ] ]
+        utils.dump_run_manifest( args.convert_dir, args.datatype, run )
     else:
         # If the conversion is not enabled, search for files into the convert directory
         if os.path.exists( args.convert_dir ) and "clinical" not in args.datatype.lower():
-            converted_filepaths = list( Path( args.convert_dir ).glob( '*.bed' ) )
+            converted_filepaths = list( Path( args.convert_dir ).glob( '*.bed' ) ) + list( Path( args.convert_dir ).glob( '*.bed.gz' ) )
     
     if converted_filepaths:
         if args.matrix:
-            # TODO feature under development
             if args.verbose:
-                print( 'Feature under development' )
+                print( "Exporting converted files to matrix {}".format( args.matrix ) )
+            # Build a matrix from the converted files
+            with metrics.timer( "matrix" ):
+                exported = utils.export_matrix( args.datatype, converted_filepaths, args.matrix, verbose=args.verbose )
+            if not exported:
+                if args.verbose:
+                    print( "Unable to export {} data to a matrix".format( args.datatype ) )
     
     # Print total elapsed time and exit
     t1 = time.time()
+    if metrics.enabled():
+        extra = { 
+            "command": sys.argv, 
+            "datatype": args.datatype, 
+            "workers": args.workers, 
+            "started": time.strftime( "%Y-%m-%dT%H:%M:%S", time.localtime( t0 ) ) 
+        }
+        if args.profile:
+            # The profile is dumped next to the metrics of the run
+            profile_filepath = '{}.prof'.format( args.profile )
+            if args.metrics_out:
+                profile_filepath = '{}.{}.prof'.format( os.path.splitext( args.metrics_out )[ 0 ], args.profile )
+            extra[ "profile" ] = { 
+                "stage": args.profile, 
+                "filepath": os.path.abspath( profile_filepath ), 
+                "top": metrics.dump_profile( profile_filepath ) 
+            }
+        report = metrics.get_report( elapsed=t1 - t0, extra=extra )
+        if args.metrics_out:
+            metrics.dump_report( report, args.metrics_out )
+        if args.verbose:
+            for name, entry in sorted( report[ "timers" ].items(), key=lambda item: item[ 1 ][ "seconds" ], reverse=True ):
+                print( "\t{}: {:.3f}s ({} calls)".format( name, entry[ "seconds" ], entry[ "calls" ] ) )
     print( 'Total elapsed time {}s\n'.format( int( t1 - t0 ) ) )
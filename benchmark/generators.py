@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+__author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
+__version__ = '0.01'
+__date__ = 'Oct 21, 2020'
+
+import os, bz2, json, uuid, random
+
+# Synthetic inputs with the same shape of the GDC data and external assets
+# Everything is generated from a seed, so the same scale and seed always produce the same files
+# Sizes are defined at scale 1.0 and they are scaled linearly
+
+# Number of probes on the Illumina platforms
+PLATFORMS = { "450K": 485577, "EPIC": 865918 }
+
+# Approximate number of Gencode genes and chromosome sizes in Mb (GRCh38)
+GENES = 60000
+CHROMOSOMES = [ ( "chr1", 248 ), ( "chr2", 242 ), ( "chr3", 198 ), ( "chr4", 190 ), ( "chr5", 181 ), ( "chr6", 171 ),
+                ( "chr7", 159 ), ( "chr8", 145 ), ( "chr9", 138 ), ( "chr10", 134 ), ( "chr11", 135 ), ( "chr12", 133 ),
+                ( "chr13", 114 ), ( "chr14", 107 ), ( "chr15", 102 ), ( "chr16", 90 ), ( "chr17", 83 ), ( "chr18", 80 ),
+                ( "chr19", 59 ), ( "chr20", 64 ), ( "chr21", 47 ), ( "chr22", 51 ), ( "chrX", 156 ), ( "chrY", 57 ) ]
+
+GENE_TYPES = [ "protein_coding", "lincRNA", "antisense", "processed_pseudogene", "miRNA" ]
+FEATURE_TYPES = [ "Island", "N_Shore", "S_Shore", "N_Shelf", "S_Shelf", "." ]
+
+# Attributes of the elements in the TCGA XML files
+XML_ATTRIBUTES = 'procurement_status="Completed" owner="TSS" cde="3081936" xsd_ver="1.8" tier="1"'
+
+# Generate the list of genes sorted by chromosome and start position
+# Every gene is a tuple ( symbol, ensembl id, chromosome, start, end, strand, gene type )
+def generate_genes( count, seed=0 ):
+    rng = random.Random( seed )
+    total_size = sum( size for _, size in CHROMOSOMES )
+    genes = [ ]
+    for chromosome, size in CHROMOSOMES:
+        for _ in range( max( 1, int( count * size / total_size ) ) ):
+            start = rng.randint( 1, size * 1000000 )
+            genes.append( ( chromosome, start, start + int( rng.lognormvariate( 9, 1.2 ) ) + 200,
+                            rng.choice( "+-" ), rng.choice( GENE_TYPES ) ) )
+    genes.sort( key=lambda gene: ( gene[ 0 ], gene[ 1 ] ) )
+    return [ ( "GENE{}".format( position ), "ENSG{:011d}".format( position ) ) + gene for position, gene in enumerate( genes ) ]
+
+# Write a Gencode-like GTF file with a gene, a transcript, and some exons per gene
+def write_gencode( filepath, genes, seed=0 ):
+    rng = random.Random( seed )
+    with bz2.open( filepath, 'wt' ) as gtf:
+        gtf.write( "##description: synthetic GENCODE annotation\n##provider: GENCODE\n##format: gtf\n" )
+        for symbol, ensembl_id, chromosome, start, end, strand, gene_type in genes:
+            attributes = 'gene_id "{}.1"; gene_type "{}"; gene_status "KNOWN"; gene_name "{}"; level 2;'.format( ensembl_id, gene_type, symbol )
+            gtf.write( "{}\tHAVANA\tgene\t{}\t{}\t.\t{}\t.\t{}\n".format( chromosome, start, end, strand, attributes ) )
+            transcript_attributes = '{} transcript_id "ENST{}.1";'.format( attributes, ensembl_id[ 4: ] )
+            gtf.write( "{}\tHAVANA\ttranscript\t{}\t{}\t.\t{}\t.\t{}\n".format( chromosome, start, end, strand, transcript_attributes ) )
+            exon_start = start
+            for _ in range( rng.randint( 1, 4 ) ):
+                exon_end = min( end, exon_start + rng.randint( 50, 500 ) )
+                gtf.write( "{}\tHAVANA\texon\t{}\t{}\t.\t{}\t.\t{}\n".format( chromosome, exon_start, exon_end, strand, transcript_attributes ) )
+                exon_start = exon_end + 1
+                if exon_start >= end:
+                    break
+
+# Write an NCBI-like GFF3 file with the reference genes
+# The first "reference" genes are in the reference, some of the others are deprecated (see write_ncbi_history)
+def write_ncbi_reference( filepath, genes ):
+    with bz2.open( filepath, 'wt' ) as gff:
+        gff.write( "##gff-version 3\n#!genome-build GRCh38.p2\n" )
+        for position, ( symbol, _, chromosome, start, end, strand, _ ) in enumerate( genes ):
+            gff.write( "NC_{:06d}.11\tBestRefSeq\tgene\t{}\t{}\t.\t{}\t.\tID=gene{};Dbxref=GeneID:{},HGNC:HGNC:{};Name={};gbkey=Gene\n".format(
+                int( chromosome[ 3: ] ) if chromosome[ 3: ].isdigit() else 23, start, end, strand, position, 100000 + position, position, symbol ) )
+
+# Write an NCBI-like gene history file with deprecated gene symbols
+def write_ncbi_history( filepath, genes ):
+    with bz2.open( filepath, 'wt' ) as history:
+        history.write( "#tax_id\tGeneID\tDiscontinued_GeneID\tDiscontinued_Symbol\tDiscontinue_Date\n" )
+        for position, ( symbol, _, _, _, _, _, _ ) in enumerate( genes ):
+            history.write( "9606\t-\t{}\t{}\t20150101\n".format( 500000 + position, symbol ) )
+            # Other species are discarded while loading
+            history.write( "10090\t-\t{}\t{}\t20150101\n".format( 900000 + position, symbol ) )
+
+# Write an HGNC-like complete set with the entrez id in the 19th column
+def write_hgnc( filepath, genes ):
+    header = [ "hgnc_id", "symbol", "name", "locus_group", "locus_type", "status", "location", "location_sortable",
+               "alias_symbol", "alias_name", "prev_symbol", "prev_name", "gene_family", "gene_family_id",
+               "date_approved_reserved", "date_symbol_changed", "date_name_changed", "date_modified", "entrez_id",
+               "ensembl_gene_id" ]
+    with bz2.open( filepath, 'wt' ) as hgnc:
+        hgnc.write( "{}\n".format( "\t".join( header ) ) )
+        for position, ( symbol, ensembl_id, _, _, _, _, _ ) in enumerate( genes ):
+            values = [ "HGNC:{}".format( position ), symbol, "synthetic gene {}".format( position ), "protein-coding gene",
+                       "gene with protein product", "Approved", "1p36", "01p36", "", "", "", "", "", "", "2000-01-01",
+                       "", "", "2020-01-01", str( 700000 + position ), ensembl_id ]
+            hgnc.write( "{}\n".format( "\t".join( values ) ) )
+
+# Generate the probes of a methylation platform
+# Most probes are associated with one or more close genes and a few transcripts each
+# Some probes are intergenic or they are not mapped to any chromosome, as in the GDC data
+def generate_probes( genes, count, seed=0 ):
+    rng = random.Random( seed )
+    probes = [ ]
+    for position in range( count ):
+        probe_id = "cg{:08d}".format( position )
+        draw = rng.random()
+        if draw < 0.01:
+            probes.append( ( probe_id, "*", "0", "0", ".", ".", ".", ".", ".", "." ) )
+            continue
+        gene_position = rng.randrange( len( genes ) )
+        _, _, chromosome, start, end, _, _ = genes[ gene_position ]
+        site = rng.randint( max( 1, start - 1500 ), end )
+        cgi = "{}:{}-{}".format( chromosome, site - 200, site + 200 ) if rng.random() < 0.6 else "."
+        if draw < 0.15:
+            probes.append( ( probe_id, chromosome, str( site ), str( site + 1 ), ".", ".", ".", ".", cgi, rng.choice( FEATURE_TYPES ) ) )
+            continue
+        symbols, types, transcripts, positions = [ ], [ ], [ ], [ ]
+        for neighbor in genes[ gene_position : gene_position + rng.randint( 1, 3 ) ]:
+            if neighbor[ 2 ] != chromosome:
+                break
+            for transcript in range( rng.randint( 1, 3 ) ):
+                symbols.append( neighbor[ 0 ] )
+                types.append( neighbor[ 6 ] )
+                transcripts.append( "ENST{}.{}".format( neighbor[ 1 ][ 4: ], transcript + 1 ) )
+                positions.append( str( rng.randint( -1500, 20000 ) ) )
+        probes.append( ( probe_id, chromosome, str( site ), str( site + 1 ), ";".join( symbols ), ";".join( types ),
+                         ";".join( transcripts ), ";".join( positions ), cgi, rng.choice( FEATURE_TYPES ) ) )
+    return probes
+
+# Write a Methylation Beta Value file as released by GDC
+def write_methylation( filepath, probes, seed=0 ):
+    rng = random.Random( seed )
+    with open( filepath, 'w' ) as methylation:
+        methylation.write( "Composite Element REF\tBeta_value\tChromosome\tStart\tEnd\tGene_Symbol\tGene_Type\t"
+                           "Transcript_ID\tPosition_to_TSS\tCGI_Coordinate\tFeature_Type\n" )
+        lines = [ ]
+        for probe in probes:
+            beta_value = "NA" if rng.random() < 0.02 else "{:.6f}".format( rng.random() )
+            lines.append( "{}\t{}\t{}\n".format( probe[ 0 ], beta_value, "\t".join( probe[ 1: ] ) ) )
+            if len( lines ) >= 100000:
+                methylation.write( "".join( lines ) )
+                lines = [ ]
+        methylation.write( "".join( lines ) )
+
+# Write a TCGA-like clinical supplement of a patient
+def write_clinical( filepath, barcode, patient_uuid, rng ):
+    element = lambda name, value: '<{0} {1}>{2}</{0}>'.format( name, XML_ATTRIBUTES, value )
+    lines = [ '<?xml version="1.0" encoding="UTF-8"?>',
+              '<brca:tcga_bcr xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:admin="http://tcga.nci/bcr/xml/administration/2.7" '
+              'xmlns:shared="http://tcga.nci/bcr/xml/shared/2.7" xmlns:clin_shared="http://tcga.nci/bcr/xml/clinical/shared/2.7" '
+              'xmlns:shared_stage="http://tcga.nci/bcr/xml/clinical/shared/stage/2.7" '
+              'xmlns:brca="http://tcga.nci/bcr/xml/clinical/brca/2.7" schemaVersion="2.7">',
+              '<admin:admin>', element( "admin:bcr", "Nationwide Children's Hospital" ), element( "admin:disease_code", "BRCA" ),
+              element( "admin:day_of_dcc_upload", rng.randint( 1, 28 ) ), '</admin:admin>',
+              '<brca:patient>', element( "shared:bcr_patient_barcode", barcode ), element( "shared:bcr_patient_uuid", patient_uuid ),
+              element( "clin_shared:gender", rng.choice( [ "FEMALE", "MALE" ] ) ),
+              element( "clin_shared:vital_status", rng.choice( [ "Alive", "Dead" ] ) ),
+              element( "clin_shared:days_to_birth", -rng.randint( 9000, 30000 ) ),
+              element( "clin_shared:race", rng.choice( [ "WHITE", "ASIAN", "BLACK OR AFRICAN AMERICAN" ] ) ),
+              '<shared_stage:stage_event system="AJCC">',
+              element( "shared_stage:pathologic_stage", rng.choice( [ "Stage I", "Stage IIA", "Stage IIB", "Stage IIIA", "Stage IIIC", "Stage IV" ] ) ),
+              '<shared_stage:tnm_categories><shared_stage:pathologic_categories>',
+              element( "shared_stage:pathologic_T", rng.choice( [ "T1", "T2", "T3" ] ) ),
+              element( "shared_stage:pathologic_N", rng.choice( [ "N0", "N1", "N2" ] ) ),
+              '</shared_stage:pathologic_categories></shared_stage:tnm_categories>',
+              '</shared_stage:stage_event>', '<brca:drugs>' ]
+    for _ in range( rng.randint( 0, 4 ) ):
+        lines.extend( [ '<rx:drug xmlns:rx="http://tcga.nci/bcr/xml/clinical/pharmaceutical/2.7">',
+                        element( "rx:drug_name", rng.choice( [ "Tamoxifen", "Letrozole", "Doxorubicin" ] ) ),
+                        element( "rx:days_to_drug_therapy_start", rng.randint( 0, 2000 ) ), '</rx:drug>' ] )
+    lines.append( '</brca:drugs><brca:follow_ups>' )
+    for follow_up in range( rng.randint( 1, 4 ) ):
+        lines.extend( [ '<follow_up_v4.0:follow_up xmlns:follow_up_v4.0="http://tcga.nci/bcr/xml/clinical/brca/followup/2.7/4.0" version="4.0">',
+                        element( "clin_shared:days_to_last_followup", follow_up * 365 ),
+                        element( "clin_shared:vital_status", "Alive" ), '</follow_up_v4.0:follow_up>' ] )
+    lines.extend( [ '</brca:follow_ups>', '</brca:patient>', '</brca:tcga_bcr>' ] )
+    with open( filepath, 'w' ) as xml:
+        xml.write( "\n".join( lines ) )
+
+# Write a TCGA-like biospecimen supplement of a patient
+# Return the list of aliquot uuids
+def write_biospecimen( filepath, barcode, patient_uuid, rng ):
+    element = lambda name, value: '<{0} {1}>{2}</{0}>'.format( name, XML_ATTRIBUTES, value )
+    aliquots = [ ]
+    lines = [ '<?xml version="1.0" encoding="UTF-8"?>',
+              '<bio:tcga_bcr xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:admin="http://tcga.nci/bcr/xml/administration/2.7" '
+              'xmlns:bio="http://tcga.nci/bcr/xml/biospecimen/2.7" xmlns:shared="http://tcga.nci/bcr/xml/shared/2.7" schemaVersion="2.7">',
+              '<admin:admin>', element( "admin:bcr", "Nationwide Children's Hospital" ), '</admin:admin>',
+              '<bio:patient>', element( "shared:bcr_patient_barcode", barcode ), element( "shared:bcr_patient_uuid", patient_uuid ),
+              '<bio:samples>' ]
+    for sample_type_id in rng.sample( [ "01", "10", "11", "06" ], rng.randint( 1, 3 ) ):
+        lines.extend( [ '<bio:sample>', element( "bio:sample_type_id", sample_type_id ),
+                        element( "bio:bcr_sample_uuid", str( uuid.UUID( int=rng.getrandbits( 128 ) ) ) ),
+                        element( "bio:bcr_sample_barcode", "{}-{}A".format( barcode, sample_type_id ) ), '<bio:portions>' ] )
+        for portion in range( rng.randint( 1, 2 ) ):
+            lines.extend( [ '<bio:portion>', element( "bio:portion_number", "{:02d}".format( portion + 1 ) ), '<bio:analytes>' ] )
+            for analyte_type in rng.sample( [ "D", "R", "W" ], rng.randint( 1, 3 ) ):
+                lines.extend( [ '<bio:analyte>', element( "bio:analyte_type_id", analyte_type ), '<bio:aliquots>' ] )
+                for aliquot in range( rng.randint( 1, 2 ) ):
+                    aliquot_uuid = str( uuid.UUID( int=rng.getrandbits( 128 ) ) ).upper()
+                    aliquots.append( aliquot_uuid )
+                    lines.extend( [ '<bio:aliquot>',
+                                    element( "bio:bcr_aliquot_barcode", "{}-{}A-{:02d}{}-A{:03d}-05".format( barcode, sample_type_id, portion + 1,
+                                                                                                           analyte_type, aliquot ) ),
+                                    element( "bio:bcr_aliquot_uuid", aliquot_uuid ),
+                                    element( "bio:concentration", "{:.2f}".format( rng.random() ) ), '</bio:aliquot>' ] )
+                lines.extend( [ '</bio:aliquots>', '</bio:analyte>' ] )
+            lines.extend( [ '</bio:analytes>', '</bio:portion>' ] )
+        lines.extend( [ '</bio:portions>', '</bio:sample>' ] )
+    lines.extend( [ '</bio:samples>', '</bio:patient>', '</bio:tcga_bcr>' ] )
+    with open( filepath, 'w' ) as xml:
+        xml.write( "\n".join( lines ) )
+    return aliquots
+
+# Generate a whole synthetic dataset in "outdir"
+#   - assets: Gencode, NCBI reference and history, and HGNC files
+#   - methylation: "samples" Methylation Beta Value files with their manifest, so that no GDC query is needed
+#   - clinical: clinical and biospecimen supplements of "patients" patients
+# The dataset is generated once, a dataset.json file describes it
+def generate_dataset( outdir, scale=0.01, platform="450K", samples=4, patients=50, seed=0, verbose=False ):
+    description = { "scale": scale, "platform": platform, "samples": samples, "patients": patients, "seed": seed }
+    description_filepath = os.path.join( outdir, "dataset.json" )
+    if os.path.exists( description_filepath ):
+        with open( description_filepath ) as dataset:
+            if json.load( dataset ).get( "parameters" ) == description:
+                return get_dataset_paths( outdir )
+    paths = get_dataset_paths( outdir )
+    for dirpath in [ paths[ "assets" ], paths[ "methylation" ], paths[ "clinical" ] ]:
+        if not os.path.exists( dirpath ):
+            os.makedirs( dirpath )
+
+    if verbose:
+        print( "Generating synthetic assets" )
+    genes = generate_genes( max( 100, int( GENES * scale ) ), seed=seed )
+    write_gencode( paths[ "gencode" ], genes, seed=seed )
+    # Most genes are in the NCBI reference, some of the others are deprecated or in HGNC only
+    reference_size = int( len( genes ) * 0.8 )
+    write_ncbi_reference( paths[ "ncbi_reference" ], genes[ :reference_size ] )
+    write_ncbi_history( paths[ "ncbi_history" ], genes[ reference_size : reference_size + len( genes ) // 10 ] )
+    write_hgnc( paths[ "hgnc" ], genes[ len( genes ) // 10 : ] )
+
+    if verbose:
+        print( "Generating {} synthetic {} Methylation Beta Value files".format( samples, platform ) )
+    probes = generate_probes( genes, max( 1000, int( PLATFORMS[ platform ] * scale ) ), seed=seed )
+    manifest = { }
+    for sample in range( samples ):
+        file_uuid = str( uuid.UUID( int=random.Random( "{}-file-{}".format( seed, sample ) ).getrandbits( 128 ) ) )
+        file_name = "jhu-usc.edu_BRCA.HumanMethylation{}.{}.lvl-3.TCGA-XX-{:04d}.gdc_hg38.txt".format( platform, sample, sample )
+        write_methylation( os.path.join( paths[ "methylation" ], "{}_{}".format( file_uuid, file_name ) ), probes, seed=seed + sample )
+        manifest[ file_uuid ] = { "file_name": file_name, "data_type": "Methylation Beta Value",
+                                  "case_id": str( uuid.UUID( int=random.Random( "{}-case-{}".format( seed, sample ) ).getrandbits( 128 ) ) ),
+                                  "sample_id": str( uuid.UUID( int=random.Random( "{}-sample-{}".format( seed, sample ) ).getrandbits( 128 ) ) ),
+                                  "aliquot_id": str( uuid.UUID( int=random.Random( "{}-aliquot-{}".format( seed, sample ) ).getrandbits( 128 ) ) ) }
+    with open( os.path.join( paths[ "methylation" ], "manifest.json" ), 'w' ) as manifest_file:
+        json.dump( manifest, manifest_file, indent=1, sort_keys=True )
+
+    if verbose:
+        print( "Generating clinical and biospecimen supplements of {} synthetic patients".format( patients ) )
+    rng = random.Random( seed )
+    for patient in range( patients ):
+        barcode = "TCGA-XX-{:04d}".format( patient )
+        patient_uuid = str( uuid.UUID( int=rng.getrandbits( 128 ) ) ).upper()
+        write_clinical( os.path.join( paths[ "clinical" ], "{}_nationwidechildrens.org_clinical.{}.xml".format(
+                            uuid.UUID( int=rng.getrandbits( 128 ) ), barcode ) ), barcode, patient_uuid, rng )
+        write_biospecimen( os.path.join( paths[ "clinical" ], "{}_nationwidechildrens.org_biospecimen.{}.xml".format(
+                               uuid.UUID( int=rng.getrandbits( 128 ) ), barcode ) ), barcode, patient_uuid, rng )
+
+    with open( description_filepath, 'w' ) as dataset:
+        json.dump( { "parameters": description, "genes": len( genes ), "probes": len( probes ) }, dataset, indent=1 )
+    return paths
+
+# Define the paths to the files of a synthetic dataset
+def get_dataset_paths( outdir ):
+    return {
+        "assets": os.path.join( outdir, "assets" ),
+        "gencode": os.path.join( outdir, "assets", "gencode.annotation.gtf.bz2" ),
+        "ncbi_reference": os.path.join( outdir, "assets", "ref_top_level.gff3.bz2" ),
+        "ncbi_history": os.path.join( outdir, "assets", "gene_history.txt.bz2" ),
+        "hgnc": os.path.join( outdir, "assets", "hgnc_complete_set.txt.bz2" ),
+        "methylation": os.path.join( outdir, "methylation" ),
+        "clinical": os.path.join( outdir, "clinical" )
+    }
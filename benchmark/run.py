@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+__author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
+__version__ = '0.01'
+__date__ = 'Oct 21, 2020'
+
+import os, sys, copy, json, time, glob, shutil, platform, tempfile, yaml
+import argparse as ap
+import multiprocessing as mp
+
+# Modules of the repository are imported from its root directory
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import utils, metrics
+import parser.metadata as metadata
+import writer.bed as bed
+import driver.gencode as gencode
+import driver.ncbi as ncbi
+import driver.hgnc as hgnc
+import benchmark.generators as generators
+
+# Offline benchmark of the conversion stages on synthetic data (see benchmark/generators.py)
+# Every stage is measured in its own forked process, so that its peak memory is not affected by the other stages
+# A stage is a function that prepares its inputs and returns the function to measure
+# The measured function returns the number of processed items (e.g. rows or files)
+STAGES = [ ]
+
+# Register a benchmark stage
+def stage( function ):
+    STAGES.append( ( function.__name__, function ) )
+    return function
+
+# Define the settings of the benchmark runs
+# GDC endpoints point to a closed local port, so that any attempt to query GDC fails fast instead of going online
+def get_settings( paths, workdir ):
+    with open( os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), "settings.yaml" ) ) as settings_file:
+        settings = yaml.safe_load( settings_file )
+    settings[ "gdc" ].update( { "searchurl": "http://127.0.0.1:9/files", "downloadurl": "http://127.0.0.1:9/data/", "repeat": 0 } )
+    settings[ "assets" ] = {
+        "gencode": paths[ "gencode" ],
+        "ncbi": { "reference": paths[ "ncbi_reference" ], "history": paths[ "ncbi_history" ] },
+        "hgnc": paths[ "hgnc" ]
+    }
+    settings[ "cache" ] = { "probes": None }
+    return settings
+
+# Count the rows of plain or compressed files, "header" lines are skipped in every file
+def count_rows( filepaths, header=0 ):
+    rows = 0
+    for filepath in filepaths:
+        with bed.open_bed( filepath ) as data:
+            rows += sum( 1 for _ in data ) - header
+    return rows
+
+# Build the Gencode index from scratch
+@stage
+def gencode_index( context ):
+    gencode_db = context[ "settings" ][ "assets" ][ "gencode" ]
+    index_db = gencode.get_index_filepath( gencode_db )
+    if os.path.exists( index_db ):
+        os.unlink( index_db )
+    def run( ):
+        connection = gencode.open_gencode_index( gencode_db )
+        try:
+            return connection.execute( 'SELECT COUNT(*) FROM regions' ).fetchone()[ 0 ]
+        finally:
+            connection.close()
+    return run
+
+# Load the genes from the Gencode index
+@stage
+def gencode_load( context ):
+    gencode_db = context[ "settings" ][ "assets" ][ "gencode" ]
+    gencode.open_gencode_index( gencode_db ).close()
+    def run( ):
+        return len( gencode.get_gencode_info_fromfile( gencode_db, "symbol", "gene", gencode_data={ } )[ "gene" ] )
+    return run
+
+# Build the Gencode interval index
+@stage
+def gencode_intervals( context ):
+    gencode_db = context[ "settings" ][ "assets" ][ "gencode" ]
+    gencode.open_gencode_index( gencode_db ).close()
+    def run( ):
+        return sum( len( entry[ "starts" ] ) for entry in gencode.get_interval_index( gencode_db, "gene" ).values() )
+    return run
+
+# Load the NCBI reference and history files
+@stage
+def ncbi_load( context ):
+    assets = context[ "settings" ][ "assets" ][ "ncbi" ]
+    def run( ):
+        return len( ncbi.get_symbol_entrez_map( assets[ "reference" ] ) ) + \
+               len( ncbi.get_deprecated_symbol_entrez_map( assets[ "history" ] ) )
+    return run
+
+# Load the HGNC file
+@stage
+def hgnc_load( context ):
+    hgnc_db = context[ "settings" ][ "assets" ][ "hgnc" ]
+    def run( ):
+        return len( hgnc.get_symbol_entrez_map( hgnc_db ) )
+    return run
+
+# Convert the methylation files with an empty probes cache
+@stage
+def methylation_convert( context ):
+    datatype = "Methylation Beta Value"
+    filepaths = sorted( glob.glob( os.path.join( context[ "paths" ][ "methylation" ], "*.txt" ) ) )
+    resources = utils.load_resources( datatype, context[ "settings" ], filepaths=filepaths )
+    convert_dir = context[ "convert_dir" ]
+    rows = count_rows( filepaths, header=1 )
+    def run( ):
+        for filepath in filepaths:
+            utils.convert( datatype, filepath, convert_dir, context[ "settings" ], resources=resources )
+        return rows
+    return run
+
+# Convert the methylation files with the probes cache warmed up by a first file
+@stage
+def methylation_convert_cached( context ):
+    datatype = "Methylation Beta Value"
+    filepaths = sorted( glob.glob( os.path.join( context[ "paths" ][ "methylation" ], "*.txt" ) ) )
+    resources = utils.load_resources( datatype, context[ "settings" ], filepaths=filepaths )
+    convert_dir = context[ "convert_dir" ]
+    utils.convert( datatype, filepaths[ 0 ], convert_dir, context[ "settings" ], resources=resources )
+    rows = count_rows( filepaths, header=1 )
+    def run( ):
+        for filepath in filepaths:
+            utils.convert( datatype, filepath, convert_dir, context[ "settings" ], resources=resources )
+        return rows
+    return run
+
+# Export the converted methylation files to a matrix
+@stage
+def methylation_matrix( context ):
+    datatype = "Methylation Beta Value"
+    filepaths = sorted( glob.glob( os.path.join( context[ "convert_dir" ], "*-mbv.bed*" ) ) )
+    if not filepaths:
+        # Inputs are converted by the methylation_convert stages, unless they have been skipped
+        methylation_convert( context )( )
+        filepaths = sorted( glob.glob( os.path.join( context[ "convert_dir" ], "*-mbv.bed*" ) ) )
+    filepaths = [ filepath for filepath in filepaths if not filepath.endswith( ".bgi" ) ]
+    matrix_prefix = os.path.join( context[ "workdir" ], "matrix" )
+    rows = count_rows( filepaths )
+    def run( ):
+        utils.export_matrix( datatype, filepaths, matrix_prefix )
+        return rows
+    return run
+
+# Parse the clinical and biospecimen XML files
+@stage
+def metadata_parse( context ):
+    datatype = "Clinical and Biospecimen Supplements"
+    filepaths = sorted( glob.glob( os.path.join( context[ "paths" ][ "clinical" ], "*.xml" ) ) )
+    def run( ):
+        for filepath in filepaths:
+            utils.convert( datatype, filepath, context[ "convert_dir" ], context[ "settings" ], resources={ } )
+        return len( filepaths )
+    return run
+
+# Build the .meta files of all the aliquots
+@stage
+def metadata_build( context ):
+    datatype = "Clinical and Biospecimen Supplements"
+    clinical = { }
+    biospecimen = { }
+    for filepath in sorted( glob.glob( os.path.join( context[ "paths" ][ "clinical" ], "*.xml" ) ) ):
+        _, _, partial = utils.convert( datatype, filepath, context[ "convert_dir" ], context[ "settings" ], resources={ } )
+        if "org_clinical." in os.path.basename( filepath ):
+            clinical.update( partial )
+        else:
+            biospecimen.update( partial )
+    outdir = os.path.join( context[ "workdir" ], "metadata" )
+    if os.path.exists( outdir ):
+        shutil.rmtree( outdir )
+    os.makedirs( outdir )
+    database = context[ "settings" ].get( "convert", { } ).get( "metadata_db", False )
+    def run( ):
+        return len( metadata.build_metadata( outdir, clinical, biospecimen, database=database ) )
+    return run
+
+# Measure a stage in the current process
+def measure( function, context ):
+    run = function( context )
+    metrics.reset_peak_rss( )
+    start = time.perf_counter( )
+    items = run( )
+    seconds = time.perf_counter( ) - start
+    return {
+        "seconds": round( seconds, 4 ),
+        "peak_rss_mb": round( metrics.get_peak_rss( ), 1 ),
+        "items": items,
+        "items_per_second": round( items / seconds, 1 ) if seconds > 0 else None
+    }
+
+# Measure a stage in a forked process and send the results back through a pipe
+def measure_forked( function, context, connection ):
+    try:
+        connection.send( ( True, measure( function, context ) ) )
+    except Exception as e:
+        connection.send( ( False, "{}: {}".format( type( e ).__name__, e ) ) )
+    finally:
+        connection.close( )
+
+# Run a stage "repeat" times and keep the fastest run
+def run_stage( function, context, repeat=1 ):
+    best = None
+    for _ in range( repeat ):
+        if "fork" in mp.get_all_start_methods():
+            fork = mp.get_context( "fork" )
+            receiver, sender = fork.Pipe( duplex=False )
+            process = fork.Process( target=measure_forked, args=( function, context, sender ) )
+            process.start( )
+            sender.close( )
+            try:
+                succeeded, result = receiver.recv( )
+            except EOFError:
+                succeeded, result = False, "Process terminated"
+            process.join( )
+            if not succeeded:
+                raise RuntimeError( result )
+        else:
+            result = measure( function, context )
+        if best is None or result[ "seconds" ] < best[ "seconds" ]:
+            best = result
+    return best
+
+# Compare a report with a baseline report
+# A stage regresses if its time or peak memory exceeds the baseline by more than "tolerance" (e.g. 0.1 is 10%)
+# Return the list of regressed stages
+def compare( report, baseline, tolerance=0.1, verbose=True ):
+    regressions = [ ]
+    if report[ "dataset" ] != baseline.get( "dataset" ):
+        print( "Warning: the baseline has been measured on a different dataset" )
+    if verbose:
+        print( "{:<28} {:>10} {:>10} {:>8} {:>12} {:>12} {:>8}".format( "stage", "base (s)", "time (s)", "ratio",
+                                                                       "base (MB)", "peak (MB)", "ratio" ) )
+    for name, result in report[ "stages" ].items():
+        base = baseline.get( "stages", { } ).get( name )
+        if base is None:
+            continue
+        time_ratio = result[ "seconds" ] / base[ "seconds" ] if base[ "seconds" ] > 0 else 1.0
+        rss_ratio = result[ "peak_rss_mb" ] / base[ "peak_rss_mb" ] if base[ "peak_rss_mb" ] > 0 else 1.0
+        regressed = time_ratio > 1.0 + tolerance or rss_ratio > 1.0 + tolerance
+        if regressed:
+            regressions.append( name )
+        if verbose:
+            print( "{:<28} {:>10.3f} {:>10.3f} {:>8.2f} {:>12.1f} {:>12.1f} {:>8.2f}{}".format( name, base[ "seconds" ], result[ "seconds" ],
+                                                                                              time_ratio, base[ "peak_rss_mb" ],
+                                                                                              result[ "peak_rss_mb" ], rss_ratio,
+                                                                                              "  REGRESSION" if regressed else "" ) )
+    return regressions
+
+if __name__ == '__main__':
+    # Load command line parameters
+    p = ap.ArgumentParser( description = 'Offline benchmark of the OpenGDC conversion stages on synthetic data',
+                           formatter_class = ap.ArgumentDefaultsHelpFormatter )
+    p.add_argument( '--workdir', type = str, default = os.path.join( tempfile.gettempdir(), "opengdc_benchmark" ),
+                    help = 'Directory with the synthetic dataset and the converted files' )
+    p.add_argument( '--scale', type = float, default = 0.01,
+                    help = 'Size of the synthetic assets and methylation files, 1.0 is the size of the real ones' )
+    p.add_argument( '--platform', type = str, default = "450K", choices = sorted( generators.PLATFORMS ),
+                    help = 'Methylation platform' )
+    p.add_argument( '--samples', type = int, default = 4,
+                    help = 'Number of methylation files' )
+    p.add_argument( '--patients', type = int, default = 50,
+                    help = 'Number of patients with clinical and biospecimen supplements' )
+    p.add_argument( '--seed', type = int, default = 0,
+                    help = 'Seed of the synthetic dataset' )
+    p.add_argument( '--stages', type = str, nargs = '+', choices = [ name for name, _ in STAGES ],
+                    help = 'Run the specified stages only' )
+    p.add_argument( '--repeat', type = int, default = 1,
+                    help = 'Run every stage multiple times and report the fastest run' )
+    p.add_argument( '--output', type = str,
+                    help = 'Dump the report to a JSON file' )
+    p.add_argument( '--baseline', type = str,
+                    help = 'Compare the report with a baseline JSON report, exit with status 1 in case of regressions' )
+    p.add_argument( '--tolerance', type = float, default = 0.1,
+                    help = 'Max relative slowdown or memory increase with respect to the baseline' )
+    p.add_argument( '--verbose', action = 'store_true', default = False,
+                    help = 'Print results on screen' )
+    args = p.parse_args()
+
+    paths = generators.generate_dataset( os.path.join( args.workdir, "dataset" ), scale=args.scale, platform=args.platform,
+                                         samples=args.samples, patients=args.patients, seed=args.seed, verbose=args.verbose )
+    with open( os.path.join( args.workdir, "dataset", "dataset.json" ) ) as dataset:
+        dataset = json.load( dataset )
+    context = {
+        "paths": paths,
+        "workdir": args.workdir,
+        "convert_dir": os.path.join( args.workdir, "converted" ),
+        "settings": get_settings( paths, args.workdir )
+    }
+    if os.path.exists( context[ "convert_dir" ] ):
+        shutil.rmtree( context[ "convert_dir" ] )
+    os.makedirs( context[ "convert_dir" ] )
+
+    report = {
+        "dataset": dataset,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "stages": { }
+    }
+    for name, function in STAGES:
+        if args.stages and name not in args.stages:
+            continue
+        if args.verbose:
+            print( "Running {}".format( name ) )
+        # Stages must not alter the settings of the following ones
+        report[ "stages" ][ name ] = run_stage( function, dict( context, settings=copy.deepcopy( context[ "settings" ] ) ),
+                                                repeat=max( args.repeat, 1 ) )
+        if args.verbose:
+            print( "\t{seconds:.3f} s, {peak_rss_mb:.1f} MB, {items} items, {items_per_second} items/s".format( **report[ "stages" ][ name ] ) )
+
+    if args.output:
+        with open( args.output, 'w' ) as output:
+            json.dump( report, output, indent=1 )
+    else:
+        print( json.dumps( report, indent=1 ) )
+
+    if args.baseline:
+        with open( args.baseline ) as baseline:
+            regressions = compare( report, json.load( baseline ), tolerance=args.tolerance )
+        if regressions:
+            print( "Regressions: {}".format( ", ".join( regressions ) ) )
+            sys.exit( 1 )
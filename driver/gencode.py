@@ -4,10 +4,165 @@ __author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
 __version__ = '0.01'
 __date__ = 'Oct 10, 2020'
 
-import os, bz2
+import os, bz2, hashlib, sqlite3, tempfile, itertools
+import numpy as np
+
+# Strands are stored as integers in the Gencode index
+STRAND2CODE = { '+': 1, '-': -1 }
+CODE2STRAND = { 1: '+', -1: '-', 0: '.' }
+
+# Define the Gencode index file path
+# The index is located next to the Gencode DB in assets
+def get_index_filepath( gencode_db ):
+    basename = gencode_db[ :-len( ".bz2" ) ] if gencode_db.endswith( ".bz2" ) else gencode_db
+    return '{}.sqlite'.format( basename )
+
+# Compute the MD5 hash of the Gencode DB
+def get_md5( filepath, chunk_size=1048576 ):
+    md5 = hashlib.md5()
+    with open( filepath, 'rb' ) as source:
+        for chunk in iter( lambda: source.read( chunk_size ), b'' ):
+            md5.update( chunk )
+    return md5.hexdigest()
+
+# Build the Gencode index by reading the Gencode DB once
+# Regions of any type are stored with integer chromosome, start, end, and strand
+# Regions are indexed by lowercased gene symbol and by Ensembl id
+def build_gencode_index( gencode_db, index_db, verbose=False ):
+    if verbose:
+        print( "\tBuilding Gencode index {}".format( index_db ) )
+    # Write the index to a temporary file first and move it in place once completed
+    # Every builder has its own temporary file, so that concurrent runs sharing the assets do not clash
+    tmp_fd, tmp_index_db = tempfile.mkstemp( prefix='{}.'.format( os.path.basename( index_db ) ), suffix='.tmp', 
+                                             dir=os.path.dirname( os.path.abspath( index_db ) ) )
+    os.close( tmp_fd )
+    connection = sqlite3.connect( tmp_index_db )
+    try:
+        connection.executescript(
+            'CREATE TABLE source ( size INTEGER, mtime INTEGER, md5 TEXT );'
+            'CREATE TABLE chromosomes ( id INTEGER PRIMARY KEY, name TEXT );'
+            'CREATE TABLE types ( id INTEGER PRIMARY KEY, name TEXT );'
+            'CREATE TABLE regions ( type INTEGER, symbol TEXT, ensembl_id TEXT, '
+                                   'chr INTEGER, start INTEGER, end INTEGER, strand INTEGER );'
+        )
+        chromosomes = { }
+        types = { }
+        rows = [ ]
+        with bz2.open( gencode_db, 'rt' ) as gencode:
+            for line in gencode:
+                if line.startswith( "#" ) or not line.strip():
+                    continue
+                line_split = line.rstrip( "\n" ).split( "\t" )
+                line_type = line_split[ 2 ].strip()
+                # Retrieve additional information from Gencode
+                symbol = "NA"
+                ensembl_id_noversion = "NA"
+                for data in line_split[ 8 ].split( ";" ):
+                    data = data.strip()
+                    if data.startswith( "gene_name" ):
+                        symbol = data.split( "\"" )[ -2 ]
+                    elif data.startswith( "gene_id" ):
+                        ensembl_id_noversion = data.split( "\"" )[ -2 ].split( "." )[ 0 ]
+                chromosome = line_split[ 0 ].strip()
+                if chromosome not in chromosomes:
+                    chromosomes[ chromosome ] = len( chromosomes )
+                if line_type not in types:
+                    types[ line_type ] = len( types )
+                rows.append( ( types[ line_type ], symbol, ensembl_id_noversion, chromosomes[ chromosome ],
+                               int( line_split[ 3 ] ), int( line_split[ 4 ] ),
+                               STRAND2CODE.get( line_split[ 6 ].strip(), 0 ) ) )
+                # Flush rows in batches to keep memory bounded
+                if len( rows ) >= 100000:
+                    connection.executemany( 'INSERT INTO regions VALUES ( ?, ?, ?, ?, ?, ?, ? )', rows )
+                    rows = [ ]
+        if rows:
+            connection.executemany( 'INSERT INTO regions VALUES ( ?, ?, ?, ?, ?, ?, ? )', rows )
+        connection.executemany( 'INSERT INTO chromosomes VALUES ( ?, ? )',
+                                [ ( code, name ) for name, code in chromosomes.items() ] )
+        connection.executemany( 'INSERT INTO types VALUES ( ?, ? )',
+                                [ ( code, name ) for name, code in types.items() ] )
+        connection.executescript(
+            'CREATE INDEX regions_symbol ON regions ( type, lower( symbol ) );'
+            'CREATE INDEX regions_ensembl_id ON regions ( type, ensembl_id );'
+        )
+        stat = os.stat( gencode_db )
+        connection.execute( 'INSERT INTO source VALUES ( ?, ?, ? )',
+                            ( stat.st_size, stat.st_mtime_ns, get_md5( gencode_db ) ) )
+        connection.commit()
+    except Exception:
+        # Remove the partial index
+        connection.close()
+        os.unlink( tmp_index_db )
+        raise
+    connection.close()
+    # Temporary files are only readable by their owner, the index is shared like the Gencode DB
+    os.chmod( tmp_index_db, os.stat( gencode_db ).st_mode & 0o777 )
+    os.replace( tmp_index_db, index_db )
+
+# Open the Gencode index
+# The index is built the first time and rebuilt whenever the Gencode DB changes
+def open_gencode_index( gencode_db, verbose=False ):
+    index_db = get_index_filepath( gencode_db )
+    stat = os.stat( gencode_db )
+    if os.path.exists( index_db ):
+        connection = sqlite3.connect( index_db )
+        try:
+            source = connection.execute( 'SELECT size, mtime, md5 FROM source' ).fetchone()
+        except sqlite3.DatabaseError:
+            # Broken index
+            source = None
+        # The source is missing if the index has not been built completely
+        size, mtime, md5 = source if source is not None else ( None, None, None )
+        if size == stat.st_size and mtime == stat.st_mtime_ns:
+            return connection
+        if size == stat.st_size and md5 == get_md5( gencode_db ):
+            # The Gencode DB has been touched but its content did not change
+            connection.execute( 'UPDATE source SET mtime = ?', ( stat.st_mtime_ns, ) )
+            connection.commit()
+            return connection
+        connection.close()
+    build_gencode_index( gencode_db, index_db, verbose=verbose )
+    return sqlite3.connect( index_db )
+
+# Convert a row of the Gencode index into a Gencode entry
+def get_entry( row, chromosomes, region_type ):
+    return {
+        'chr': chromosomes[ row[ 0 ] ],
+        'start': row[ 1 ],
+        'end': row[ 2 ],
+        'strand': CODE2STRAND[ row[ 3 ] ],
+        'type': region_type,
+        'symbol': row[ 4 ],
+        'ensembl_id': row[ 5 ]
+    }
+
+# Retrieve the Gencode entries of a specific region type which match an identifier
+# region_name can be "symbol" or "ensembl_id"
+def get_gencode_entries( gencode_db, region_name, region_type, identifier ):
+    connection = open_gencode_index( gencode_db )
+    try:
+        chromosomes = dict( connection.execute( 'SELECT id, name FROM chromosomes' ) )
+        types = { name.lower(): ( code, name ) for code, name in connection.execute( 'SELECT id, name FROM types' ) }
+        if region_type.lower() not in types:
+            return [ ]
+        type_code, type_name = types[ region_type.lower() ]
+        if region_name.lower() == "symbol":
+            condition = 'lower( symbol ) = ?'
+            identifier = identifier.lower()
+        elif region_name.lower() == "ensembl_id":
+            condition = 'ensembl_id = ?'
+        else:
+            return [ ]
+        rows = connection.execute( 'SELECT chr, start, end, strand, symbol, ensembl_id FROM regions '
+                                   'WHERE type = ? AND {} ORDER BY rowid'.format( condition ),
+                                   ( type_code, identifier ) )
+        return [ get_entry( row, chromosomes, type_name ) for row in rows ]
+    finally:
+        connection.close()
 
 # Load the Gencode DB partially
-def get_gencode_info_fromfile( gencode_db, region_name, region_type, gencode_data={ } ):
+# Data are read from the Gencode index which is built on the first call
+def get_gencode_info_fromfile( gencode_db, region_name, region_type, gencode_data={ }, verbose=False ):
     if not gencode_data:
         gencode_data = {
             'gene': { },
@@ -18,48 +173,120 @@ def get_gencode_info_fromfile( gencode_db, region_name, region_type, gencode_dat
             'start_codon': { },
             'stop_codon': { }
         }
-    
+
     # If gencode_data is already defined, avoid reading the Gencode DB again
     if not gencode_data[ region_type.lower() ]:
-        # Read the Gencode DB from assets
-        with bz2.open( gencode_db, 'rt' ) as gencode:
-            for line in gencode:
-                line = line.strip()
-                if line:
-                    if not line.startswith( "#" ):
-                        entry = { }
-                        line_split = line.split( "\t" )
-                        line_type = line_split[ 2 ].strip()
-                        # Consider a specific type only
-                        if line_type.lower() == region_type.lower():
-                            # Retrieve chromosome, start, end, strand and type
-                            entry[ 'chr' ] = line_split[ 0 ].strip()
-                            entry[ 'start' ] = line_split[ 3 ].strip()
-                            entry[ 'end' ] = line_split[ 4 ].strip()
-                            entry[ 'strand' ] = line_split[ 6 ].strip()
-                            entry[ 'type' ] = line_type
-                            # Retrieve additional information from Gencode
-                            extended_info_arr = line_split[ 8 ].strip().split( ";" )
-                            symbol = "NA"
-                            ensembl_id_noversion = "NA"
-                            for data in extended_info_arr:
-                                if data.lower().strip().startswith( "gene_name" ):
-                                    symbol = data.strip().split( "\"" )[ -2 ]
-                                elif data.lower().strip().startswith( "gene_id" ):
-                                    ensembl_id_noversion = data.strip().split( "\"" )[ -2 ].split( "." )[ 0 ];
-                            entry[ 'symbol' ] = symbol
-                            entry[ 'ensembl_id' ] = ensembl_id_noversion
-                            # Define an identifier for the Gencode map
-                            identifier = ""
-                            if region_name.lower() == "symbol":
-                                identifier = symbol.lower()
-                            elif region_name.lower() == "ensembl_id":
-                                identifier = ensembl_id_noversion
-                            # Put extended results into the Gencode map
-                            if identifier.strip():
-                                entries = [ ]
-                                if identifier in gencode_data:
-                                    entries = gencode_data[ region_type.lower() ][ identifier ]
-                                entries.append( entry )
-                                gencode_data[ region_type.lower() ][ identifier ] = entries
-    return gencode_data
\ No newline at end of file
+        connection = open_gencode_index( gencode_db, verbose=verbose )
+        try:
+            chromosomes = dict( connection.execute( 'SELECT id, name FROM chromosomes' ) )
+            for type_code, type_name in connection.execute( 'SELECT id, name FROM types' ).fetchall():
+                # Consider a specific type only
+                if type_name.lower() != region_type.lower():
+                    continue
+                rows = connection.execute( 'SELECT chr, start, end, strand, symbol, ensembl_id FROM regions '
+                                           'WHERE type = ? ORDER BY rowid', ( type_code, ) )
+                for row in rows:
+                    entry = get_entry( row, chromosomes, type_name )
+                    # Define an identifier for the Gencode map
+                    identifier = ""
+                    if region_name.lower() == "symbol":
+                        identifier = entry[ 'symbol' ].lower()
+                    elif region_name.lower() == "ensembl_id":
+                        identifier = entry[ 'ensembl_id' ]
+                    # Put extended results into the Gencode map
+                    # The last entry of an identifier wins, as it did while scanning the Gencode DB
+                    if identifier.strip():
+                        gencode_data[ region_type.lower() ][ identifier ] = [ entry ]
+        finally:
+            connection.close()
+    return gencode_data
+
+# Build a coordinate interval index of the regions of a specific type from the Gencode index
+# Regions are grouped by chromosome and sorted by start position into NumPy arrays
+# "max_ends" is the running maximum of the end positions, "end_order" sorts the regions by end position
+def get_interval_index( gencode_db, region_type="gene", verbose=False ):
+    connection = open_gencode_index( gencode_db, verbose=verbose )
+    try:
+        chromosomes = dict( connection.execute( 'SELECT id, name FROM chromosomes' ) )
+        types = { name.lower(): code for code, name in connection.execute( 'SELECT id, name FROM types' ) }
+        if region_type.lower() not in types:
+            return { }
+        rows = connection.execute( 'SELECT chr, start, end, strand, symbol, ensembl_id FROM regions '
+                                   'WHERE type = ? ORDER BY chr, start, end, rowid', 
+                                   ( types[ region_type.lower() ], ) ).fetchall()
+    finally:
+        connection.close()
+    interval_index = { }
+    for chromosome_code, regions in itertools.groupby( rows, key=lambda row: row[ 0 ] ):
+        chr_regions = list( zip( *regions ) )
+        ends = np.array( chr_regions[ 2 ], dtype=np.int64 )
+        end_order = np.argsort( ends, kind="stable" )
+        interval_index[ chromosomes[ chromosome_code ] ] = {
+            "starts": np.array( chr_regions[ 1 ], dtype=np.int64 ),
+            "ends": ends,
+            "max_ends": np.maximum.accumulate( ends ),
+            "end_order": end_order,
+            "sorted_ends": ends[ end_order ],
+            "strands": np.array( [ CODE2STRAND[ strand ] for strand in chr_regions[ 3 ] ] ),
+            "symbols": np.array( chr_regions[ 4 ] ),
+            "ensembl_ids": np.array( chr_regions[ 5 ] )
+        }
+    return interval_index
+
+# Find the regions overlapping a batch of intervals on a chromosome
+# "starts" and "ends" are arrays of inclusive coordinates
+# Return two arrays with the positions of the intervals and of the overlapping regions in the chromosome entry of the index
+# Pairs are sorted by interval and by region start position
+def query_overlaps( interval_index, chromosome, starts, ends ):
+    starts = np.asarray( starts, dtype=np.int64 )
+    ends = np.asarray( ends, dtype=np.int64 )
+    entry = interval_index.get( chromosome )
+    if entry is None or len( starts ) == 0:
+        return np.zeros( 0, dtype=np.int64 ), np.zeros( 0, dtype=np.int64 )
+    # Regions before "first" end before the intervals, regions from "last" on start after the intervals
+    first = np.searchsorted( entry[ "max_ends" ], starts, side="left" )
+    last = np.searchsorted( entry[ "starts" ], ends, side="right" )
+    counts = np.maximum( last - first, 0 )
+    # Expand the candidate ranges into pairs
+    queries = np.repeat( np.arange( len( starts ) ), counts )
+    offsets = np.arange( counts.sum() ) - np.repeat( np.cumsum( counts ) - counts, counts )
+    regions = np.repeat( first, counts ) + offsets
+    overlapping = entry[ "ends" ][ regions ] >= starts[ queries ]
+    return queries[ overlapping ], regions[ overlapping ]
+
+# Find the nearest region to every interval in a batch of intervals on a chromosome
+# Return two arrays with the positions of the nearest regions in the chromosome entry of the index and their distances
+# The distance is 0 for overlapping regions, positions are -1 if there are no regions on the chromosome
+# The first region by start position wins among overlapping regions, the upstream region wins on ties
+def query_nearest( interval_index, chromosome, starts, ends ):
+    starts = np.asarray( starts, dtype=np.int64 )
+    ends = np.asarray( ends, dtype=np.int64 )
+    nearest = np.full( len( starts ), -1, dtype=np.int64 )
+    distances = np.full( len( starts ), -1, dtype=np.int64 )
+    entry = interval_index.get( chromosome )
+    if entry is None or len( starts ) == 0:
+        return nearest, distances
+    no_region = np.iinfo( np.int64 ).max
+    # Closest region ending before the intervals
+    before = np.searchsorted( entry[ "sorted_ends" ], starts, side="left" ) - 1
+    has_before = before >= 0
+    before = np.maximum( before, 0 )
+    before_distances = np.where( has_before, starts - entry[ "sorted_ends" ][ before ], no_region )
+    # Closest region starting after the intervals
+    after = np.searchsorted( entry[ "starts" ], ends, side="right" )
+    has_after = after < len( entry[ "starts" ] )
+    after = np.minimum( after, len( entry[ "starts" ] ) - 1 )
+    after_distances = np.where( has_after, entry[ "starts" ][ after ] - ends, no_region )
+    upstream = before_distances <= after_distances
+    nearest = np.where( upstream, np.where( has_before, entry[ "end_order" ][ before ], -1 ), 
+                                  np.where( has_after, after, -1 ) )
+    distances = np.where( nearest >= 0, np.minimum( before_distances, after_distances ), -1 )
+    # Overlapping regions
+    queries, regions = query_overlaps( interval_index, chromosome, starts, ends )
+    if len( queries ) > 0:
+        # Keep the first overlapping region of every interval
+        first_pair = np.ones( len( queries ), dtype=bool )
+        first_pair[ 1: ] = queries[ 1: ] != queries[ :-1 ]
+        nearest[ queries[ first_pair ] ] = regions[ first_pair ]
+        distances[ queries[ first_pair ] ] = 0
+    return nearest, distances
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+__author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
+__version__ = '0.01'
+__date__ = 'Oct 21, 2020'
+
+import os, sys, json, time, shutil, hashlib, tarfile, tempfile, threading
+import argparse as ap
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# On-disk cache of the responses of the GDC API queries
+# Responses are keyed by the path of the endpoint (e.g. "/files") and by the canonical JSON payload of the query
+# The host is not part of the key, so that responses recorded from GDC can be replayed by a local stand-in server
+# Every response is a JSON file <key[:2]>/<key>.json in the cache directory
+#   - responses older than "ttl" seconds are discarded, unless the cache is used in offline mode
+#   - the least recently used responses are evicted once the cache exceeds "max_size" bytes
+# Modes:
+#   - online: GDC is queried if the response is not in the cache
+#   - offline: responses are served from the cache only, GDC is never contacted and files are not downloaded
+#   - record: as online, but all the responses and the downloaded files are also recorded to a session directory
+#     that can be replayed with the stand-in server defined in this module
+MODES = [ "online", "offline", "record" ]
+
+# Name of the list of recorded files in a session directory
+SESSION_FILES = "files.tsv"
+
+# Recorded files are appended by concurrent downloads
+LOCK = threading.Lock()
+
+# Size in bytes of the cache directories
+# It is computed by walking a cache directory the first time only, then it is tracked incrementally
+SIZES = { }
+
+# Fraction of "max_size" the cache is shrunk to once it exceeds "max_size", so that eviction does not run after every store
+EVICT_TO = 0.9
+
+# Define the cache of the GDC queries from settings.yaml
+# Return None if both the cache and the session recording are disabled
+def get_cache( settings ):
+    gdc = settings.get( "gdc", { } )
+    mode = gdc.get( "mode" ) or "online"
+    if mode not in MODES:
+        raise ValueError( "Unknown GDC mode {}, it must be one of {}".format( mode, ", ".join( MODES ) ) )
+    if not gdc.get( "cache" ) and mode == "online":
+        return None
+    return {
+        "dirpath": gdc.get( "cache" ),
+        "ttl": gdc.get( "cache_ttl" ),
+        "max_size": int( gdc.get( "cache_size" ) or 0 ) * 1048576,
+        "mode": mode,
+        "session": gdc.get( "session" ) if mode == "record" else None
+    }
+
+# Check whether the cache serves responses without contacting GDC
+def is_offline( cache ):
+    return cache is not None and cache[ "mode" ] == "offline"
+
+# Define the key of a query
+def get_key( url, params ):
+    payload = json.dumps( [ urlparse( url ).path.rstrip( "/" ), params ], sort_keys=True, separators=( ",", ":" ) )
+    return hashlib.md5( payload.encode() ).hexdigest()
+
+# Define the path to a response in a cache or session directory
+def get_entry_filepath( dirpath, key ):
+    return os.path.join( dirpath, key[ :2 ], '{}.json'.format( key ) )
+
+# Write a response to a cache or session directory
+def write_entry( dirpath, key, url, params, response ):
+    entry_filepath = get_entry_filepath( dirpath, key )
+    os.makedirs( os.path.dirname( entry_filepath ), exist_ok=True )
+    # Write to a temporary file first and move it in place once completed
+    # The same response can be written by concurrent runs
+    with tempfile.NamedTemporaryFile( 'w', dir=os.path.dirname( entry_filepath ), suffix='.tmp', delete=False ) as tmp_entry:
+        json.dump( { "endpoint": urlparse( url ).path, "params": params, "created": time.time(), "response": response }, tmp_entry )
+    os.replace( tmp_entry.name, entry_filepath )
+    return entry_filepath
+
+# Read a response from a cache or session directory
+# Return the response with its creation time, or None if the response is not available
+def read_entry( dirpath, key ):
+    try:
+        with open( get_entry_filepath( dirpath, key ) ) as entry_file:
+            entry = json.load( entry_file )
+        return entry[ "response" ], entry[ "created" ]
+    except ( OSError, ValueError, KeyError ):
+        # Missing or broken entry
+        return None
+
+# Retrieve the response of a query from the cache
+# Return None if the response is not in the cache or it is expired
+def lookup( cache, url, params ):
+    if cache is None or not cache[ "dirpath" ]:
+        return None
+    key = get_key( url, params )
+    entry = read_entry( cache[ "dirpath" ], key )
+    if entry is None:
+        return None
+    response, created = entry
+    if cache[ "ttl" ] and time.time() - created > cache[ "ttl" ] and not is_offline( cache ):
+        # Expired responses are still served in offline mode
+        return None
+    try:
+        # Keep track of the last access for the eviction of the least recently used responses
+        os.utime( get_entry_filepath( cache[ "dirpath" ], key ) )
+    except OSError:
+        pass
+    return response
+
+# Store the response of a query to the cache, and to the session directory in record mode
+def store( cache, url, params, response ):
+    if cache is None or is_offline( cache ):
+        return
+    key = get_key( url, params )
+    if cache[ "dirpath" ]:
+        entry_filepath = get_entry_filepath( cache[ "dirpath" ], key )
+        previous_size = os.path.getsize( entry_filepath ) if os.path.exists( entry_filepath ) else 0
+        write_entry( cache[ "dirpath" ], key, url, params, response )
+        if cache[ "max_size" ]:
+            with LOCK:
+                size = SIZES.get( cache[ "dirpath" ] )
+                if size is not None:
+                    size += os.path.getsize( entry_filepath ) - previous_size
+                if size is None or size > cache[ "max_size" ]:
+                    # The size is synchronized with the cache directory, which can be shared with concurrent runs
+                    size = evict( cache[ "dirpath" ], cache[ "max_size" ], target_size=int( cache[ "max_size" ] * EVICT_TO ) )
+                SIZES[ cache[ "dirpath" ] ] = size
+    record( cache, url, params, response )
+
+# Record the response of a query to the session directory in record mode
+# Responses served from the cache must be recorded too, the session is replayed without the cache
+def record( cache, url, params, response ):
+    if cache is None or not cache[ "session" ]:
+        return
+    write_entry( cache[ "session" ], get_key( url, params ), url, params, response )
+
+# Evict the least recently used responses if the size of the cache exceeds "max_size" bytes
+# Responses are evicted until the size of the cache is below "target_size" bytes ("max_size" by default)
+# Return the size of the cache
+def evict( dirpath, max_size, target_size=None ):
+    entries = [ ]
+    size = 0
+    for root, _, filenames in os.walk( dirpath ):
+        for filename in filenames:
+            if filename.endswith( ".json" ):
+                try:
+                    stat = os.stat( os.path.join( root, filename ) )
+                except OSError:
+                    continue
+                entries.append( ( stat.st_mtime, stat.st_size, os.path.join( root, filename ) ) )
+                size += stat.st_size
+    if size <= max_size:
+        return size
+    for _, entry_size, entry_filepath in sorted( entries ):
+        if size <= ( max_size if target_size is None else target_size ):
+            break
+        try:
+            os.unlink( entry_filepath )
+        except OSError:
+            pass
+        size -= entry_size
+    return size
+
+# Remove all the responses from the cache
+def clear( cache ):
+    if cache is not None and cache[ "dirpath" ] and os.path.exists( cache[ "dirpath" ] ):
+        shutil.rmtree( cache[ "dirpath" ] )
+        SIZES.pop( cache[ "dirpath" ], None )
+
+# Record a downloaded file to the session directory in record mode
+def record_file( cache, file_uuid, filepath ):
+    if cache is None or not cache[ "session" ]:
+        return
+    os.makedirs( cache[ "session" ], exist_ok=True )
+    with LOCK, open( os.path.join( cache[ "session" ], SESSION_FILES ), 'a' ) as files:
+        files.write( '{}\t{}\n'.format( file_uuid, os.path.abspath( filepath ) ) )
+
+# Load the recorded files of a session as a dict <file uuid, file path>
+def load_session_files( session_dir ):
+    files = { }
+    session_files_filepath = os.path.join( session_dir, SESSION_FILES )
+    if os.path.exists( session_files_filepath ):
+        with open( session_files_filepath ) as session_files:
+            for line in session_files:
+                if line.strip():
+                    file_uuid, filepath = line.rstrip( "\n" ).split( "\t" )
+                    files[ file_uuid ] = filepath
+    return files
+
+# Define the request handler of the stand-in server of a recorded session
+# Queries are answered with the recorded responses, files are served from the paths in which they have been recorded
+# Batches of files posted to the "data" endpoint are served as a tar.gz archive of <file uuid>/<file name> files as GDC does
+def get_handler( session_dir, verbose=False ):
+    files = load_session_files( session_dir )
+
+    class SessionHandler( BaseHTTPRequestHandler ):
+        def log_message( self, format, *args ):
+            if verbose:
+                BaseHTTPRequestHandler.log_message( self, format, *args )
+
+        def send_json( self, status, payload ):
+            body = json.dumps( payload ).encode()
+            self.send_response( status )
+            self.send_header( "Content-Type", "application/json" )
+            self.send_header( "Content-Length", str( len( body ) ) )
+            self.end_headers()
+            self.wfile.write( body )
+
+        def do_POST( self ):
+            try:
+                params = json.loads( self.rfile.read( int( self.headers.get( "Content-Length", 0 ) ) ) or b"{}" )
+            except ValueError:
+                self.send_json( 400, { "message": "Invalid JSON payload" } )
+                return
+            if urlparse( self.path ).path.rstrip( "/" ).endswith( "/data" ) and "ids" in params:
+                if len( params[ "ids" ] ) == 1:
+                    # GDC does not archive single files
+                    self.send_file( params[ "ids" ][ 0 ] )
+                else:
+                    self.send_archive( params[ "ids" ] )
+                return
+            entry = read_entry( session_dir, get_key( self.path, params ) )
+            if entry is None:
+                self.send_json( 404, { "message": "Query not recorded" } )
+            else:
+                self.send_json( 200, entry[ 0 ] )
+
+        def send_archive( self, file_uuids ):
+            missing = [ file_uuid for file_uuid in file_uuids if not os.path.exists( files.get( file_uuid ) or "" ) ]
+            if missing:
+                self.send_json( 404, { "message": "Files not recorded: {}".format( ", ".join( missing ) ) } )
+                return
+            # The archive is streamed, the end of the response is marked by closing the connection
+            self.send_response( 200 )
+            self.send_header( "Content-Type", "application/x-tar" )
+            self.end_headers()
+            with tarfile.open( fileobj=self.wfile, mode='w|gz' ) as archive:
+                for file_uuid in file_uuids:
+                    # Recorded files are named <file uuid>_<file name>
+                    file_name = os.path.basename( files[ file_uuid ] )[ len( file_uuid ) + 1: ]
+                    archive.add( files[ file_uuid ], arcname='{}/{}'.format( file_uuid, file_name ) )
+
+        def do_GET( self ):
+            # Files are requested as <downloadurl><file uuid>
+            self.send_file( urlparse( self.path ).path.rstrip( "/" ).split( "/" )[ -1 ] )
+
+        def send_file( self, file_uuid ):
+            filepath = files.get( file_uuid )
+            if filepath is None or not os.path.exists( filepath ):
+                self.send_json( 404, { "message": "File not recorded" } )
+                return
+            size = os.path.getsize( filepath )
+            offset = 0
+            if self.headers.get( "Range", "" ).startswith( "bytes=" ):
+                offset = int( self.headers[ "Range" ][ len( "bytes=" ): ].split( "-" )[ 0 ] or 0 )
+                if offset >= size:
+                    self.send_response( 416 )
+                    self.send_header( "Content-Range", "bytes */{}".format( size ) )
+                    self.end_headers()
+                    return
+                self.send_response( 206 )
+                self.send_header( "Content-Range", "bytes {}-{}/{}".format( offset, size - 1, size ) )
+            else:
+                self.send_response( 200 )
+            self.send_header( "Content-Type", "application/octet-stream" )
+            self.send_header( "Content-Length", str( size - offset ) )
+            self.end_headers()
+            with open( filepath, 'rb' ) as data:
+                data.seek( offset )
+                shutil.copyfileobj( data, self.wfile, 1048576 )
+
+    return SessionHandler
+
+# Serve a recorded session
+# Runs pointing their GDC endpoints to the server (e.g. searchurl http://127.0.0.1:8765/files and
+# downloadurl http://127.0.0.1:8765/data/) replay the recorded queries and downloads without the network
+def serve( session_dir, host="127.0.0.1", port=8765, verbose=False ):
+    server = ThreadingHTTPServer( ( host, port ), get_handler( session_dir, verbose=verbose ) )
+    if verbose:
+        print( "Serving session {} on http://{}:{}".format( session_dir, host, server.server_address[ 1 ] ) )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    p = ap.ArgumentParser( description = 'Stand-in GDC server replaying a session recorded with OpenGDC.py --record',
+                           formatter_class = ap.ArgumentDefaultsHelpFormatter )
+    p.add_argument( '--session',
+                    type = str,
+                    required = True,
+                    help = 'Path to the recorded session directory' )
+    p.add_argument( '--host',
+                    type = str,
+                    default = '127.0.0.1',
+                    help = 'Host name of the server' )
+    p.add_argument( '--port',
+                    type = int,
+                    default = 8765,
+                    help = 'Port of the server' )
+    p.add_argument( '--verbose',
+                    action = 'store_true',
+                    default = False,
+                    help = 'Print requests to STDERR' )
+    args = p.parse_args()
+    if not os.path.isdir( args.session ):
+        print( "Session directory {} does not exist".format( args.session ) )
+        sys.exit( 1 )
+    serve( args.session, host=args.host, port=args.port, verbose=args.verbose )
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+__author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
+__version__ = '0.01'
+__date__ = 'Oct 21, 2020'
+
+import os, time, random, threading, requests, urllib3, metrics
+from email.utils import parsedate_to_datetime
+
+# Request policy shared by all the requests to GDC in the current process
+#   - every request waits for a token of a token bucket refilled at "rate" requests per second (up to "burst" tokens)
+#     and for a free slot, up to "concurrency" requests are in flight at the same time
+#   - requests time out if GDC does not connect or send data for "timeout" seconds
+#   - failed requests are retried after an exponential backoff with full jitter, or after the delay in the
+#     Retry-After header, which also pauses all the other requests
+#   - rate and concurrency adapt to GDC: they are halved when GDC throttles requests, fails with server errors or
+#     timeouts, or becomes slow, and they grow back slowly while requests succeed (additive increase, multiplicative decrease)
+#   - GDC is slow if the latency of an endpoint (the time to receive the response headers) exceeds its baseline, 
+#     latencies and baselines are tracked per endpoint since searches and downloads take different times
+# Concurrent runs slow down independently as soon as GDC is degraded
+POLICY = {
+    "timeout": 30.0,
+    "backoff": 1.0,
+    "backoff_max": 60.0,
+    "max_rate": 10.0,
+    "burst": 10.0,
+    "max_concurrency": 8,
+    "rate": 10.0,
+    "concurrency": 8,
+    "tokens": 10.0,
+    "refilled": 0.0,
+    "active": 0,
+    "successes": 0,
+    "paused_until": 0.0,
+    "decreased": 0.0,
+    "latencies": { }
+}
+
+# Status codes of the requests that can be retried, any other client error is permanent
+RETRY_STATUS = [ 408, 416, 425, 429, 500, 502, 503, 504 ]
+
+# Status codes with which GDC asks to slow down
+THROTTLE_STATUS = [ 429, 503 ]
+
+# Requests are considered slow if the average latency of their endpoint exceeds this factor of its baseline (and 1 second)
+SLOW_FACTOR = 4.0
+
+# Weight of the last request in the average latency of an endpoint
+LATENCY_WEIGHT = 0.2
+
+# The baseline of an endpoint follows lower latencies immediately and it drifts towards higher latencies with this weight,
+# so that the baseline is not stuck to an unusually fast request
+BASELINE_DECAY = 0.01
+
+# Min number of seconds between two consecutive decreases, failures of concurrent requests count once
+COOLDOWN = 1.0
+
+# Max number of seconds a Retry-After header can pause requests
+MAX_RETRY_AFTER = 600.0
+
+CONDITION = threading.Condition()
+
+# Reset the policy lock in forked processes
+# The lock could be held by a thread of the parent process, and requests in flight in the parent process do not exist in the child
+def reset_after_fork( ):
+    global CONDITION
+    CONDITION = threading.Condition()
+    POLICY[ "active" ] = 0
+
+if hasattr( os, "register_at_fork" ):
+    os.register_at_fork( after_in_child=reset_after_fork )
+
+# Configure the policy with the GDC settings in settings.yaml
+def configure( gdc_settings ):
+    with CONDITION:
+        POLICY.update( {
+            "timeout": float( gdc_settings.get( "timeout" ) or POLICY[ "timeout" ] ),
+            "backoff": float( gdc_settings.get( "backoff" ) or POLICY[ "backoff" ] ),
+            "backoff_max": float( gdc_settings.get( "backoff_max" ) or POLICY[ "backoff_max" ] ),
+            "max_rate": float( gdc_settings.get( "rate" ) or POLICY[ "max_rate" ] ),
+            "max_concurrency": int( gdc_settings.get( "concurrency" ) or POLICY[ "max_concurrency" ] )
+        } )
+        POLICY[ "burst" ] = max( POLICY[ "max_rate" ], 1.0 )
+        POLICY[ "rate" ] = POLICY[ "max_rate" ]
+        POLICY[ "concurrency" ] = POLICY[ "max_concurrency" ]
+        POLICY[ "tokens" ] = POLICY[ "burst" ]
+        POLICY[ "refilled" ] = time.monotonic()
+        POLICY.update( { "successes": 0, "paused_until": 0.0, "decreased": 0.0, "latencies": { } } )
+        CONDITION.notify_all()
+
+# Define the timeout of a request, it is the max time to connect and the max time between two received chunks
+def get_timeout( ):
+    return POLICY[ "timeout" ]
+
+# Refill the token bucket
+def refill( now ):
+    POLICY[ "tokens" ] = min( POLICY[ "burst" ], POLICY[ "tokens" ] + ( now - POLICY[ "refilled" ] ) * POLICY[ "rate" ] )
+    POLICY[ "refilled" ] = now
+
+# Wait for a token and a free slot before sending a request
+# Every acquire must be followed by a release once the response has been received
+def acquire( ):
+    with CONDITION:
+        while True:
+            now = time.monotonic()
+            refill( now )
+            if now < POLICY[ "paused_until" ]:
+                CONDITION.wait( POLICY[ "paused_until" ] - now )
+            elif POLICY[ "active" ] >= POLICY[ "concurrency" ]:
+                CONDITION.wait( )
+            elif POLICY[ "tokens" ] < 1.0:
+                CONDITION.wait( ( 1.0 - POLICY[ "tokens" ] ) / POLICY[ "rate" ] )
+            else:
+                POLICY[ "tokens" ] -= 1.0
+                POLICY[ "active" ] += 1
+                return
+
+# Define the latency of a request, it is the time GDC took to send the response headers
+# The time elapsed since "start" is used if no response has been received
+def get_latency( start, response=None ):
+    if response is not None and response.elapsed is not None:
+        return response.elapsed.total_seconds()
+    return time.monotonic() - start
+
+# Release the slot of a request and adapt rate and concurrency to its outcome
+# "latency" is the time GDC took to respond (see get_latency), "endpoint" is the name of the requested endpoint, 
+# "error" is the exception raised by the request if any
+def release( latency, endpoint=None, error=None ):
+    with CONDITION:
+        POLICY[ "active" ] -= 1
+        degraded = error is not None and is_degraded( error )
+        if error is None:
+            entry = POLICY[ "latencies" ].get( endpoint )
+            if entry is None:
+                entry = POLICY[ "latencies" ][ endpoint ] = { "latency": latency, "baseline": latency }
+            # Exponentially weighted moving average of the latency
+            entry[ "latency" ] = ( 1.0 - LATENCY_WEIGHT ) * entry[ "latency" ] + LATENCY_WEIGHT * latency
+            entry[ "baseline" ] = min( latency, entry[ "baseline" ] + BASELINE_DECAY * ( latency - entry[ "baseline" ] ) )
+            degraded = entry[ "latency" ] > max( 1.0, SLOW_FACTOR * entry[ "baseline" ] )
+        now = time.monotonic()
+        if degraded:
+            if now - POLICY[ "decreased" ] >= COOLDOWN:
+                refill( now )
+                POLICY[ "rate" ] = max( POLICY[ "rate" ] / 2.0, 0.1 )
+                POLICY[ "concurrency" ] = max( POLICY[ "concurrency" ] // 2, 1 )
+                POLICY[ "decreased" ] = now
+                metrics.count( "gdc.slowdowns" )
+        elif error is None:
+            refill( now )
+            POLICY[ "rate" ] = min( POLICY[ "rate" ] + POLICY[ "max_rate" ] / 20.0, POLICY[ "max_rate" ] )
+            # Concurrency grows by one every "concurrency" successful requests
+            POLICY[ "successes" ] += 1
+            if POLICY[ "successes" ] >= POLICY[ "concurrency" ]:
+                POLICY[ "successes" ] = 0
+                POLICY[ "concurrency" ] = min( POLICY[ "concurrency" ] + 1, POLICY[ "max_concurrency" ] )
+        # Honor Retry-After for all the requests
+        retry_after = get_retry_after( error )
+        if retry_after:
+            POLICY[ "paused_until" ] = max( POLICY[ "paused_until" ], now + retry_after )
+        CONDITION.notify_all()
+
+# Retrieve the status code of the response of a failed request
+def get_status( error ):
+    response = getattr( error, "response", None )
+    return response.status_code if response is not None else None
+
+# Check whether a failed request can be retried
+# Client errors are permanent, except for timeouts, throttling, and resumed transfers that cannot be resumed
+def is_retryable( error ):
+    status = get_status( error )
+    return status is None or status in RETRY_STATUS
+
+# Check whether a failed request means that GDC is degraded
+def is_degraded( error ):
+    status = get_status( error )
+    if status is None:
+        # Timeouts and connection errors, also raised by urllib3 while reading the raw stream of a response
+        return isinstance( error, ( requests.RequestException, urllib3.exceptions.HTTPError ) )
+    return status in THROTTLE_STATUS or status >= 500
+
+# Retrieve the number of seconds in the Retry-After header of the response of a failed request
+# The header can be a number of seconds or an HTTP date
+def get_retry_after( error ):
+    response = getattr( error, "response", None )
+    value = response.headers.get( "Retry-After" ) if response is not None else None
+    if not value:
+        return None
+    try:
+        seconds = float( value )
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime( value ).timestamp() - time.time()
+        except ( TypeError, ValueError, OverflowError ):
+            return None
+    return min( max( seconds, 0.0 ), MAX_RETRY_AFTER )
+
+# Define the delay before the next attempt of a failed request
+# Exponential backoff with full jitter, at least the delay in the Retry-After header
+def get_delay( attempt, error=None ):
+    delay = random.uniform( 0, min( POLICY[ "backoff_max" ], POLICY[ "backoff" ] * 2 ** ( attempt - 1 ) ) )
+    retry_after = get_retry_after( error )
+    if retry_after:
+        delay = max( delay, retry_after )
+    return delay
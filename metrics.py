@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+__author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
+__version__ = '0.01'
+__date__ = 'Oct 21, 2020'
+
+import os, sys, json, time, pstats, cProfile, resource, threading
+from contextlib import contextmanager
+
+# Lightweight instrumentation of a run
+# Timers accumulate the seconds spent in named code blocks and the number of times they have been entered
+# Counters accumulate quantities (e.g. rows and bytes), counters are named "<timer>.<unit>" to compute rates,
+# and "<cache>.hits" and "<cache>.misses" to compute cache hit ratios
+# Nothing is collected unless metrics are enabled
+METRICS = {
+    "enabled": False,
+    "pid": None,
+    "timers": { },
+    "counters": { },
+    "profile": None,
+    "profiler": None
+}
+
+# Metrics are updated by download threads too
+LOCK = threading.Lock()
+
+# Enable the collection of metrics in the current process
+# Forked processes inherit the collection status
+# If "profile" is the name of a timer, the code blocks measured by that timer are also profiled with cProfile
+# The code blocks running in the main thread of the current process are profiled only
+def enable( profile=None ):
+    METRICS.update( {
+        "enabled": True,
+        "pid": os.getpid(),
+        "profile": profile,
+        "profiler": cProfile.Profile() if profile else None
+    } )
+
+# Check whether metrics are collected
+def enabled( ):
+    return METRICS[ "enabled" ]
+
+# Discard the collected metrics, the collection status is not changed
+def reset( ):
+    with LOCK:
+        METRICS[ "timers" ] = { }
+        METRICS[ "counters" ] = { }
+
+# Add time to a timer
+def add_time( name, seconds, calls=1 ):
+    if not METRICS[ "enabled" ]:
+        return
+    with LOCK:
+        entry = METRICS[ "timers" ].setdefault( name, { "seconds": 0.0, "calls": 0 } )
+        entry[ "seconds" ] += seconds
+        entry[ "calls" ] += calls
+
+# Retrieve the seconds accumulated by a timer
+def get_time( name ):
+    return METRICS[ "timers" ].get( name, { } ).get( "seconds", 0.0 )
+
+# Add a quantity to a counter
+def count( name, value=1 ):
+    if not METRICS[ "enabled" ]:
+        return
+    with LOCK:
+        METRICS[ "counters" ][ name ] = METRICS[ "counters" ].get( name, 0 ) + value
+
+# Check whether the current code block must be profiled
+def is_profiled( name ):
+    return ( name == METRICS[ "profile" ] and os.getpid() == METRICS[ "pid" ] and
+             threading.current_thread() is threading.main_thread() )
+
+# Measure the time spent in a code block
+# The time spent in the code blocks measured by the "exclude" timer in the meanwhile is not counted
+# (e.g. the time spent producing the rows that are consumed by the code block)
+@contextmanager
+def timer( name, exclude=None ):
+    if not METRICS[ "enabled" ]:
+        yield
+        return
+    profiler = METRICS[ "profiler" ] if is_profiled( name ) else None
+    excluded = get_time( exclude ) if exclude else 0.0
+    if profiler is not None:
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+        if exclude:
+            seconds -= get_time( exclude ) - excluded
+        add_time( name, seconds )
+
+# Measure the time spent producing the items of an iterable, and count them as "<name>.rows"
+# The iterable is returned as it is if metrics are not enabled
+# If "name" is the profiled timer, the code producing the items is profiled only
+def timed_iter( name, iterable ):
+    if not METRICS[ "enabled" ]:
+        return iterable
+    def iterate( ):
+        profiler = METRICS[ "profiler" ] if is_profiled( name ) else None
+        seconds = 0.0
+        rows = 0
+        iterator = iter( iterable )
+        try:
+            while True:
+                if profiler is not None:
+                    profiler.enable()
+                start = time.perf_counter()
+                try:
+                    item = next( iterator )
+                except StopIteration:
+                    break
+                finally:
+                    seconds += time.perf_counter() - start
+                    if profiler is not None:
+                        profiler.disable()
+                rows += 1
+                yield item
+        finally:
+            add_time( name, seconds )
+            count( '{}.rows'.format( name ), rows )
+    return iterate( )
+
+# Retrieve the metrics collected in the current process and reset them
+# This is used to send the metrics collected by worker processes back to the main process
+def pop( ):
+    with LOCK:
+        collected = { "timers": METRICS[ "timers" ], "counters": METRICS[ "counters" ] }
+        METRICS[ "timers" ] = { }
+        METRICS[ "counters" ] = { }
+    return collected
+
+# Merge the metrics collected by another process
+# Timers of worker processes are summed, so they can exceed the elapsed time of the run
+def merge( collected ):
+    if not METRICS[ "enabled" ] or not collected:
+        return
+    for name, entry in collected[ "timers" ].items():
+        add_time( name, entry[ "seconds" ], calls=entry[ "calls" ] )
+    for name, value in collected[ "counters" ].items():
+        count( name, value )
+
+# Reset the peak resident set size of the current process
+# This is supported on Linux only, the peak of the process is reported otherwise
+def reset_peak_rss( ):
+    try:
+        with open( "/proc/self/clear_refs", "w" ) as clear_refs:
+            clear_refs.write( "5" )
+        return True
+    except OSError:
+        return False
+
+# Retrieve the peak resident set size of the current process, or of its largest terminated child process, in MB
+def get_peak_rss( children=False ):
+    if not children:
+        try:
+            with open( "/proc/self/status" ) as status:
+                for line in status:
+                    if line.startswith( "VmHWM:" ):
+                        return int( line.split()[ 1 ] ) / 1024.0
+        except OSError:
+            pass
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    peak = resource.getrusage( resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF ).ru_maxrss
+    return peak / 1048576.0 if sys.platform == "darwin" else peak / 1024.0
+
+# Define the report of a run with the collected metrics and the rates derived from them
+#   - "<timer>.<unit>_per_second" for every counter "<timer>.<unit>" (e.g. "convert_rows.rows_per_second")
+#   - "<cache>.hit_ratio" for every couple of counters "<cache>.hits" and "<cache>.misses"
+def get_report( elapsed=None, extra=None ):
+    with LOCK:
+        timers = { name: dict( entry ) for name, entry in METRICS[ "timers" ].items() }
+        counters = dict( METRICS[ "counters" ] )
+    rates = { }
+    ratios = { }
+    for name, value in counters.items():
+        prefix, unit = name.rsplit( ".", 1 ) if "." in name else ( name, None )
+        if prefix in timers and timers[ prefix ][ "seconds" ] > 0:
+            rates[ '{}_per_second'.format( name ) ] = round( value / timers[ prefix ][ "seconds" ], 3 )
+        if unit == "hits":
+            lookups = value + counters.get( '{}.misses'.format( prefix ), 0 )
+            ratios[ '{}.hit_ratio'.format( prefix ) ] = round( value / lookups, 4 ) if lookups else None
+    for entry in timers.values():
+        entry[ "seconds" ] = round( entry[ "seconds" ], 4 )
+    report = {
+        "elapsed_seconds": round( elapsed, 3 ) if elapsed is not None else None,
+        "peak_rss_mb": round( get_peak_rss( ), 1 ),
+        "peak_rss_workers_mb": round( get_peak_rss( children=True ), 1 ),
+        "timers": timers,
+        "counters": counters,
+        "rates": rates,
+        "cache": ratios
+    }
+    if extra:
+        report.update( extra )
+    return report
+
+# Dump the report of a run to a JSON file
+def dump_report( report, report_filepath ):
+    report_dir = os.path.dirname( os.path.abspath( report_filepath ) )
+    if not os.path.exists( report_dir ):
+        os.makedirs( report_dir )
+    # Write to a temporary file first and move it in place once completed
+    with open( '{}.tmp'.format( report_filepath ), 'w' ) as tmp_report:
+        json.dump( report, tmp_report, indent=1, sort_keys=True )
+    os.replace( '{}.tmp'.format( report_filepath ), report_filepath )
+
+# Dump the profile of the profiled timer with cProfile statistics
+# Return the list of the functions with the highest cumulative time
+def dump_profile( profile_filepath, top=20 ):
+    profiler = METRICS[ "profiler" ]
+    if profiler is None:
+        return [ ]
+    profiler.dump_stats( profile_filepath )
+    try:
+        stats = pstats.Stats( profiler )
+    except TypeError:
+        # Nothing has been profiled
+        return [ ]
+    functions = sorted( stats.stats.items(), key=lambda item: item[ 1 ][ 3 ], reverse=True )[ :top ]
+    return [ { "function": '{}:{}({})'.format( *function ), "calls": calls, "cumulative_seconds": round( cumulative, 4 ) }
+             for function, ( _, calls, _, cumulative, _ ) in functions ]
@@ -4,7 +4,11 @@ __author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
 __version__ = '0.01'
 __date__ = 'Oct 21, 2020'
 
-import os, requests, utils, xmltodict
+import os, sys, requests, utils, metrics
+from xml.parsers import expat
+from concurrent.futures import ThreadPoolExecutor
+
+import writer.metadb as metadb
 
 # Define supported input file extensions
 def supported_ext( ):
@@ -14,6 +18,15 @@ def supported_ext( ):
 def dump_schema( convert_dir ):
     pass
 
+# Define the list of outputs produced by the conversion of a file
+# Clinical and Biospecimen Supplements are collected into .meta files at the end of the conversion
+def get_outputs( outfilepath, settings ):
+    return [ ]
+
+# Matrices are not supported for the Clinical and Biospecimen Supplements data type
+def export_matrix( filepaths, matrix_prefix, verbose=False ):
+    return False
+
 # Define the conversion procedure for the Clinical and Biospecimen Supplements data type
 def convert( datatype, filepath, outdir, settings, resources={ }, verbose=False ):
     datatype = None
@@ -28,79 +41,124 @@ def convert( datatype, filepath, outdir, settings, resources={ }, verbose=False
     file_uuid = os.path.basename( filepath ).split( '_' )[ 0 ]
     if verbose:
         print( "\tProcessing {}".format( file_uuid ) )
-    metadata = { }
-    # Load XML to dict
-    with open( filepath ) as xmlfile:
-        metadict = xmltodict.parse( xmlfile.read(), dict_constructor=dict )
-        if datatype == "clinical":
-            clinical = { "clinical__{}".format( "__".join( [ str(k) for k in keypath[:-1] ] ) ): value for ( keypath, value ) in keypaths( metadict ) }
-            # Search for patient_uuid
-            patient_uuid = "NA"
-            for key in clinical:
-                if key.lower().endswith( "bcr_patient_uuid" ):
-                    patient_uuid = clinical[ key ]
-                    break
-            # Use the "resources" channel to pass the results out
-            resources[ patient_uuid ] = clinical
-            return True, None, resources
-        elif datatype == "biospecimen":
-            biospecimen = { "__".join( [ str(k) for k in keypath ] ): value for ( keypath, value ) in keypaths( metadict )  }
-            samples = { }
-            for keypathstr in biospecimen:
-                keypath = keypathstr.split( "__" )
-                # Last element is always "#text"
-                if keypath[ -2 ].lower().endswith( "bcr_aliquot_uuid" ):
-                    aliquots = [ biospecimen[ keypathstr ] ]
-                    if keypath[ 4 ] in samples:
-                        aliquots = samples[ keypath[ 4 ] ] + aliquots
-                    samples[ keypath[ 4 ] ] = aliquots            
-            for sample_id in samples:
-                sample_type_id_pathstr = "__".join( [ 'bio:tcga_bcr', 'bio:patient', 'bio:samples', 
-                                                     'bio:sample', str(sample_id), 'bio:sample_type_id', '#text' ] )
-                tissue_status = None
-                if sample_type_id_pathstr in biospecimen:
-                    # Retrieve sample type id
-                    tissue_status = get_tissue_status( biospecimen[ sample_type_id_pathstr ] )
-
-                for aliquot_id in range( len( samples[ str(sample_id) ] ) ):
-                    data_map = { }
-                    aliquot_path = [ 'bio:tcga_bcr', 'bio:patient', 'bio:samples', 'bio:sample', str(sample_id), 
-                                     'bio:portions', 'bio:portion', 'bio:analytes', 'bio:analyte', str(aliquot_id), 
-                                     'bio:aliquots', 'bio:aliquot' ]
-                    for position in reversed( list( range( 1, len( aliquot_path ) + 1 ) ) ):
-                        path = aliquot_path[ : position ]
-                        for keypathstr in biospecimen:
-                            keypath = keypathstr.split( "__" )
-                            if ( len( set( keypath ).intersection( set( path ) ) ) == len( path ) and 
-                                    len( keypath ) == len( path ) + 2 ):
-                                data_map[ "biospecimen__{}".format( "__".join( keypath[:-1] ) ) ] = biospecimen[ keypathstr ]
-                    
-                    if tissue_status is None:
-                        # If sample type id not in biospecimen
-                        # Try to retrieve it from the aliquot barcode
-                        aliquot_barcode_pathstr = '__'.join( aliquot_path + [ "bio:bcr_aliquot_barcode", "#text" ] )
-                        sample_type_id = biospecimen[ aliquot_barcode_pathstr ].split( "-" )[ 3 ][:2]
-                        tissue_status = get_tissue_status( sample_type_id )
-                    data_map[ "biospecimen__tissue_status" ] = tissue_status
-                    resources[ samples[ str(sample_id) ][ aliquot_id ].lower() ] = data_map
-
-            return True, None, resources
+    # Stream the XML file into flattened <key path, value> pairs
+    metrics.count( "parse_xml.bytes", os.path.getsize( filepath ) )
+    if datatype == "clinical":
+        with metrics.timer( "parse_xml" ):
+            clinical = dict( keypaths( filepath, prefix="clinical__" ) )
+        # Search for patient_uuid
+        patient_uuid = "NA"
+        for key in clinical:
+            if key.lower().endswith( "bcr_patient_uuid" ):
+                patient_uuid = clinical[ key ]
+                break
+        # Use the "resources" channel to pass the results out
+        resources[ patient_uuid ] = clinical
+        return True, None, resources
+    elif datatype == "biospecimen":
+        with metrics.timer( "parse_xml" ):
+            biospecimen = dict( keypaths( filepath, suffix="__#text" ) )
+        # Index key paths by the path of their parent element
+        # The inherited fields of an aliquot are collected by walking its path once
+        children = index_keypaths( biospecimen )
+        for keypathstr in biospecimen:
+            # Last element is always "#text"
+            aliquot_path, field, _ = keypathstr.rsplit( "__", 2 )
+            if not field.lower().endswith( "bcr_aliquot_uuid" ):
+                continue
+            data_map = { }
+            sample_type_id = None
+            path = None
+            for element in aliquot_path.split( "__" ):
+                path = element if path is None else '{}__{}'.format( path, element )
+                for child, childpathstr in children.get( path, [ ] ):
+                    data_map[ "biospecimen__{}".format( childpathstr[ :-len( "__#text" ) ] ) ] = biospecimen[ childpathstr ]
+                    if child == "bio:sample_type_id":
+                        sample_type_id = biospecimen[ childpathstr ]
+            if sample_type_id is None:
+                # If sample type id not in biospecimen
+                # Try to retrieve it from the aliquot barcode
+                aliquot_barcode_pathstr = '{}__bio:bcr_aliquot_barcode__#text'.format( aliquot_path )
+                sample_type_id = biospecimen[ aliquot_barcode_pathstr ].split( "-" )[ 3 ][:2]
+            data_map[ "biospecimen__tissue_status" ] = get_tissue_status( sample_type_id )
+            resources[ biospecimen[ keypathstr ].lower() ] = data_map
+
+        return True, None, resources
     return False, None, resources
 
-# Get mapping <key path, value>
-def keypaths( nested ):
-    for key, value in nested.items():
-        if isinstance( value, dict ):
-            for subkey, subvalue in keypaths( value ):
-                yield [key] + subkey, subvalue
-        elif isinstance( value, list ):
-            for position in range( len( value ) ):
-                tmpkey = [key] + [position]
-                for subkey, subvalue in keypaths( value[ position ] ):
-                    yield tmpkey + subkey, subvalue
+# Index the flattened key paths of the text of the elements by the path of their parent element
+# Return a dict <parent path, list of (element name, key path)>
+def index_keypaths( flattened ):
+    children = { }
+    for keypathstr in flattened:
+        if keypathstr.count( "__" ) >= 2:
+            parent_path, child, _ = keypathstr.rsplit( "__", 2 )
+            children.setdefault( parent_path, [ ] ).append( ( child, keypathstr ) )
+    return children
+
+# Get mapping <key path, value> by streaming an XML file
+# Key paths are the names of the nested elements separated by "__", with the position of the element among its 
+# siblings with the same name if there are more than one, e.g. bio:tcga_bcr__bio:patient__bio:samples__bio:sample__0
+# Values are the stripped texts of the elements with attributes or children, other elements are skipped as in xmltodict
+# Pairs are yielded in document order, key paths are interned since they are repeated across files
+def keypaths( filepath, prefix="", suffix="" ):
+    # Elements on the current path: [ node, sibling counts by name, text, attributes or children flag ]
+    # A node is ( parent node, name, position, sibling counts of the parent ) and it is resolved into a key path
+    # once the whole file is parsed, because positions are needed only if there are more siblings with the same name
+    stack = [ [ None, { }, None, True ] ]
+    pairs = [ ]
+
+    def start_element( name, attributes ):
+        parent = stack[ -1 ]
+        parent[ 3 ] = True
+        if parent[ 1 ] is None:
+            parent[ 1 ] = { }
+        position = parent[ 1 ].get( name, 0 )
+        parent[ 1 ][ name ] = position + 1
+        stack.append( [ ( parent[ 0 ], name, position, parent[ 1 ] ), None, None, len( attributes ) > 0 ] )
+
+    def end_element( name ):
+        node, _, text, has_items = stack.pop()
+        if has_items and text:
+            text = text.strip()
+            if text:
+                pairs.append( ( node, text ) )
+
+    def characters( data ):
+        element = stack[ -1 ]
+        element[ 2 ] = data if element[ 2 ] is None else element[ 2 ] + data
+
+    def forbid_entities( *args ):
+        raise ValueError( "Entities are disabled" )
+
+    parser = expat.ParserCreate()
+    parser.ordered_attributes = True
+    parser.buffer_text = True
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = characters
+    parser.EntityDeclHandler = forbid_entities
+    with open( filepath, 'rb' ) as xmlfile:
+        parser.ParseFile( xmlfile )
+
+    # Resolve nodes into key paths
+    # Paths of the parent nodes are resolved once
+    resolved = { }
+    def resolve( node ):
+        parent, name, position, siblings = node
+        if parent is None:
+            path = name
         else:
-            if key == "#text":
-                yield [key], value
+            parent_path = resolved.get( id( parent ) )
+            if parent_path is None:
+                parent_path = resolve( parent )
+                resolved[ id( parent ) ] = parent_path
+            path = '{}__{}'.format( parent_path, name )
+        if siblings[ name ] > 1:
+            path = '{}__{}'.format( path, position )
+        return path
+    for node, text in pairs:
+        yield sys.intern( '{}{}{}'.format( prefix, resolve( node ), suffix ) ), text
 
 def get_tissue_status( sample_type_id ):
     sample_type_id = int( sample_type_id )
@@ -113,15 +171,45 @@ def get_tissue_status( sample_type_id ):
     else:
         return "undefined"
 
-def build_metadata( outdir, clinical, biospecimen, verbose=False ):
-    for aliquot_uuid in biospecimen:
-        if verbose:
-            print( "\tBuilding {}".format( aliquot_uuid ) )
-        with open( os.path.join( outdir, "{}.meta".format( aliquot_uuid ) ), 'w+' ) as meta:
-            for key in sorted( biospecimen[ aliquot_uuid ] ):
-                meta.write( "{}\t{}\n".format( key, biospecimen[ aliquot_uuid ][ key ] ) )
-            patient_uuid = biospecimen[ aliquot_uuid][ "biospecimen__{}".format( 
-                                '__'.join( [ 'bio:tcga_bcr', 'bio:patient', 'shared:bcr_patient_uuid' ] ) ) ]
-            if patient_uuid in clinical:
-                for key in sorted( clinical[ patient_uuid ] ):
-                    meta.write( "{}\t{}\n".format( key, clinical[ patient_uuid ][ key ] ) )
+# Retrieve the patient uuid of an aliquot from its biospecimen data
+def get_patient_uuid( aliquot_data ):
+    return aliquot_data[ "biospecimen__{}".format( '__'.join( [ 'bio:tcga_bcr', 'bio:patient', 'shared:bcr_patient_uuid' ] ) ) ]
+
+# Dump the .meta file of an aliquot with its biospecimen and clinical data
+# Lines are buffered and written at once, to a temporary file first and moved in place once completed
+def dump_metadata( metadata_filepath, aliquot_data, clinical ):
+    lines = [ "{}\t{}\n".format( key, aliquot_data[ key ] ) for key in sorted( aliquot_data ) ]
+    patient_uuid = get_patient_uuid( aliquot_data )
+    if patient_uuid in clinical:
+        lines.extend( [ "{}\t{}\n".format( key, clinical[ patient_uuid ][ key ] ) for key in sorted( clinical[ patient_uuid ] ) ] )
+    tmp_metadata_filepath = '{}.tmp'.format( metadata_filepath )
+    with open( tmp_metadata_filepath, 'w' ) as meta:
+        meta.write( ''.join( lines ) )
+    os.replace( tmp_metadata_filepath, metadata_filepath )
+
+# Build a .meta file for each aliquot and return the list of .meta file paths
+# Files are written by "workers" threads, since writing many small files is mostly bound to I/O
+# If "database" is enabled, metadata are also collected into a SQLite database in the same pass (see writer/metadb.py)
+# and its path is returned with the .meta file paths
+def build_metadata( outdir, clinical, biospecimen, workers=1, database=False, verbose=False ):
+    metadata_filepaths = [ ]
+    db = metadb.create_db( metadb.get_db_filepath( outdir ) ) if database else None
+    with ThreadPoolExecutor( max_workers=max( workers, 1 ) ) as executor:
+        futures = [ ]
+        for aliquot_uuid in biospecimen:
+            if verbose:
+                print( "\tBuilding {}".format( aliquot_uuid ) )
+            metadata_filepath = os.path.join( outdir, "{}.meta".format( aliquot_uuid ) )
+            metadata_filepaths.append( metadata_filepath )
+            futures.append( executor.submit( dump_metadata, metadata_filepath, biospecimen[ aliquot_uuid ], clinical ) )
+            if db is not None:
+                metadb.add_aliquot( db, aliquot_uuid, get_patient_uuid( biospecimen[ aliquot_uuid ] ), biospecimen[ aliquot_uuid ] )
+        if db is not None:
+            for patient_uuid in clinical:
+                metadb.add_patient( db, patient_uuid, clinical[ patient_uuid ] )
+            metadb.close_db( db )
+            metadata_filepaths.append( db[ "filepath" ] )
+        for future in futures:
+            # Raise errors occurred while writing
+            future.result()
+    return metadata_filepaths
@@ -4,15 +4,53 @@ __author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
 __version__ = '0.01'
 __date__ = 'Oct 21, 2020'
 
-import os, requests, utils
+import os, time, pickle, itertools, requests, utils, metrics
+import numpy as np
+import writer.bed as bed
+import writer.matrix as matrix
+import writer.columnar as columnar
+import writer.bgzf as bgzf
 import driver.gencode as gencode
 import driver.ncbi as ncbi
 import driver.hgnc as hgnc
 
+# Columns of the Methylation Beta Value files
+COLUMNS = [ "composite_element_ref", "beta_value", "chromosome", "start", "end", "gene_symbols", "gene_types",
+            "transcript_ids", "positions_to_tss", "cgi_coordinate", "feature_type" ]
+
+# Position of the columns in the tables of strings read from the Methylation Beta Value files
+COLUMN = { column: index for index, column in enumerate( COLUMNS ) }
+
+# Vectorized string functions on tables of strings
+STRIP = np.frompyfunc( str.strip, 1, 1 )
+LOWER = np.frompyfunc( str.lower, 1, 1 )
+
 # Define supported input file extensions
 def supported_ext( ):
     return [ "txt" ]
 
+# Fields of the converted files with their GMQL types
+FIELDS = [
+    ( "chrom", "STRING" ),
+    ( "start", "LONG" ),
+    ( "end", "LONG" ),
+    ( "strand", "CHAR" ),
+    ( "composite_element_ref", "STRING" ),
+    ( "beta_value", "DOUBLE" ),
+    ( "gene_symbol", "STRING" ),
+    ( "entrez_gene_id", "STRING" ),
+    ( "gene_type", "STRING" ),
+    ( "ensembl_transcript_id", "STRING" ),
+    ( "position_to_tss", "STRING" ),
+    ( "all_gene_symbols", "STRING" ),
+    ( "all_entrez_gene_ids", "STRING" ),
+    ( "all_gene_types", "STRING" ),
+    ( "all_ensembl_transcript_ids", "STRING" ),
+    ( "all_positions_to_tss", "STRING" ),
+    ( "cgi_coordinate", "STRING" ),
+    ( "feature_type", "STRING" )
+]
+
 # header.schema definition
 def dump_schema( convert_dir ):
     with open( os.path.join( convert_dir, 'header.schema' ), 'w+' ) as schema:
@@ -20,154 +58,238 @@ def dump_schema( convert_dir ):
             '<?xml version="1.0" encoding="UTF-8"?>\n'\
             '<gmqlSchemaCollection xmlns="http://genomic.elet.polimi.it/entities" name="GLOBAL_SCHEMAS">\n'\
                 '\t<gmqlSchema type="tab" coordinate_system="1-based">\n'\
-                    '\t\t<field type="STRING">chrom</field>\n'\
-		            '\t\t<field type="LONG">start</field>\n'\
-		            '\t\t<field type="LONG">end</field>\n'\
-		            '\t\t<field type="CHAR">strand</field>\n'\
-		            '\t\t<field type="STRING">composite_element_ref</field>\n'\
-                    '\t\t<field type="DOUBLE">beta_value</field>\n'\
-                    '\t\t<field type="STRING">gene_symbol</field>\n'\
-                    '\t\t<field type="STRING">entrez_gene_id</field>\n'\
-                    '\t\t<field type="STRING">gene_type</field>\n'\
-                    '\t\t<field type="STRING">ensembl_transcript_id</field>\n'\
-                    '\t\t<field type="STRING">position_to_tss</field>\n'\
-                    '\t\t<field type="STRING">all_gene_symbols</field>\n'\
-                    '\t\t<field type="STRING">all_entrez_gene_ids</field>\n'\
-                    '\t\t<field type="STRING">all_gene_types</field>\n'\
-                    '\t\t<field type="STRING">all_ensembl_transcript_ids</field>\n'\
-                    '\t\t<field type="STRING">all_positions_to_tss</field>\n'\
-                    '\t\t<field type="STRING">cgi_coordinate</field>\n'\
-                    '\t\t<field type="STRING">feature_type</field>\n'\
+                    '{}'\
                 '\t</gmqlSchema>\n'\
-            '</gmqlSchemaCollection>'
+            '</gmqlSchemaCollection>'.format( 
+                ''.join( [ '\t\t<field type="{}">{}</field>\n'.format( field_type, field ) for field, field_type in FIELDS ] ) )
         )
 
+# Export converted files to a probe x aliquot matrix of beta values
+# The matrix is dumped to <matrix_prefix>.npy and exported to <matrix_prefix>.tsv
+def export_matrix( filepaths, matrix_prefix, verbose=False ):
+    filepaths = sorted( str( filepath ) for filepath in filepaths if str( filepath ).endswith( ( "-mbv.bed", "-mbv.bed.gz" ) ) )
+    if not filepaths:
+        return False
+    aliquots = [ os.path.basename( filepath ).split( "-mbv.bed" )[ 0 ] for filepath in filepaths ]
+    # composite_element_ref and beta_value are the 5th and 6th fields of the converted files
+    beta_values, probes = matrix.build_matrix( filepaths, aliquots, matrix_prefix, 4, 5, verbose=verbose )
+    if verbose:
+        print( "\tExporting matrix to TSV" )
+    matrix.export_tsv( beta_values, probes, aliquots, matrix.get_matrix_filepaths( matrix_prefix )[ "tsv" ], 
+                       row_header="composite_element_ref" )
+    return True
+
+# Load the per-probe annotation cache from disk
+# The cache is discarded if it has been built with different external assets
+def load_probe_cache( cache_filepath, assets_signature ):
+    if cache_filepath and os.path.exists( cache_filepath ):
+        try:
+            with open( cache_filepath, 'rb' ) as cache:
+                signature, probes = pickle.load( cache )
+            if signature == assets_signature:
+                return probes
+        except ( OSError, EOFError, pickle.UnpicklingError, ValueError ):
+            # Ignore broken caches
+            pass
+    return { }
+
+# Dump the per-probe annotation cache to disk
+def dump_probe_cache( cache_filepath, assets_signature, probes ):
+    if cache_filepath:
+        cache_dir = os.path.dirname( cache_filepath )
+        if cache_dir and not os.path.exists( cache_dir ):
+            os.makedirs( cache_dir )
+        # Write to a temporary file first and move it in place once completed
+        tmp_cache_filepath = '{}.tmp'.format( cache_filepath )
+        with open( tmp_cache_filepath, 'wb' ) as cache:
+            pickle.dump( ( assets_signature, probes ), cache, protocol=pickle.HIGHEST_PROTOCOL )
+        os.replace( tmp_cache_filepath, cache_filepath )
+
+# Read a Methylation Beta Value file in chunks of "chunk_size" rows
+# Each chunk is a table of strings with one row per line and one column per field in COLUMNS, 
+# and it contains the rows that must be converted only
+# Rows without gene symbols are kept if "intergenic" is enabled
+def read_chunks( filepath, chunk_size=100000, intergenic=False ):
+    with open( filepath ) as gdc:
+        next( gdc ) # Skip header
+        while True:
+            lines = list( itertools.islice( gdc, chunk_size ) )
+            if not lines:
+                break
+            table = read_table( lines )
+            if len( table ) == 0:
+                continue
+            # Discard rows without chromosome, beta value, or gene symbols
+            mask = ( table[ :, COLUMN[ "chromosome" ] ] != "*" ) & ( LOWER( table[ :, COLUMN[ "beta_value" ] ] ) != "na" )
+            if not intergenic:
+                mask &= ~get_intergenic_mask( table )
+            yield table[ mask ]
+
+# Split lines into a table of strings
+# Lines are tokenized by the NumPy C parser, strings are kept as Python objects to avoid fixed-width copies
+def read_table( lines ):
+    try:
+        return np.loadtxt( lines, dtype=object, delimiter="\t", comments=None, usecols=range( len( COLUMNS ) ), ndmin=2 )
+    except ValueError:
+        # Rows with empty trailing fields can be shorter
+        rows = [ line.rstrip( "\r\n" ).split( "\t" ) for line in lines if line.strip() ]
+        rows = [ ( row + [ "" ] * ( len( COLUMNS ) - len( row ) ) )[ :len( COLUMNS ) ] for row in rows ]
+        table = np.empty( ( len( rows ), len( COLUMNS ) ), dtype=object )
+        table[ : ] = rows
+        return table
+
+# Define the mask of the rows without gene symbols in a table
+def get_intergenic_mask( table ):
+    gene_symbols = STRIP( table[ :, COLUMN[ "gene_symbols" ] ] )
+    return ( gene_symbols == "" ) | ( gene_symbols == "." )
+
+# Annotate the rows without gene symbols in a table with the nearest Gencode gene
+# Genes are retrieved with batched queries on the Gencode interval index, one per chromosome
+# The position to TSS is computed from the gene strand, gene types and transcripts are left empty
+# Rows on chromosomes without genes are discarded
+def annotate_nearest( table, interval_index ):
+    intergenic = get_intergenic_mask( table )
+    if not intergenic.any():
+        return table
+    annotated = ~intergenic
+    chromosomes = table[ :, COLUMN[ "chromosome" ] ]
+    for chromosome in np.unique( chromosomes[ intergenic ] ):
+        rows = np.nonzero( intergenic & ( chromosomes == chromosome ) )[ 0 ]
+        # Coordinates are parsed for the intergenic rows only
+        starts = table[ rows, COLUMN[ "start" ] ].astype( np.int64 )
+        genes, _ = gencode.query_nearest( interval_index, chromosome, starts, table[ rows, COLUMN[ "end" ] ].astype( np.int64 ) )
+        starts = starts[ genes >= 0 ]
+        rows = rows[ genes >= 0 ]
+        genes = genes[ genes >= 0 ]
+        if len( rows ) == 0:
+            continue
+        entry = interval_index[ chromosome ]
+        reverse = entry[ "strands" ][ genes ] == "-"
+        tss = np.where( reverse, entry[ "ends" ][ genes ], entry[ "starts" ][ genes ] )
+        positions_to_tss = ( starts - tss ) * np.where( reverse, -1, 1 )
+        table[ rows, COLUMN[ "gene_symbols" ] ] = entry[ "symbols" ][ genes ]
+        table[ rows, COLUMN[ "gene_types" ] ] = ""
+        table[ rows, COLUMN[ "transcript_ids" ] ] = ""
+        table[ rows, COLUMN[ "positions_to_tss" ] ] = positions_to_tss.astype( str )
+        annotated[ rows ] = True
+    return table[ annotated ]
+
 # Define the conversion procedure for the Methylation Beta Value data type
 def convert( datatype, filepath, outdir, settings, resources={ }, verbose=False ):
     # File uuid is prepended to the file name and it is separated from the original file name by an underscore
     file_uuid = os.path.basename( filepath ).split( '_' )[ 0 ]
     if verbose:
         print( "\tProcessing {}".format( file_uuid ) )
-    # Prepare a payload
-    # aliquot_id is the field that must be retrieved
-    fields = "cases.samples.portions.analytes.aliquots.aliquot_id"
-    # Define a filter with multiple conditions
-    # files.file_id = file_uuid                 # Search for a specific file with the specified file_uuid
-    # files.data_type = datatype                # Specify a data type
-    filters = {
-        "op":"and",
-        "content":[
-            {
-                "op":"=",
-                "content":{
-                    "field":"files.file_id",
-                    "value":file_uuid
-                }
-            },
-            {
-                "op":"=",
-                "content":{
-                    "field":"files.data_type",
-                    "value":datatype
-                }
-            }
-        ]
-    }
-    params = {
-        "filters": filters,
-        "fields": fields,
-        "format": "JSON",                               # Set a response output format
-        "size": str( settings[ "gdc" ][ "size" ] )      # Set the maximum amount of entries in the result
-    }
-    
-    # Submit a query to GDC to retrieve the aliquot uuid
-    query_response = utils.query( settings[ "gdc" ][ "searchurl" ], params,
-                                  repeat=settings[ "gdc" ][ "repeat" ] )
-    if not query_response:
+    # Retrieve aliquot_uuid from the files manifest
+    file_info = resources.get( "Files", { } ).get( file_uuid )
+    if file_info is None:
+        # Resolve files downloaded after loading resources
+        # The manifest is not updated, this can run in worker processes
+        file_info = utils.resolve_files( datatype, [ filepath ], settings, update_manifest=False ).get( file_uuid, { } )
+    aliquot_uuid = file_info.get( "aliquot_id" )
+    if aliquot_uuid is None:
         # Unable to retrieve aliquot_uuid
         return False, None, resources
     
-    # Retrieve aliquot_uuid
-    aliquot_uuid = query_response[ "data" ][ "hits" ][0][ "cases" ][0][ "samples" ][0][ "portions" ][0][ "analytes" ][0][ "aliquots" ][0][ "aliquot_id" ]
-    
-    # Take all the converted lines in memory
-    # Then sort them by chromosome and genomic coordinates
-    # Finally, dump them to the output file
-    dataMapChr = { }
+    # Converted lines are sorted by chromosome and genomic coordinates and dumped to the output file
+    # Lines are spilled to temporary files if they exceed the memory budget
+    # The same aliquot can be used for multiple experiments
+    # Add "-mbv" suffix to avoid conflicts
+    bed_filepath = os.path.join( outdir, '{}-mbv.bed'.format( aliquot_uuid ) )
+    compress = settings.get( "convert", { } ).get( "compress", False )
+    if compress:
+        # Block-compressed files are indexed by genomic region
+        bed_filepath = '{}.gz'.format( bed_filepath )
+    max_memory = settings.get( "convert", { } ).get( "memory", 256 ) * 1048576
+    metrics.count( "convert_rows.bytes", os.path.getsize( filepath ) )
+    # The time spent producing the rows is measured separately from the time spent sorting and writing them
+    rows = metrics.timed_iter( "convert_rows", convert_rows( filepath, settings, resources ) )
+    with metrics.timer( "write_bed", exclude="convert_rows" ):
+        written = bed.write_sorted( bed_filepath, rows, max_memory=max_memory, compress=compress )
+    if written > 0:
+        metrics.count( "write_bed.rows", written )
+        if settings.get( "convert", { } ).get( "columnar", False ):
+            # Also dump the converted file in columnar format
+            with metrics.timer( "write_columnar" ), bed.open_bed( bed_filepath ) as bedfile:
+                columnar.write_columnar( get_columnar_dirpath( bed_filepath ), FIELDS, 
+                                         ( line.rstrip( "\n" ).split( "\t" ) for line in bedfile ) )
+        return True, bed_filepath, resources
+    return False, None, resources
 
-    # Open the input file
-    with open( filepath ) as gdc:
-        next( gdc ) # Skip header
-        for line in gdc:
-            line = line.strip()
-            if line:
-                # Fields are separated by tabs
-                line_split = line.split( "\t" )
-                chromosome = line_split[ 2 ]
-                beta_value = line_split[ 1 ]
-                gene_symbols_comp = line_split[ 5 ]
-                if chromosome != "*" and beta_value.lower() != "na" and ( gene_symbols_comp.strip() != "" and gene_symbols_comp.strip() != "." ):
-                    start = line_split[ 3 ]
-                    end = line_split[ 4 ]
-                    composite_element_ref = line_split[ 0 ]
-                    gene_types_comp = line_split[ 6 ]
-                    transcript_ids_comp = line_split[ 7 ]
-                    positions_to_tss_comp = line_split[ 8 ]
-                    cgi_coordinate = line_split[ 9 ]
-                    feature_type = line_split[ 10 ]
-                    
-                    # Enxtend info by querying Gencode, NCBI, and HGNC
-                    fieldsmap, resources = extract_fields( chromosome, gene_symbols_comp, start, end, gene_types_comp,
-                                                           transcript_ids_comp, positions_to_tss_comp, settings, 
-                                                           resources=resources )
-                    strand = fieldsmap[ "strand" ]
-                    gene_symbol = fieldsmap[ "symbol" ]
-                    gene_type = fieldsmap[ "gene_type" ]
-                    transcript_id = fieldsmap[ "transcript_id" ]
-                    position_to_tss = fieldsmap[ "position_to_tss" ]
-                    entrez_id = fieldsmap[ "entrez" ]
-                    all_entrez_ids = fieldsmap[ "entrez_ids" ]
-                    all_gene_symbols = fieldsmap[ "gene_symbols" ]
-                    all_gene_types = fieldsmap[ "gene_types" ]
-                    all_transcript_ids = fieldsmap[ "transcript_ids" ]
-                    all_positions_to_tss = fieldsmap[ "positions_to_tss" ]
+# Define the path to the columnar version of a converted file
+def get_columnar_dirpath( bed_filepath ):
+    return '{}.columnar'.format( bed_filepath.split( "-mbv.bed" )[ 0 ] + "-mbv" )
 
-                    # Values in "values" list compose the output line
-                    values = [ chromosome, start, end, strand, composite_element_ref, 
-                               beta_value, gene_symbol, entrez_id, gene_type, transcript_id, 
-                               position_to_tss, all_gene_symbols, all_entrez_ids, all_gene_types,
-                               all_transcript_ids, all_positions_to_tss, cgi_coordinate, feature_type ]
+# Define the list of outputs produced by the conversion of a file
+def get_outputs( outfilepath, settings ):
+    outputs = [ outfilepath ]
+    if outfilepath.endswith( ".gz" ):
+        outputs.append( bgzf.get_index_filepath( outfilepath ) )
+    if settings.get( "convert", { } ).get( "columnar", False ):
+        outputs.append( get_columnar_dirpath( outfilepath ) )
+    return outputs
 
-                    # Build a nested dict with chromosome and start position as keys to sort lines by genomic coordinates
-                    chromosome_id = int( chromosome.replace( "chr", "" ).replace( "X", "23" ).replace( "Y", "24" ) )
-                    start_id = int( start )
-                    dataMapStart = { start_id: values }
-                    if chromosome_id in dataMapChr:
-                        dataMapStart = dataMapChr[ chromosome_id ]
-                        dataList = [ ]
-                        if start_id in dataMapStart:
-                            dataList = dataMapStart[ start_id ]
-                        dataList.append( values )
-                        dataMapStart[ start_id ] = dataList
-                    dataMapChr[ chromosome_id ] = dataMapStart
+# Convert the rows of a Methylation Beta Value file
+# Yield the list of values that compose an output line
+def convert_rows( filepath, settings, resources ):
+    # Per-probe annotation cache shared across files
+    if "Probes" not in resources:
+        resources[ "Probes" ] = { }
+    probes = resources[ "Probes" ]
 
+    # Rows without gene symbols are annotated with the nearest Gencode gene if enabled
+    nearest = settings.get( "convert", { } ).get( "nearest", False )
+    if nearest and "Intervals" not in resources:
+        resources[ "Intervals" ] = gencode.get_interval_index( settings[ "assets" ][ "gencode" ], "gene" )
 
-    if dataMapChr:
-        # The same aliquot can be used for multiple experiments
-        # Add "-mbv" suffix to avoid conflicts
-        bed_filepath = os.path.join( outdir, '{}-mbv.bed'.format( aliquot_uuid ) )
-        with open( bed_filepath, 'w+' ) as bed:
-            # Sort chromosomes
-            chromosomes = sorted( dataMapChr.keys() )
-            for chromosome in chromosomes:
-                # Sort start positions
-                start_positions = sorted( dataMapChr[ chromosome ].keys() )
-                for start in start_positions:
-                    # Finally dump the line out on the BED file
-                    for entry in dataMapChr[ chromosome ][ start ]:
-                        bed.write( '{}\n'.format( '\t'.join( [ str( value ) for value in entry ] ) ) )
-        return True, bed_filepath, resources
-    return False, None, resources
+    # Keep track of the probes annotation cache usage and of the time spent annotating new probes
+    hits = 0
+    misses = 0
+    extract_seconds = 0.0
+    # Read the input file in chunks
+    # Rows are filtered with vectorized masks and only the surviving rows are annotated
+    for chunk in read_chunks( filepath, intergenic=nearest ):
+        if nearest:
+            chunk = annotate_nearest( chunk, resources[ "Intervals" ] )
+        for ( composite_element_ref, beta_value, chromosome, start, end, gene_symbols_comp, gene_types_comp, 
+              transcript_ids_comp, positions_to_tss_comp, cgi_coordinate, feature_type ) in chunk.tolist():
+            # Annotations are the same for a given probe across all the samples of a platform
+            # Extend info by querying Gencode, NCBI, and HGNC once per probe
+            probe_key = ( composite_element_ref, chromosome, start, end, gene_symbols_comp, gene_types_comp,
+                          transcript_ids_comp, positions_to_tss_comp )
+            if probe_key in probes:
+                fieldsmap = probes[ probe_key ]
+                hits += 1
+            else:
+                extract_start = time.perf_counter()
+                fieldsmap, resources = extract_fields( chromosome, gene_symbols_comp, start, end, gene_types_comp,
+                                                       transcript_ids_comp, positions_to_tss_comp, settings, 
+                                                       resources=resources )
+                extract_seconds += time.perf_counter() - extract_start
+                misses += 1
+                probes[ probe_key ] = fieldsmap
+            strand = fieldsmap[ "strand" ]
+            gene_symbol = fieldsmap[ "symbol" ]
+            gene_type = fieldsmap[ "gene_type" ]
+            transcript_id = fieldsmap[ "transcript_id" ]
+            position_to_tss = fieldsmap[ "position_to_tss" ]
+            entrez_id = fieldsmap[ "entrez" ]
+            all_entrez_ids = fieldsmap[ "entrez_ids" ]
+            all_gene_symbols = fieldsmap[ "gene_symbols" ]
+            all_gene_types = fieldsmap[ "gene_types" ]
+            all_transcript_ids = fieldsmap[ "transcript_ids" ]
+            all_positions_to_tss = fieldsmap[ "positions_to_tss" ]
+
+            # Values in "values" list compose the output line
+            values = [ chromosome, start, end, strand, composite_element_ref, 
+                       beta_value, gene_symbol, entrez_id, gene_type, transcript_id, 
+                       position_to_tss, all_gene_symbols, all_entrez_ids, all_gene_types,
+                       all_transcript_ids, all_positions_to_tss, cgi_coordinate, feature_type ]
+            yield values
+    # Rows have been consumed
+    metrics.add_time( "extract_fields", extract_seconds, calls=misses )
+    metrics.count( "probes.hits", hits )
+    metrics.count( "probes.misses", misses )
 
 # Extract significant info and extend data by querying Gencode, NCBI, and HGNC
 def extract_fields( chromosome, gene_symbols_comp, start_site, end_site, gene_types_comp,
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+__author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
+__version__ = '0.01'
+__date__ = 'Oct 21, 2020'
+
+import os, sys, time, unittest, requests
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import gdcpolicy
+
+# Define a failed request with a response status code and headers
+def get_error( status, headers={ } ):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update( headers )
+    return requests.HTTPError( response=response )
+
+# State machine of the request policy (additive increase, multiplicative decrease)
+# Run with: python -m unittest discover tests
+class TestPolicy( unittest.TestCase ):
+    def setUp( self ):
+        self.cooldown = gdcpolicy.COOLDOWN
+        # Every degraded outcome is counted, unless a test checks the cooldown
+        gdcpolicy.COOLDOWN = 0.0
+        gdcpolicy.configure( { "rate": 100, "concurrency": 8, "backoff": 1, "backoff_max": 60 } )
+
+    def tearDown( self ):
+        gdcpolicy.COOLDOWN = self.cooldown
+        gdcpolicy.configure( { } )
+
+    # Take a slot and release it with the outcome of a request
+    # The token bucket is not used, requests would wait for tokens once the rate decreases
+    def request( self, latency, endpoint="query", error=None ):
+        gdcpolicy.POLICY[ "active" ] += 1
+        gdcpolicy.release( latency, endpoint=endpoint, error=error )
+
+    def test_throttling_halves_rate_and_concurrency( self ):
+        self.request( 0.1, error=get_error( 429 ) )
+        self.assertEqual( gdcpolicy.POLICY[ "rate" ], 50.0 )
+        self.assertEqual( gdcpolicy.POLICY[ "concurrency" ], 4 )
+        self.request( 0.1, error=get_error( 503 ) )
+        self.request( 0.1, error=requests.Timeout() )
+        self.assertEqual( gdcpolicy.POLICY[ "rate" ], 12.5 )
+        self.assertEqual( gdcpolicy.POLICY[ "concurrency" ], 1 )
+
+    def test_failures_within_cooldown_count_once( self ):
+        gdcpolicy.COOLDOWN = 60.0
+        for _ in range( 5 ):
+            self.request( 0.1, error=get_error( 500 ) )
+        self.assertEqual( gdcpolicy.POLICY[ "rate" ], 50.0 )
+        self.assertEqual( gdcpolicy.POLICY[ "concurrency" ], 4 )
+
+    def test_successes_increase_rate_and_concurrency( self ):
+        self.request( 0.1, error=get_error( 429 ) )
+        # The rate grows by 1/20 of the max rate per success, concurrency by one every "concurrency" successes
+        for _ in range( 4 ):
+            self.request( 0.1 )
+        self.assertAlmostEqual( gdcpolicy.POLICY[ "rate" ], 70.0 )
+        self.assertEqual( gdcpolicy.POLICY[ "concurrency" ], 5 )
+        for _ in range( 100 ):
+            self.request( 0.1 )
+        self.assertEqual( gdcpolicy.POLICY[ "rate" ], 100.0 )
+        self.assertEqual( gdcpolicy.POLICY[ "concurrency" ], 8 )
+
+    def test_client_errors_do_not_adapt( self ):
+        self.request( 0.1, error=get_error( 404 ) )
+        self.assertEqual( gdcpolicy.POLICY[ "rate" ], 100.0 )
+        self.assertEqual( gdcpolicy.POLICY[ "concurrency" ], 8 )
+        self.assertFalse( gdcpolicy.is_retryable( get_error( 404 ) ) )
+        self.assertTrue( gdcpolicy.is_retryable( get_error( 429 ) ) )
+        self.assertTrue( gdcpolicy.is_retryable( get_error( 502 ) ) )
+        self.assertTrue( gdcpolicy.is_retryable( requests.ConnectionError() ) )
+
+    def test_retry_after_pauses_requests( self ):
+        start = time.monotonic()
+        self.request( 0.1, error=get_error( 503, { "Retry-After": "30" } ) )
+        self.assertGreaterEqual( gdcpolicy.POLICY[ "paused_until" ], start + 30 )
+        self.assertGreaterEqual( gdcpolicy.get_delay( 1, get_error( 503, { "Retry-After": "30" } ) ), 30 )
+        self.assertLessEqual( gdcpolicy.get_delay( 1 ), 1 )
+
+    def test_endpoints_have_their_own_baseline( self ):
+        # Fast downloads do not make slower search pages look degraded
+        for _ in range( 50 ):
+            self.request( 0.05, endpoint="retrieve" )
+            self.request( 3.0, endpoint="query" )
+        self.assertEqual( gdcpolicy.POLICY[ "rate" ], 100.0 )
+        self.assertEqual( gdcpolicy.POLICY[ "concurrency" ], 8 )
+
+    def test_slow_endpoint_decreases_rate( self ):
+        for _ in range( 20 ):
+            self.request( 0.2 )
+        for _ in range( 10 ):
+            self.request( 3.0 )
+        self.assertLess( gdcpolicy.POLICY[ "rate" ], 100.0 )
+        self.assertLess( gdcpolicy.POLICY[ "concurrency" ], 8 )
+
+    def test_baseline_follows_sustained_latency( self ):
+        # A single unusually fast request does not keep a healthy endpoint degraded
+        self.request( 0.01 )
+        for _ in range( 1000 ):
+            self.request( 2.0 )
+        rate = gdcpolicy.POLICY[ "rate" ]
+        concurrency = gdcpolicy.POLICY[ "concurrency" ]
+        for _ in range( 200 ):
+            self.request( 2.0 )
+        self.assertGreaterEqual( gdcpolicy.POLICY[ "rate" ], rate )
+        self.assertGreaterEqual( gdcpolicy.POLICY[ "concurrency" ], concurrency )
+        self.assertEqual( gdcpolicy.POLICY[ "rate" ], 100.0 )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,10 @@ __author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
 __version__ = '0.01'
 __date__ = 'Oct 21, 2020'
 
-import os, requests
+import os, json, time, zlib, queue, itertools, shutil, hashlib, tarfile, tempfile, threading, requests, urllib3, metrics, gdccache, gdcpolicy
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 # Import supported GDC data parsers
 import parser.methylation as methylation
@@ -21,57 +24,414 @@ PARSERS = {
     'Clinical and Biospecimen Supplements': metadata
 }
 
+# Define a HTTP session with a pool of keep-alive connections
+# The same session is shared by concurrent transfers
+def get_session( pool_size=10 ):
+    session = requests.Session()
+    adapter = HTTPAdapter( pool_connections=pool_size, pool_maxsize=pool_size )
+    session.mount( 'http://', adapter )
+    session.mount( 'https://', adapter )
+    return session
+
 # Download data from the Genomic Data Commons
-# Try submitting the same request "repeat" times in case of bad response status
-def retrieve( url, locate, params, repeat=0 ):
+# Data are streamed in chunks to a "<locate>.part" file which is moved in place once completed
+# Interrupted transfers are resumed from the "<locate>.part" file with HTTP Range requests
+# Requests follow the shared request policy (see gdcpolicy.py)
+# Data are hashed while they are streamed, the file is not moved in place if its md5 checksum or size do not match 
+# "md5sum" and "file_size" (if specified), and it is downloaded again
+# Try submitting the same request "repeat" times in case of timeouts or server errors, waiting longer after every attempt
+def retrieve( url, locate, params, repeat=0, session=None, chunk_size=1048576, md5sum=None, file_size=None ):
+    partial_locate = '{}.part'.format( locate )
     recursion_count = 0
     while recursion_count <= repeat:
+        gdcpolicy.acquire()
+        start = time.monotonic()
+        latency = None
         try:
-            response = requests.get( url, headers={"Content-Type": "application/json"} )
-            response.raise_for_status()
-            with open( locate, 'wb' ) as file:
-                file.write( response.content )
+            headers = { "Content-Type": "application/json" }
+            offset = os.path.getsize( partial_locate ) if os.path.exists( partial_locate ) else 0
+            if offset > 0:
+                # Resume the transfer
+                headers[ "Range" ] = "bytes={}-".format( offset )
+            with metrics.timer( "retrieve" ), ( session or requests ).get( url, headers=headers, stream=True, 
+                                                                          timeout=gdcpolicy.get_timeout() ) as response:
+                latency = gdcpolicy.get_latency( start, response )
+                if response.status_code == 416:
+                    # The partial file cannot be resumed, start from scratch
+                    os.unlink( partial_locate )
+                response.raise_for_status()
+                # Overwrite the partial file if the Range request has been ignored
+                mode = 'ab' if offset > 0 and response.status_code == 206 else 'wb'
+                checksum = hashlib.md5()
+                size = offset if mode == 'ab' else 0
+                if md5sum and mode == 'ab':
+                    # The partial file is read once to resume the checksum of an interrupted transfer
+                    with open( partial_locate, 'rb' ) as partial:
+                        for chunk in iter( lambda: partial.read( chunk_size ), b'' ):
+                            checksum.update( chunk )
+                with open( partial_locate, mode ) as file:
+                    for chunk in response.iter_content( chunk_size=chunk_size ):
+                        file.write( chunk )
+                        checksum.update( chunk )
+                        size += len( chunk )
+                        metrics.count( "retrieve.bytes", len( chunk ) )
+                if not is_intact( checksum.hexdigest(), size, md5sum=md5sum, file_size=file_size ):
+                    # Corrupted or truncated data, start from scratch
+                    metrics.count( "checksum.mismatches" )
+                    os.unlink( partial_locate )
+                    raise ValueError( "Checksum mismatch for {}".format( locate ) )
+            gdcpolicy.release( latency, endpoint="retrieve" )
+            os.replace( partial_locate, locate )
+            return True
+        except ( requests.RequestException, ValueError, OSError ) as e:
+            gdcpolicy.release( latency if latency is not None else gdcpolicy.get_latency( start ), endpoint="retrieve", error=e )
+            if not gdcpolicy.is_retryable( e ):
+                # Client errors are permanent
+                break
+            # Repeat
+            recursion_count += 1
+            if recursion_count <= repeat:
+                metrics.count( "retrieve.retries" )
+                time.sleep( gdcpolicy.get_delay( recursion_count, e ) )
+    return False
+
+# Download a batch of files from the Genomic Data Commons with a single request
+# File uuids are posted to the GDC "data" endpoint, which responds with a tar.gz archive of <file uuid>/<file name> files
+# The archive is extracted while it is streamed, every file is written to a "<locate>.part" file which is moved in place once completed
+# "locates" is a dict <file uuid, path to the downloaded file>
+# "checksums" is a dict <file uuid, ( md5sum, file_size )>, files are hashed while they are extracted and they are discarded 
+# if their md5 checksum or size do not match
+# Files extracted before a failure are not requested again by the next attempts
+# Return the list of uuids of the files that have not been downloaded or that have been discarded
+def retrieve_bulk( url, locates, repeat=0, session=None, chunk_size=1048576, checksums={ } ):
+    pending = dict( locates )
+    # Archive members are named <file uuid>/<file name>, locates are named <file uuid>_<file name>
+    members = { '{}/{}'.format( file_uuid, os.path.basename( locate )[ len( file_uuid ) + 1: ] ): file_uuid 
+                    for file_uuid, locate in pending.items() }
+    recursion_count = 0
+    while pending and recursion_count <= repeat:
+        gdcpolicy.acquire()
+        start = time.monotonic()
+        latency = None
+        try:
+            with metrics.timer( "retrieve" ), ( session or requests ).post( url, headers={ "Content-Type": "application/json" }, 
+                                                                           json={ "ids": sorted( pending ) }, stream=True, 
+                                                                           timeout=gdcpolicy.get_timeout() ) as response:
+                latency = gdcpolicy.get_latency( start, response )
+                response.raise_for_status()
+                with tarfile.open( fileobj=response.raw, mode='r|gz' ) as archive:
+                    for member in archive:
+                        file_uuid = members.get( member.name )
+                        if not member.isfile() or file_uuid not in pending:
+                            # Skip the MANIFEST.txt of the archive and any other file of the requested folders
+                            continue
+                        partial_locate = '{}.part'.format( pending[ file_uuid ] )
+                        checksum = hashlib.md5()
+                        size = 0
+                        with archive.extractfile( member ) as data, open( partial_locate, 'wb' ) as file:
+                            for chunk in iter( lambda: data.read( chunk_size ), b'' ):
+                                file.write( chunk )
+                                checksum.update( chunk )
+                                size += len( chunk )
+                                metrics.count( "retrieve.bytes", len( chunk ) )
+                        md5sum, file_size = checksums.get( file_uuid, ( None, None ) )
+                        if not is_intact( checksum.hexdigest(), size, md5sum=md5sum, file_size=file_size ):
+                            # Corrupted file, it is left pending
+                            metrics.count( "checksum.mismatches" )
+                            os.unlink( partial_locate )
+                            continue
+                        os.replace( partial_locate, pending.pop( file_uuid ) )
+            gdcpolicy.release( latency, endpoint="retrieve_bulk" )
             break
-        except:
-            # Remove empty file in case of bad response status
-            if os.path.exists( locate ):
-                os.unlink( locate )
+        except ( requests.RequestException, urllib3.exceptions.HTTPError, tarfile.TarError, EOFError, zlib.error, OSError ) as e:
+            # The archive is read from the raw stream, transfer errors are raised by urllib3
+            gdcpolicy.release( latency if latency is not None else gdcpolicy.get_latency( start ), endpoint="retrieve_bulk", error=e )
+            if not gdcpolicy.is_retryable( e ):
+                # Client errors are permanent
+                break
             # Repeat
             recursion_count += 1
+            if recursion_count <= repeat:
+                metrics.count( "retrieve.retries" )
+                time.sleep( gdcpolicy.get_delay( recursion_count, e ) )
+    return sorted( pending )
+
+# Check whether downloaded data match the md5 checksum and size reported by GDC, if any
+def is_intact( digest, size, md5sum=None, file_size=None ):
+    return ( not md5sum or digest == md5sum ) and ( file_size is None or size == int( file_size ) )
+
+# Compute the md5 checksum of a file
+def get_md5sum( filepath, chunk_size=1048576 ):
+    checksum = hashlib.md5()
+    with open( filepath, 'rb' ) as file:
+        for chunk in iter( lambda: file.read( chunk_size ), b'' ):
+            checksum.update( chunk )
+    return checksum.hexdigest()
+
+# Name of the list of verified files located in the download directory
+VERIFIED = "verified.tsv"
+
+# Verified files are appended by concurrent downloads
+VERIFIED_LOCK = threading.Lock()
+
+# Load the list of verified files from the download directory as a dict <file uuid, ( md5sum, size, mtime )>
+# The last record of a file wins
+def load_verified( download_dir ):
+    verified = { }
+    verified_filepath = os.path.join( download_dir, VERIFIED )
+    if os.path.exists( verified_filepath ):
+        with open( verified_filepath ) as verified_files:
+            for line in verified_files:
+                line_split = line.rstrip( "\n" ).split( "\t" )
+                if len( line_split ) == 4:
+                    verified[ line_split[ 0 ] ] = ( line_split[ 1 ], int( line_split[ 2 ] ), int( line_split[ 3 ] ) )
+    return verified
+
+# Keep track of a file whose checksum has been verified
+# Size and modification time of the file are recorded to detect changes without hashing the file again
+def record_verified( download_dir, file_uuid, filepath, md5sum ):
+    stat = os.stat( filepath )
+    with VERIFIED_LOCK, open( os.path.join( download_dir, VERIFIED ), 'a' ) as verified_files:
+        verified_files.write( '{}\t{}\t{}\t{}\n'.format( file_uuid, md5sum, stat.st_size, stat.st_mtime_ns ) )
+
+# Check whether a file has been verified against a checksum and it has not changed since then
+def is_verified( verified, file_uuid, filepath, md5sum ):
+    if file_uuid not in verified or verified[ file_uuid ][ 0 ] != md5sum:
+        return False
+    try:
+        stat = os.stat( filepath )
+    except OSError:
+        return False
+    return verified[ file_uuid ][ 1: ] == ( stat.st_size, stat.st_mtime_ns )
 
 # Make a query to the Genomic Data Commons and format the response as JSON
-# Try submitting the same request "repeat" times in case of bad response status
-def query( url, params, repeat=0 ):
+# Try submitting the same request "repeat" times in case of timeouts or server errors
+# Responses are served from and stored to "cache" if specified (see gdccache.py)
+def query( url, params, repeat=0, cache=None ):
+    cached_response = gdccache.lookup( cache, url, params )
+    if cached_response is not None:
+        metrics.count( "query_cache.hits" )
+        gdccache.record( cache, url, params, cached_response )
+        return cached_response
+    metrics.count( "query_cache.misses" )
+    if gdccache.is_offline( cache ):
+        # The response is not available without querying GDC
+        return { }
     # Make a query to the 'files' endpoint with payload
+    # Requests follow the shared request policy (see gdcpolicy.py)
     recursion_count = 0
     query_response = { }
     while recursion_count <= repeat:
+        gdcpolicy.acquire()
+        start = time.monotonic()
+        latency = None
         try:
-            response = requests.post( url, headers={"Content-Type": "application/json"}, json=params )
-            response.raise_for_status()
-            query_response = response.json()
+            with metrics.timer( "query" ):
+                response = requests.post( url, headers={"Content-Type": "application/json"}, json=params, 
+                                          timeout=gdcpolicy.get_timeout() )
+                # Latencies are measured until the response headers are received for all the endpoints
+                latency = gdcpolicy.get_latency( start, response )
+                response.raise_for_status()
+                query_response = response.json()
+            gdcpolicy.release( latency, endpoint="query" )
+            metrics.count( "query.bytes", len( response.content ) )
             break
-        except:
+        except ( requests.RequestException, ValueError ) as e:
+            gdcpolicy.release( latency if latency is not None else gdcpolicy.get_latency( start ), endpoint="query", error=e )
+            if not gdcpolicy.is_retryable( e ):
+                # Client errors are permanent
+                break
             # Repeat
             recursion_count += 1
+            if recursion_count <= repeat:
+                metrics.count( "query.retries" )
+                time.sleep( gdcpolicy.get_delay( recursion_count, e ) )
+    if query_response:
+        gdccache.store( cache, url, params, query_response )
     return query_response
 
+# Search for data on the Genomic Data Commons
+# Make queries to the GDC "files" endpoint requesting "page_size" hits at a time
+# Pages of hits are yielded as soon as they are retrieved
+# The total number of hits from the pagination metadata is used to check that no hits have been dropped
+# A RuntimeError is raised after the last retrieved page if the search results are incomplete
+def search_pages( url, params, page_size, repeat=0, cache=None, verbose=False ):
+    page_params = dict( params )
+    page_params[ "size" ] = str( page_size )
+    retrieved = 0
+    total = None
+    reason = "unable to query GDC"
+    while total is None or retrieved < total:
+        page_params[ "from" ] = str( retrieved )
+        query_response = query( url, page_params, repeat=repeat, cache=cache )
+        if not query_response:
+            # Unable to query GDC, or the page is not cached in offline mode
+            if gdccache.is_offline( cache ):
+                reason = "page not available in the offline cache"
+            break
+        hits = query_response[ "data" ][ "hits" ]
+        total = query_response[ "data" ][ "pagination" ][ "total" ]
+        if verbose:
+            print( "\tRetrieved {}/{} hits".format( retrieved + len( hits ), total ) )
+        if not hits:
+            reason = "empty page"
+            break
+        yield hits
+        retrieved += len( hits )
+    if total is None or retrieved < total:
+        # Hits are never dropped silently, the search fails once the retrieved pages have been consumed
+        metrics.count( "search.incomplete" )
+        if total is not None:
+            metrics.count( "search.missing_hits", total - retrieved )
+        message = "Unable to retrieve all the search results from GDC ({}/{} hits, {})".format( retrieved, 
+                                                                                                "?" if total is None else total, 
+                                                                                                reason )
+        print( message )
+        raise RuntimeError( message )
+
+# Search for data on the Genomic Data Commons
+# Hits are yielded one by one as soon as their page is retrieved
+def search( url, params, page_size, repeat=0, cache=None, verbose=False ):
+    for hits in search_pages( url, params, page_size, repeat=repeat, cache=cache, verbose=verbose ):
+        for hit in hits:
+            yield hit
+
+# Define the list of attributes that must be retrieved for every file
+FILE_FIELDS = [
+    "file_name",
+    "file_id",
+    "data_type",
+    "file_size",
+    "md5sum",
+    "cases.case_id",
+    "cases.samples.sample_id",
+    "cases.samples.portions.analytes.aliquots.aliquot_id"
+]
+
+# Name of the manifest with the files info located in the download directory
+MANIFEST = "manifest.json"
+
+# Flatten the info about a file retrieved from the GDC "files" endpoint
+# Consider the first case, sample, and aliquot only
+def get_file_info( hit ):
+    info = {
+        "file_name": hit.get( "file_name" ),
+        "data_type": hit.get( "data_type" ),
+        "case_id": None,
+        "sample_id": None,
+        "aliquot_id": None
+    }
+    try:
+        case = hit[ "cases" ][ 0 ]
+        info[ "case_id" ] = case.get( "case_id" )
+        sample = case[ "samples" ][ 0 ]
+        info[ "sample_id" ] = sample.get( "sample_id" )
+        info[ "aliquot_id" ] = sample[ "portions" ][ 0 ][ "analytes" ][ 0 ][ "aliquots" ][ 0 ][ "aliquot_id" ]
+    except ( KeyError, IndexError ):
+        pass
+    return info
+
+# Load the manifest with the files info from the download directory
+def load_manifest( download_dir ):
+    manifest_filepath = os.path.join( download_dir, MANIFEST )
+    if os.path.exists( manifest_filepath ):
+        with open( manifest_filepath ) as manifest:
+            return json.load( manifest )
+    return { }
+
+# Dump the manifest with the files info to the download directory
+def dump_manifest( download_dir, manifest ):
+    manifest_filepath = os.path.join( download_dir, MANIFEST )
+    # Write to a temporary file first and move it in place once completed
+    # The manifest can be updated by concurrent downloads and conversions
+    with tempfile.NamedTemporaryFile( 'w', dir=download_dir, suffix='.tmp', delete=False ) as tmp_manifest:
+        json.dump( manifest, tmp_manifest, indent=1, sort_keys=True )
+    os.replace( tmp_manifest.name, manifest_filepath )
+
+# Retrieve the info of a list of downloaded files
+# Info are loaded from the manifest in the download directory
+# Files that are not in the manifest are resolved with a single batched query to the GDC "files" endpoint
+# Manifests are updated with the resolved files unless "update_manifest" is disabled (e.g. in worker processes, 
+# the manifest is written by a single process)
+def resolve_files( datatype, filepaths, settings, update_manifest=True, verbose=False ):
+    files = { }
+    missing = { }
+    manifests = { }
+    for filepath in filepaths:
+        download_dir = os.path.dirname( os.path.abspath( filepath ) )
+        if download_dir not in manifests:
+            manifests[ download_dir ] = load_manifest( download_dir )
+        # File uuid is prepended to the file name and it is separated from the original file name by an underscore
+        file_uuid = os.path.basename( filepath ).split( '_' )[ 0 ]
+        if file_uuid in manifests[ download_dir ]:
+            files[ file_uuid ] = manifests[ download_dir ][ file_uuid ]
+        else:
+            missing[ file_uuid ] = download_dir
+    
+    metrics.count( "files_manifest.hits", len( files ) )
+    metrics.count( "files_manifest.misses", len( missing ) )
+    if missing:
+        if verbose:
+            print( "\tResolving {} files on GDC".format( len( missing ) ) )
+        file_uuids = sorted( missing )
+        batch_size = int( settings[ "gdc" ][ "size" ] )
+        for batch_start in range( 0, len( file_uuids ), batch_size ):
+            batch = file_uuids[ batch_start : batch_start + batch_size ]
+            filters = {
+                "op":"and",
+                "content":[
+                    {
+                        "op":"in",
+                        "content":{
+                            "field":"files.file_id",
+                            "value":batch
+                        }
+                    },
+                    {
+                        "op":"=",
+                        "content":{
+                            "field":"files.data_type",
+                            "value":datatype
+                        }
+                    }
+                ]
+            }
+            params = {
+                "filters": filters,
+                "fields": ",".join( FILE_FIELDS ),
+                "format": "JSON",
+                "size": str( len( batch ) )
+            }
+            query_response = query( settings[ "gdc" ][ "searchurl" ], params, 
+                                    repeat=settings[ "gdc" ][ "repeat" ], cache=gdccache.get_cache( settings ) )
+            if query_response:
+                for hit in query_response[ "data" ][ "hits" ]:
+                    files[ hit[ "file_id" ] ] = get_file_info( hit )
+                    manifests[ missing[ hit[ "file_id" ] ] ][ hit[ "file_id" ] ] = files[ hit[ "file_id" ] ]
+        # Update manifests
+        if update_manifest:
+            for download_dir in set( missing.values() ):
+                dump_manifest( download_dir, manifests[ download_dir ] )
+    return files
+
 # Download data from the Genomic Data Commons
 # Make a query to the GDC "files" endpoint to retrieve the list of files available for a given tumor and data type
 # For each of the hit, start downloading by calling the "retrieve" function on the GDC "data" endpoint
+# In bulk mode (gdc/bulk in settings.yaml), files are downloaded in batches of up to gdc/bulk_size MB with "retrieve_bulk" instead
 # Use "after_datetime" to select files created after a specified date
-def download( tumor, datatype, download_dir, after_datetime=None, settings=None, verbose=False ):
+# Yield the position of the hit and the path to the downloaded file as soon as a download is completed
+# A slot is acquired from "slots" before downloading a file, it must be released by the caller once the file has been consumed
+# The info of the files are added to "files" (a dict <file uuid, file info>) before they are yielded
+def iter_download( tumor, datatype, download_dir, after_datetime=None, settings=None, slots=None, files=None, verbose=False ):
     if settings is None:
         if verbose:
             print( "Missing settings" )
-        return [ ]
+        return
     # Search for data
     # Prepare a payload
     # Define a list of attributes that must be retrieved
-    fields = [
-        "file_name",
-        "file_id"
-    ]
+    # Case, sample, and aliquot uuids are stored in the manifest to avoid querying GDC while converting
+    fields = FILE_FIELDS
     fields = ",".join(fields)
     # Define a filter with multiple conditions
     # cases.project.project_id = tumor              # Get data related to a particular tumor only
@@ -106,8 +466,7 @@ def download( tumor, datatype, download_dir, after_datetime=None, settings=None,
     params = {
         "filters": filters,
         "fields": fields,
-        "format": "JSON",                               # Set a response output format
-        "size": str( settings[ "gdc" ][ "size" ] )      # Set the maximum amount of entries in the result
+        "format": "JSON"                                # Set a response output format
     }
 
     # Append filter on data creation datetime if after_datetime is specified
@@ -124,36 +483,169 @@ def download( tumor, datatype, download_dir, after_datetime=None, settings=None,
             }
         )
     
-    if verbose:
-        print("Querying GDC")
-    # Submit a query to GDC to retrieve the list of available data
-    query_response = query( settings[ "gdc" ][ "searchurl" ], params,
-                            repeat=settings[ "gdc" ][ "repeat" ] )
-    if not query_response:
-        # Raise error: unable to query GDC
-        return [ ]
-    
-    # Extract info from query_response
-    data_filepaths = [ ]
-    if len( query_response[ "data" ][ "hits" ] ) > 0:
-        for hit in query_response[ "data" ][ "hits" ]:
-            file_uuid = hit[ "file_id" ]    # Get the file uuid
-            file_name = hit[ "file_name" ]  # Get the file name
-            # Download uuid by querying the 'data' endpoint
-            data_url = '{}{}?related_files=true'.format( settings[ "gdc" ][ "downloadurl" ], file_uuid )
-            # Save file as <file_uuid>_<file_name>
-            # Append the file uuid in front of the file name to retrieve the aliquot uuid during the conversion process
-            data_path = os.path.join( download_dir, '{}_{}'.format( file_uuid, file_name ) )
-            if not os.path.exists( data_path ):
+    # Search results are cached, files are not downloaded in offline mode
+    cache = gdccache.get_cache( settings )
+    # Completed downloads are collected in a queue
+    completed = queue.Queue()
+    failures = [ ]
+    # Search for data and submit downloads in a separate thread
+    def produce():
+        # Up to "concurrency" files are downloaded at the same time over a pool of keep-alive connections
+        concurrency = settings[ "gdc" ].get( "concurrency", 1 )
+        session = get_session( pool_size=concurrency )
+        # Files waiting to be downloaded in the next batch in bulk mode
+        bulk = settings[ "gdc" ].get( "bulk", False )
+        bulk_size = float( settings[ "gdc" ].get( "bulk_size" ) or 0 ) * 1048576
+        batch = [ ]
+        # Download a single file and verify its checksum
+        # Files downloaded by previous runs that have never been verified are hashed once, they are downloaded again if corrupted
+        # Verified files are recorded in the download directory, so that next runs do not hash them again
+        def transfer_file( position, file_uuid, data_url, data_path, file_size, md5sum ):
+            transfer = True
+            try:
+                if os.path.exists( data_path ):
+                    # Files are hashed only if their size matches
+                    if ( is_intact( None, os.path.getsize( data_path ), file_size=file_size ) and 
+                            is_intact( get_md5sum( data_path ) if md5sum else None, None, md5sum=md5sum ) ):
+                        transfer = False
+                    else:
+                        metrics.count( "checksum.mismatches" )
+                        os.unlink( data_path )
+                if transfer:
+                    retrieve( data_url, data_path, params, repeat=settings[ "gdc" ][ "repeat" ], session=session, 
+                              md5sum=md5sum, file_size=file_size )
+                if md5sum and os.path.exists( data_path ):
+                    record_verified( download_dir, file_uuid, data_path, md5sum )
+            finally:
+                completed.put( ( position, data_path, transfer ) )
+        # Download a batch of files
+        # Files missing from the archive or corrupted are retrieved one by one, as well as single files that GDC does not archive
+        def transfer_batch( files ):
+            missing = [ file_uuid for _, file_uuid, _, _, _, _ in files ]
+            try:
+                if len( files ) > 1:
+                    missing = retrieve_bulk( settings[ "gdc" ][ "downloadurl" ].rstrip( "/" ), 
+                                             { file_uuid: data_path for _, file_uuid, _, data_path, _, _ in files },
+                                             repeat=settings[ "gdc" ][ "repeat" ], session=session, 
+                                             checksums={ file_uuid: ( md5sum, file_size ) for _, file_uuid, _, _, file_size, md5sum in files } )
+            finally:
+                for position, file_uuid, data_url, data_path, file_size, md5sum in files:
+                    if file_uuid in missing:
+                        transfer_file( position, file_uuid, data_url, data_path, file_size, md5sum )
+                    else:
+                        if md5sum:
+                            record_verified( download_dir, file_uuid, data_path, md5sum )
+                        completed.put( ( position, data_path, True ) )
+        # Submit the batch of files waiting to be downloaded
+        def flush( executor ):
+            if batch:
                 if verbose:
-                    print( "\tDownloading {}_{}".format( file_uuid, file_name ) )
-                # Start retrieving data
-                retrieve( data_url, data_path, params, repeat=settings[ "gdc" ][ "repeat" ] )
-            if os.path.exists( data_path ):
-                data_filepaths.append( data_path )
-    
+                    print( "\tDownloading a batch of {} files ({:.2f} MB)".format( 
+                                len( batch ), sum( file_size or 0 for _, _, _, _, file_size, _ in batch ) / 1048576 ) )
+                executor.submit( transfer_batch, batch[ : ] )
+                del batch[ : ]
+        try:
+            with ThreadPoolExecutor( max_workers=concurrency ) as executor:
+                if verbose:
+                    print("Querying GDC")
+                # Keep track of the files info in the manifest located in the download directory
+                manifest = load_manifest( download_dir )
+                # Files verified by previous runs are not hashed again
+                verified = load_verified( download_dir )
+                position = 0
+                # Submit a query to GDC to retrieve the list of available data
+                # Start downloading files as soon as the first page of results is retrieved
+                for hits in search_pages( settings[ "gdc" ][ "searchurl" ], params, settings[ "gdc" ][ "size" ],
+                                          repeat=settings[ "gdc" ][ "repeat" ], cache=cache, verbose=verbose ):
+                    for hit in hits:
+                        manifest[ hit[ "file_id" ] ] = get_file_info( hit )
+                        if files is not None:
+                            files[ hit[ "file_id" ] ] = manifest[ hit[ "file_id" ] ]
+                    # Files info must be available before their download is completed
+                    dump_manifest( download_dir, manifest )
+                    for hit in hits:
+                        file_uuid = hit[ "file_id" ]    # Get the file uuid
+                        file_name = hit[ "file_name" ]  # Get the file name
+                        # Download uuid by querying the 'data' endpoint
+                        data_url = '{}{}?related_files=true'.format( settings[ "gdc" ][ "downloadurl" ], file_uuid )
+                        # Save file as <file_uuid>_<file_name>
+                        # Append the file uuid in front of the file name to retrieve the aliquot uuid during the conversion process
+                        data_path = os.path.join( download_dir, '{}_{}'.format( file_uuid, file_name ) )
+                        # Checksum and size are used to verify the downloaded data
+                        md5sum = hit.get( "md5sum" )
+                        file_size = hit.get( "file_size" )
+                        # Wait for a free slot
+                        # The pending batch is submitted before waiting, slots are freed once its files are consumed
+                        if slots is not None and not slots.acquire( blocking=False ):
+                            flush( executor )
+                            slots.acquire()
+                        if md5sum and is_verified( verified, file_uuid, data_path, md5sum ):
+                            metrics.count( "verified_files.hits" )
+                            completed.put( ( position, data_path, False ) )
+                        elif gdccache.is_offline( cache ) or ( os.path.exists( data_path ) and not md5sum ):
+                            completed.put( ( position, data_path, False ) )
+                        elif os.path.exists( data_path ):
+                            # Verify a file downloaded by a previous run
+                            metrics.count( "verified_files.misses" )
+                            executor.submit( transfer_file, position, file_uuid, data_url, data_path, file_size, md5sum )
+                        elif bulk:
+                            # Batches are sized by the total size of their files, and they are bounded by the page size
+                            batch.append( ( position, file_uuid, data_url, data_path, file_size, md5sum ) )
+                            if ( sum( size or 0 for _, _, _, _, size, _ in batch ) >= bulk_size or 
+                                    len( batch ) >= int( settings[ "gdc" ][ "size" ] ) ):
+                                flush( executor )
+                        else:
+                            if verbose:
+                                print( "\tDownloading {}_{}".format( file_uuid, file_name ) )
+                            # Start retrieving data
+                            executor.submit( transfer_file, position, file_uuid, data_url, data_path, file_size, md5sum )
+                        position += 1
+                flush( executor )
+        except Exception as e:
+            failures.append( e )
+        finally:
+            session.close()
+            completed.put( None )
+
+    producer = threading.Thread( target=produce, daemon=True )
+    producer.start()
+    # Collect downloaded files and report the aggregate progress
+    t0 = time.time()
+    transferred = 0
+    downloaded_bytes = 0
+    while True:
+        download = completed.get()
+        if download is None:
+            break
+        position, data_path, transfer = download
+        if not os.path.exists( data_path ):
+            # Unable to download the file
+            if slots is not None:
+                slots.release()
+            continue
+        # Keep track of the files of the session in record mode
+        gdccache.record_file( cache, os.path.basename( data_path ).split( '_' )[ 0 ], data_path )
+        if transfer:
+            transferred += 1
+            downloaded_bytes += os.path.getsize( data_path )
+            metrics.count( "download.files" )
+            metrics.count( "download.bytes", os.path.getsize( data_path ) )
+            if verbose:
+                elapsed = max( time.time() - t0, 1e-6 )
+                print( "\tDownloaded {} files ({:.2f} files/s, {:.2f} MB/s)".format( 
+                            transferred, transferred / elapsed, downloaded_bytes / elapsed / 1048576 ) )
+        yield position, data_path
+    producer.join()
+    if failures:
+        raise failures[ 0 ]
+
+# Download data from the Genomic Data Commons
+# Return the list of downloaded files sorted according to the search results
+def download( tumor, datatype, download_dir, after_datetime=None, settings=None, verbose=False ):
+    data_filepaths = sorted( iter_download( tumor, datatype, download_dir, after_datetime=after_datetime, 
+                                            settings=settings, verbose=verbose ) )
     # Return the list of downloaded files
-    return data_filepaths
+    return [ data_path for _, data_path in data_filepaths ]
 
 # Convert GDC data
 def convert( datatype, filepath, convert_dir, settings, resources={ }, verbose=False ):
@@ -173,37 +665,280 @@ def convert( datatype, filepath, convert_dir, settings, resources={ }, verbose=F
         print( "Unsupported GDC Data Type" )
     return False, None, resources
 
+# Name of the manifest with the info about the conversion runs located in the convert directory
+RUN_MANIFEST = "run_manifest.json"
+
+# Define a signature of the settings and external assets used to convert a data type
+# Settings about the GDC API do not affect the conversion
+def get_run_signature( datatype, settings ):
+    conversion_settings = { key: value for key, value in settings.items() if key != "gdc" }
+    signature = json.dumps( [ datatype, conversion_settings, get_assets_signature( settings ) ], sort_keys=True )
+    return hashlib.md5( signature.encode() ).hexdigest()
+
+# Load the manifest of the last conversion run of a data type from the convert directory
+# If settings or external assets changed since the last run, all the input files are marked as changed
+def load_run_manifest( convert_dir, datatype, settings ):
+    run_manifest_filepath = os.path.join( convert_dir, RUN_MANIFEST )
+    run = { }
+    if os.path.exists( run_manifest_filepath ):
+        with open( run_manifest_filepath ) as run_manifest:
+            run = json.load( run_manifest ).get( datatype, { } )
+    run.setdefault( "inputs", { } )
+    run.setdefault( "outputs", [ ] )
+    signature = get_run_signature( datatype, settings )
+    if run.get( "signature" ) != signature:
+        run[ "signature" ] = signature
+        for input_filepath in run[ "inputs" ]:
+            run[ "inputs" ][ input_filepath ][ "size" ] = None
+    return run
+
+# Dump the manifest of the last conversion run of a data type to the convert directory
+def dump_run_manifest( convert_dir, datatype, run ):
+    run_manifest_filepath = os.path.join( convert_dir, RUN_MANIFEST )
+    runs = { }
+    if os.path.exists( run_manifest_filepath ):
+        with open( run_manifest_filepath ) as run_manifest:
+            runs = json.load( run_manifest )
+    runs[ datatype ] = run
+    # Write to a temporary file first and move it in place once completed
+    with open( '{}.tmp'.format( run_manifest_filepath ), 'w' ) as tmp_run_manifest:
+        json.dump( runs, tmp_run_manifest, indent=1, sort_keys=True )
+    os.replace( '{}.tmp'.format( run_manifest_filepath ), run_manifest_filepath )
+
+# Yield the input files that are new or changed since the last run
+# Input files whose outputs have been removed are also selected
+# "skip" is called for every input file that does not need to be converted
+def iter_changed_inputs( run, filepaths, skip=None ):
+    for filepath in filepaths:
+        entry = run[ "inputs" ].get( os.path.abspath( filepath ) )
+        stat = os.stat( filepath )
+        if ( entry is None or entry[ "size" ] != stat.st_size or entry[ "mtime" ] != stat.st_mtime_ns or 
+                not all( os.path.exists( outfilepath ) for outfilepath in entry[ "outputs" ] ) ):
+            yield filepath
+        elif skip is not None:
+            skip( filepath )
+
+# Select the input files that are new or changed since the last run
+def get_changed_inputs( run, filepaths ):
+    return list( iter_changed_inputs( run, filepaths ) )
+
+# Drop the input files that do not exist anymore from the run manifest and remove their outputs
+def drop_missing_inputs( run, verbose=False ):
+    missing = [ input_filepath for input_filepath in run[ "inputs" ] if not os.path.exists( input_filepath ) ]
+    for input_filepath in missing:
+        entry = run[ "inputs" ].pop( input_filepath )
+        # Do not remove outputs that are also produced by other input files
+        claimed = set( outfilepath for other in run[ "inputs" ].values() for outfilepath in other[ "outputs" ] )
+        for outfilepath in entry[ "outputs" ]:
+            if outfilepath not in claimed and os.path.exists( outfilepath ):
+                if verbose:
+                    print( "\tRemoving {}".format( outfilepath ) )
+                if os.path.isdir( outfilepath ):
+                    shutil.rmtree( outfilepath )
+                else:
+                    os.unlink( outfilepath )
+    return missing
+
+# Name of the directory with the partial results of the conversion of every input file located in the convert directory
+PARTIALS = "partials"
+
+# Dump the partial results of the conversion of an input file to the convert directory
+# Partial results are stored to a JSON file per input file, the run manifest keeps the path to the file only
+def dump_partial( convert_dir, filepath, partial ):
+    partials_dir = os.path.join( convert_dir, PARTIALS )
+    if not os.path.exists( partials_dir ):
+        os.makedirs( partials_dir )
+    partial_filepath = os.path.join( os.path.abspath( partials_dir ), 
+                                     '{}.json'.format( hashlib.md5( os.path.abspath( filepath ).encode() ).hexdigest() ) )
+    # Write to a temporary file first and move it in place once completed
+    with open( '{}.tmp'.format( partial_filepath ), 'w' ) as tmp_partial:
+        json.dump( partial, tmp_partial )
+    os.replace( '{}.tmp'.format( partial_filepath ), partial_filepath )
+    return partial_filepath
+
+# Load the partial results of the conversion of an input file
+# Partial results of older runs are stored in the run manifest
+def load_partial( partial ):
+    if partial is None or isinstance( partial, dict ):
+        return partial or { }
+    with open( partial ) as partial_file:
+        return json.load( partial_file )
+
+# Keep track of a converted input file and its outputs in the run manifest
+# "partial" is the path to the partial results of the conversion that must be reused in next runs (see dump_partial)
+# Outputs of the previous conversion that are not produced anymore (e.g. after changing settings) are removed
+def update_run_manifest( run, filepath, outputs, partial=None ):
+    stat = os.stat( filepath )
+    outputs = [ os.path.abspath( outfilepath ) for outfilepath in outputs ]
+    previous = run[ "inputs" ].get( os.path.abspath( filepath ), { } ).get( "outputs", [ ] )
+    for outfilepath in set( previous ).difference( outputs ):
+        if os.path.isdir( outfilepath ):
+            shutil.rmtree( outfilepath )
+        elif os.path.exists( outfilepath ):
+            os.unlink( outfilepath )
+    run[ "inputs" ][ os.path.abspath( filepath ) ] = {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "outputs": outputs,
+        "partial": partial
+    }
+
+# Conversion context shared with the worker processes
+# It is defined before forking so that workers inherit the read-only resources without pickling them
+SHARED = { }
+
+# Convert a single file with the shared conversion context
+# Return the resources that have been added or replaced while converting the file only
+def convert_shared( filepath ):
+    print( "Converting {}".format( filepath ) )
+    shared_resources = SHARED[ "resources" ]
+    # Use a shallow copy to avoid partial results leaking across files
+    converted, outfilepath, resources = convert( SHARED[ "datatype" ], filepath, SHARED[ "convert_dir" ], SHARED[ "settings" ],
+                                                 resources=dict( shared_resources ), verbose=SHARED[ "verbose" ] )
+    partial = { key: value for key, value in resources.items() 
+                    if key not in shared_resources or shared_resources[ key ] is not value }
+    return filepath, converted, outfilepath, partial
+
+# Convert a single file in a worker process
+# The info of the file are sent by the main process if they have been retrieved after forking (e.g. in pipeline mode)
+# Metrics collected while converting the file are sent back to the main process with the results
+# Probes annotated while converting the file are also sent back, so that the main process can persist them
+# Probes are only added to the annotation cache, new probes are the last items of the dict
+def convert_forked( task ):
+    filepath, file_info = task
+    if file_info is not None:
+        SHARED[ "resources" ][ "Files" ][ os.path.basename( filepath ).split( '_' )[ 0 ] ] = file_info
+    probes = SHARED[ "resources" ].get( "Probes", { } )
+    known = len( probes )
+    result = convert_shared( filepath )
+    return result, dict( itertools.islice( probes.items(), known, None ) ), metrics.pop()
+
+# Convert a list of files with a pool of "workers" processes
+# Results are yielded in the same order of the input files
+# The first file is converted before forking if "warmup" is enabled
+def convert_many( datatype, filepaths, convert_dir, settings, resources={ }, workers=1, warmup=True, verbose=False ):
+    SHARED.update( {
+        "datatype": datatype,
+        "convert_dir": convert_dir,
+        "settings": settings,
+        "resources": resources,
+        "verbose": verbose
+    } )
+    filepaths = iter( filepaths )
+    # Processes must be forked to share resources
+    if workers < 2 or "fork" not in mp.get_all_start_methods():
+        for filepath in filepaths:
+            yield convert_shared( filepath )
+        return
+    if warmup:
+        # Convert the first file in the current process
+        # This warms up the caches in resources before forking
+        for filepath in filepaths:
+            yield convert_shared( filepath )
+            break
+    # Files info are looked up when files are submitted to the workers
+    tasks = ( ( filepath, resources.get( "Files", { } ).get( os.path.basename( filepath ).split( '_' )[ 0 ] ) ) 
+                  for filepath in filepaths )
+    # Workers discard the metrics inherited from the main process
+    with mp.get_context( "fork" ).Pool( workers, initializer=metrics.reset ) as pool:
+        for result, probes, collected in pool.imap( convert_forked, tasks ):
+            metrics.merge( collected )
+            if probes and "Probes" in resources:
+                # Probes annotated by the workers are merged into the annotation cache of the main process
+                metrics.count( "probes_cache.merged", len( probes ) )
+                resources[ "Probes" ].update( probes )
+            yield result
+
 # Load external resources
 # Paths to the resource files are defined in settings.yaml
-def load_resources( datatype, settings, verbose=False ):
+def load_resources( datatype, settings, filepaths=[ ], verbose=False ):
     resources = { }
     # Define the external resources required to convert the Methylation Beta Value data
     if datatype == "Methylation Beta Value":
+        if verbose:
+            print( "\tLoading files manifest" )
+        # Retrieve aliquot uuids for all the files at once
+        resources[ "Files" ] = resolve_files( datatype, filepaths, settings, verbose=verbose )
         # Load data from external assets
         if verbose:
             print( "\tLoading Gencode local DB" )
-        # Do not load Gencode
-        # Gencode must be partially loaded while converting
-        resources[ "Gencode" ] = { } 
+        # Load genes from the Gencode index
+        # The index is built from the Gencode DB the first time only
+        with metrics.timer( "gencode_load" ):
+            resources[ "Gencode" ] = gencode.get_gencode_info_fromfile( settings[ 'assets' ][ 'gencode' ], "symbol", "gene",
+                                                                        gencode_data={ }, verbose=verbose )
+        if settings.get( "convert", { } ).get( "nearest", False ):
+            if verbose:
+                print( "\tLoading Gencode interval index" )
+            # Genes are indexed by coordinates to annotate CpG sites without gene symbols
+            with metrics.timer( "gencode_intervals" ):
+                resources[ "Intervals" ] = gencode.get_interval_index( settings[ 'assets' ][ 'gencode' ], "gene", verbose=verbose )
         if verbose:
             print( "\tLoading NCBI local DB" )
         # Load both NCBI reference and history files
-        resources[ "NCBI" ] = {
-            "DB": ncbi.get_symbol_entrez_map( settings[ 'assets' ][ 'ncbi' ][ 'reference' ] ),
-            "Deprecated": ncbi.get_deprecated_symbol_entrez_map( settings[ 'assets' ][ 'ncbi' ][ 'history' ] )
-        }
+        with metrics.timer( "ncbi_load" ):
+            resources[ "NCBI" ] = {
+                "DB": ncbi.get_symbol_entrez_map( settings[ 'assets' ][ 'ncbi' ][ 'reference' ] ),
+                "Deprecated": ncbi.get_deprecated_symbol_entrez_map( settings[ 'assets' ][ 'ncbi' ][ 'history' ] )
+            }
         if verbose:
             print( "\tLoading HGNC local DB" )
         # Load HGNC database
-        resources[ "HGNC" ] = hgnc.get_symbol_entrez_map( settings[ 'assets' ][ 'hgnc' ] )
+        with metrics.timer( "hgnc_load" ):
+            resources[ "HGNC" ] = hgnc.get_symbol_entrez_map( settings[ 'assets' ][ 'hgnc' ] )
+        if verbose:
+            print( "\tLoading probes annotation cache" )
+        # Load the per-probe annotation cache if available
+        with metrics.timer( "probes_cache_load" ):
+            resources[ "Probes" ] = methylation.load_probe_cache( settings.get( "cache", { } ).get( "probes" ),
+                                                                  get_assets_signature( settings ) )
     return resources
 
+# Dump external resources that have been extended during the conversion
+def dump_resources( datatype, settings, resources, verbose=False ):
+    if datatype == "Methylation Beta Value":
+        if verbose:
+            print( "\tDumping probes annotation cache" )
+        with metrics.timer( "probes_cache_dump" ):
+            methylation.dump_probe_cache( settings.get( "cache", { } ).get( "probes" ),
+                                          get_assets_signature( settings ), resources.get( "Probes", { } ) )
+
+# Define a signature of the external assets
+# It is based on the size and last modification time of the assets files
+def get_assets_signature( settings ):
+    assets = [ settings[ 'assets' ][ 'gencode' ],
+               settings[ 'assets' ][ 'ncbi' ][ 'reference' ],
+               settings[ 'assets' ][ 'ncbi' ][ 'history' ],
+               settings[ 'assets' ][ 'hgnc' ] ]
+    signature = [ ]
+    for asset in assets:
+        if os.path.exists( asset ):
+            stat = os.stat( asset )
+            signature.append( ( os.path.basename( asset ), stat.st_size, stat.st_mtime_ns ) )
+        else:
+            signature.append( ( os.path.basename( asset ), None, None ) )
+    return tuple( signature )
+
 # Dump the header.schema with the definition of the fields in the converted files
 def dump_schema( datatype, convert_dir ):
     # Invoke a specific parser according to the specified "datatype"
     if datatype in PARSERS:
         PARSERS[ datatype ].dump_schema( convert_dir )
 
+# Return the list of outputs produced by the conversion of a file
+def get_outputs( datatype, outfilepath, settings ):
+    # Invoke a specific parser according to the specified "datatype"
+    if datatype in PARSERS:
+        return PARSERS[ datatype ].get_outputs( outfilepath, settings )
+    return [ outfilepath ]
+
+# Export converted files to a data matrix
+def export_matrix( datatype, filepaths, matrix_prefix, verbose=False ):
+    # Invoke a specific parser according to the specified "datatype"
+    if datatype in PARSERS:
+        return PARSERS[ datatype ].export_matrix( filepaths, matrix_prefix, verbose=verbose )
+    return False
+
 # Return a list of supported input data types
 def supproted_ext( datatype ):
     # Invoke a specific parser according to the specified "datatype"
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+__author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
+__version__ = '0.01'
+__date__ = 'Oct 21, 2020'
+
+import os, gzip, heapq, tempfile
+import writer.bgzf as bgzf
+
+# Chromosomes that are not numbers are sorted after chromosome 22
+CHROMOSOMES = { "X": 23, "Y": 24, "M": 25, "MT": 25 }
+
+# Define the sort key of a chromosome
+# Chromosomes 1-22, X, Y, and M are sorted numerically, any other chromosome follows them in lexicographic order
+def chromosome_key( chromosome ):
+    name = chromosome[ 3: ] if chromosome.lower().startswith( "chr" ) else chromosome
+    if name.isdigit():
+        return ( 0, int( name ), "" )
+    if name.upper() in CHROMOSOMES:
+        return ( 0, CHROMOSOMES[ name.upper() ], "" )
+    return ( 1, 0, name )
+
+# Define the sort key of a BED line by its chromosome and start position
+def line_key( line ):
+    chromosome, start, _ = line.split( "\t", 2 )
+    return ( chromosome_key( chromosome ), int( start ) )
+
+# Dump a sorted run of lines to a temporary file
+def dump_run( lines, tmp_dir ):
+    run = tempfile.TemporaryFile( 'w+', dir=tmp_dir )
+    run.writelines( line for _, line in lines )
+    run.seek( 0 )
+    return run
+
+# Open a BED file for reading, block-compressed BED files are decompressed on the fly
+def open_bed( bed_filepath ):
+    if str( bed_filepath ).endswith( ".gz" ):
+        return gzip.open( bed_filepath, 'rt' )
+    return open( bed_filepath )
+
+# Write BED lines sorted by chromosome and start position
+# "rows" is an iterable of lists of values, the first three values are the chromosome, start, and end
+# Lines are kept in memory up to "max_memory" bytes, then they are sorted and spilled to temporary files
+# Spilled runs are finally merged and written out in batches of "batch_size" lines
+# Lines with the same chromosome and start position keep their original order
+# If "compress" is enabled, lines are written to a block-compressed file with a region index (see writer/bgzf.py)
+# Return the number of written lines, the BED file is not created if there are no lines
+def write_sorted( bed_filepath, rows, max_memory=268435456, batch_size=10000, tmp_dir=None, compress=False ):
+    tmp_dir = tmp_dir or os.path.dirname( os.path.abspath( bed_filepath ) )
+    runs = [ ]
+    lines = [ ]
+    memory = 0
+    count = 0
+    try:
+        for values in rows:
+            line = '{}\n'.format( '\t'.join( [ str( value ) for value in values ] ) )
+            lines.append( ( ( chromosome_key( str( values[ 0 ] ) ), int( values[ 1 ] ) ), line ) )
+            # Approximate the memory footprint of a line with its key
+            memory += len( line ) + 200
+            count += 1
+            if memory >= max_memory:
+                lines.sort( key=lambda entry: entry[ 0 ] )
+                runs.append( dump_run( lines, tmp_dir ) )
+                lines = [ ]
+                memory = 0
+        if count == 0:
+            return 0
+
+        lines.sort( key=lambda entry: entry[ 0 ] )
+        if runs:
+            # Merge the sorted runs with the lines in memory
+            # Runs are merged in the order they have been produced to keep ties stable
+            runs.append( dump_run( lines, tmp_dir ) )
+            lines = [ ]
+            merged = heapq.merge( *runs, key=line_key )
+        else:
+            merged = ( line for _, line in lines )
+
+        # Write to a temporary file first and move it in place once completed
+        tmp_bed_filepath = '{}.tmp'.format( bed_filepath )
+        if compress:
+            # The region index is built while writing the sorted lines
+            index = bgzf.write_bgzf( tmp_bed_filepath, merged )
+            os.replace( tmp_bed_filepath, bed_filepath )
+            bgzf.dump_index( index, bed_filepath )
+            return count
+        with open( tmp_bed_filepath, 'w', buffering=1048576 ) as bed:
+            batch = [ ]
+            for line in merged:
+                batch.append( line )
+                if len( batch ) >= batch_size:
+                    bed.write( ''.join( batch ) )
+                    batch = [ ]
+            bed.write( ''.join( batch ) )
+        os.replace( tmp_bed_filepath, bed_filepath )
+        return count
+    finally:
+        for run in runs:
+            run.close()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+__author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
+__version__ = '0.01'
+__date__ = 'Oct 21, 2020'
+
+import os, json, zlib, struct
+
+# Block-compressed files are series of gzip members (BGZF blocks, as in bgzip and samtools)
+# Every block contains up to BLOCK_SIZE bytes of uncompressed data and its compressed size in the BC extra field
+# They can be decompressed with any gzip reader, and random access is possible through virtual offsets
+# A virtual offset is the offset of a block in the compressed file shifted by 16 bits, plus an offset within the block
+BLOCK_SIZE = 65280
+
+# Empty block marking the end of a file
+EOF_BLOCK = bytes.fromhex( "1f8b08040000000000ff0600424302001b0003000000000000000000" )
+
+# The region index maps windows of 2^WINDOW_SHIFT bases to the virtual offset of the first line overlapping them
+WINDOW_SHIFT = 14
+INDEX_VERSION = 1
+
+# Define the path to the region index of a block-compressed file
+def get_index_filepath( bgzf_filepath ):
+    return '{}.bgi'.format( bgzf_filepath )
+
+# Compress data into a BGZF block
+def compress_block( data, level=6 ):
+    compressor = zlib.compressobj( level, zlib.DEFLATED, -15 )
+    compressed = compressor.compress( data ) + compressor.flush()
+    # The block size in the header is the total size of the block minus 1
+    header = struct.pack( "<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len( compressed ) + 25 )
+    return header + compressed + struct.pack( "<II", zlib.crc32( data ), len( data ) )
+
+# Read the BGZF block at "offset"
+# Return the uncompressed data and the size of the compressed block, the size is 0 at the end of the file
+def read_block( bgzf, offset ):
+    bgzf.seek( offset )
+    header = bgzf.read( 12 )
+    if len( header ) < 12:
+        return b"", 0
+    extra_length = struct.unpack( "<H", header[ 10:12 ] )[ 0 ]
+    extra = bgzf.read( extra_length )
+    block_size = None
+    position = 0
+    while position + 4 <= extra_length:
+        subfield_length = struct.unpack( "<H", extra[ position + 2 : position + 4 ] )[ 0 ]
+        if extra[ position : position + 2 ] == b"BC":
+            block_size = struct.unpack( "<H", extra[ position + 4 : position + 6 ] )[ 0 ] + 1
+        position += 4 + subfield_length
+    if block_size is None:
+        raise ValueError( "Not a BGZF block at offset {}".format( offset ) )
+    data = bgzf.read( block_size - 12 - extra_length )
+    return zlib.decompress( data[ :-8 ], -15 ), block_size
+
+# Iterate over the lines of a block-compressed file starting from a virtual offset
+def iter_lines( bgzf, virtual_offset=0 ):
+    block_offset = virtual_offset >> 16
+    within_block = virtual_offset & 0xffff
+    pending = b""
+    while True:
+        data, block_size = read_block( bgzf, block_offset )
+        if block_size == 0:
+            break
+        block_offset += block_size
+        pending += data[ within_block: ]
+        within_block = 0
+        lines = pending.split( b"\n" )
+        pending = lines.pop( )
+        for line in lines:
+            yield line.decode( )
+    if pending:
+        yield pending.decode( )
+
+# Keep track of the virtual offset of a line in the region index
+# Lines are sorted by chromosome and start position, so the first line overlapping a window has the lowest offset
+def index_line( index, chromosome, start, end, virtual_offset ):
+    if chromosome not in index:
+        index[ chromosome ] = { "offset": virtual_offset, "lines": 0, "windows": [ ] }
+    entry = index[ chromosome ]
+    entry[ "lines" ] += 1
+    windows = entry[ "windows" ]
+    for window in range( start >> WINDOW_SHIFT, ( end >> WINDOW_SHIFT ) + 1 ):
+        if window >= len( windows ):
+            windows.extend( [ None ] * ( window + 1 - len( windows ) ) )
+        if windows[ window ] is None:
+            windows[ window ] = virtual_offset
+
+# Write sorted BED lines to a block-compressed file
+# Return the region index built while writing
+def write_bgzf( bgzf_filepath, lines, level=6 ):
+    index = { }
+    buffer = bytearray( )
+    block_offset = 0
+    with open( bgzf_filepath, 'wb' ) as bgzf:
+        for line in lines:
+            chromosome, start, end = line.split( "\t", 3 )[ :3 ]
+            index_line( index, chromosome, int( start ), int( end ), ( block_offset << 16 ) | len( buffer ) )
+            buffer += line.encode( )
+            while len( buffer ) >= BLOCK_SIZE:
+                block = compress_block( bytes( buffer[ :BLOCK_SIZE ] ), level=level )
+                bgzf.write( block )
+                block_offset += len( block )
+                del buffer[ :BLOCK_SIZE ]
+        if buffer:
+            bgzf.write( compress_block( bytes( buffer ), level=level ) )
+        bgzf.write( EOF_BLOCK )
+    # Windows that are not overlapped by any line point to the last line before them
+    for entry in index.values():
+        windows = entry[ "windows" ]
+        last_offset = entry[ "offset" ]
+        for window, virtual_offset in enumerate( windows ):
+            if virtual_offset is None:
+                windows[ window ] = last_offset
+            else:
+                last_offset = virtual_offset
+    return index
+
+# Dump the region index of a block-compressed file
+def dump_index( index, bgzf_filepath ):
+    index_filepath = get_index_filepath( bgzf_filepath )
+    # Write to a temporary file first and move it in place once completed
+    tmp_index_filepath = '{}.tmp'.format( index_filepath )
+    with open( tmp_index_filepath, 'w' ) as index_file:
+        json.dump( { "version": INDEX_VERSION, "window_shift": WINDOW_SHIFT, "chromosomes": index }, index_file )
+    os.replace( tmp_index_filepath, index_filepath )
+
+# Load the region index of a block-compressed file
+def load_index( bgzf_filepath ):
+    with open( get_index_filepath( bgzf_filepath ) ) as index_file:
+        return json.load( index_file )
+
+# Query a block-compressed BED file for the lines overlapping a region
+# "start" and "end" are inclusive, as the coordinates in the converted files
+# Yield the lists of values of the lines, "index" can be specified to avoid loading it again
+def query_region( bgzf_filepath, chromosome, start, end, index=None ):
+    index = index or load_index( bgzf_filepath )
+    entry = index[ "chromosomes" ].get( chromosome )
+    if entry is None:
+        return
+    window = max( start, 0 ) >> index[ "window_shift" ]
+    if window >= len( entry[ "windows" ] ):
+        # No line reaches the region
+        return
+    with open( bgzf_filepath, 'rb' ) as bgzf:
+        for line in iter_lines( bgzf, entry[ "windows" ][ window ] ):
+            values = line.split( "\t" )
+            if values[ 0 ] != chromosome or int( values[ 1 ] ) > end:
+                break
+            if int( values[ 2 ] ) >= start:
+                yield values
+
+# Query a list of block-compressed BED files for the lines overlapping a region
+# Yield the path to the file with the list of values of every line
+def query_regions( bgzf_filepaths, chromosome, start, end ):
+    for bgzf_filepath in bgzf_filepaths:
+        for values in query_region( bgzf_filepath, chromosome, start, end ):
+            yield bgzf_filepath, values
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+__author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
+__version__ = '0.01'
+__date__ = 'Oct 21, 2020'
+
+import os, json, array, shutil
+import numpy as np
+
+# Columnar layout of a converted file
+# It is a directory with the following files:
+#   - schema.json with the number of rows and the list of fields with their GMQL type, data type, and encoding
+#   - <field>.npy with the values of the numeric fields, or the int32 codes of the dictionary-encoded fields
+#   - <field>.dict.npy with the distinct values of the dictionary-encoded fields (codes are positions in this array)
+# All the .npy files can be memory-mapped
+VERSION = 1
+
+# Numeric GMQL types with their data type and array typecode
+# Fields with any other GMQL type (e.g. STRING and CHAR) are dictionary-encoded
+NUMERIC_TYPES = {
+    "LONG": ( "int64", "q" ),
+    "INTEGER": ( "int32", "i" ),
+    "DOUBLE": ( "float32", "f" ),
+    "FLOAT": ( "float32", "f" )
+}
+
+# Parse a numeric value, empty and NA values are NaN for floating point fields
+def parse_value( value, typecode ):
+    if typecode == "f":
+        return float( value ) if value and value.lower() != "na" else float( "nan" )
+    return int( value )
+
+# Write rows to a columnar directory
+# "fields" is the list of ( name, GMQL type ) of the fields, "rows" is an iterable of lists of string values
+# Return the number of written rows
+def write_columnar( dirpath, fields, rows ):
+    columns = [ ]
+    dictionaries = [ ]
+    for _, field_type in fields:
+        if field_type in NUMERIC_TYPES:
+            columns.append( array.array( NUMERIC_TYPES[ field_type ][ 1 ] ) )
+            dictionaries.append( None )
+        else:
+            columns.append( array.array( "i" ) )
+            dictionaries.append( { } )
+    count = 0
+    for values in rows:
+        for position, value in enumerate( values ):
+            dictionary = dictionaries[ position ]
+            if dictionary is None:
+                columns[ position ].append( parse_value( value, columns[ position ].typecode ) )
+            else:
+                code = dictionary.get( value )
+                if code is None:
+                    code = len( dictionary )
+                    dictionary[ value ] = code
+                columns[ position ].append( code )
+        count += 1
+
+    # Write to a temporary directory first and move it in place once completed
+    tmp_dirpath = '{}.tmp'.format( dirpath )
+    if os.path.exists( tmp_dirpath ):
+        shutil.rmtree( tmp_dirpath )
+    os.makedirs( tmp_dirpath )
+    schema = { "version": VERSION, "rows": count, "fields": [ ] }
+    for position, ( name, field_type ) in enumerate( fields ):
+        if dictionaries[ position ] is None:
+            dtype = NUMERIC_TYPES[ field_type ][ 0 ]
+            encoding = "plain"
+        else:
+            dtype = "int32"
+            encoding = "dictionary"
+            # Distinct values are sorted by code
+            np.save( os.path.join( tmp_dirpath, '{}.dict.npy'.format( name ) ), np.array( list( dictionaries[ position ] ), dtype=str ) )
+        np.save( os.path.join( tmp_dirpath, '{}.npy'.format( name ) ), np.frombuffer( columns[ position ], dtype=dtype ) )
+        schema[ "fields" ].append( { "name": name, "type": field_type, "dtype": dtype, "encoding": encoding } )
+    with open( os.path.join( tmp_dirpath, 'schema.json' ), 'w' ) as schema_file:
+        json.dump( schema, schema_file, indent=1 )
+    if os.path.exists( dirpath ):
+        shutil.rmtree( dirpath )
+    os.replace( tmp_dirpath, dirpath )
+    return count
+
+# Read the schema of a columnar directory
+def read_schema( dirpath ):
+    with open( os.path.join( dirpath, 'schema.json' ) ) as schema_file:
+        return json.load( schema_file )
+
+# Read a columnar directory as a dict of memory-mapped arrays
+# Select a subset of fields with "fields"
+# Dictionary-encoded fields are ( codes, distinct values ) tuples, or arrays of strings if "decode" is enabled
+def read_columnar( dirpath, fields=None, decode=False ):
+    columns = { }
+    for field in read_schema( dirpath )[ "fields" ]:
+        if fields is not None and field[ "name" ] not in fields:
+            continue
+        values = np.load( os.path.join( dirpath, '{}.npy'.format( field[ "name" ] ) ), mmap_mode='r' )
+        if field[ "encoding" ] == "dictionary":
+            dictionary = np.load( os.path.join( dirpath, '{}.dict.npy'.format( field[ "name" ] ) ), mmap_mode='r' )
+            values = dictionary[ values ] if decode else ( values, dictionary )
+        columns[ field[ "name" ] ] = values
+    return columns
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+__author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
+__version__ = '0.01'
+__date__ = 'Oct 21, 2020'
+
+import os
+import numpy as np
+import writer.bed as bed
+
+# Define the paths to the files that compose a matrix
+# <matrix_prefix>.npy contains the float32 values, <matrix_prefix>.rows and <matrix_prefix>.columns contain the ids
+def get_matrix_filepaths( matrix_prefix ):
+    return {
+        "values": '{}.npy'.format( matrix_prefix ),
+        "rows": '{}.rows'.format( matrix_prefix ),
+        "columns": '{}.columns'.format( matrix_prefix ),
+        "tsv": '{}.tsv'.format( matrix_prefix )
+    }
+
+# Build a matrix from a list of tab-separated files, one column per file
+# "row_field" and "value_field" are the positions of the row id and the value in the lines of the files
+# The matrix is backed by a memory-mapped float32 array in column-major order
+# Columns are filled one at a time so that only one column is kept in memory
+# Missing values are NaN
+def build_matrix( filepaths, column_ids, matrix_prefix, row_field, value_field, verbose=False ):
+    matrix_filepaths = get_matrix_filepaths( matrix_prefix )
+    matrix_dir = os.path.dirname( os.path.abspath( matrix_prefix ) )
+    if not os.path.exists( matrix_dir ):
+        os.makedirs( matrix_dir )
+    # Collect row ids from all the files
+    if verbose:
+        print( "\tIndexing rows" )
+    row_ids = set( )
+    for filepath in filepaths:
+        with bed.open_bed( filepath ) as data:
+            for line in data:
+                row_ids.add( line.split( "\t", row_field + 1 )[ row_field ] )
+    row_ids = sorted( row_ids )
+    row_index = { row_id: position for position, row_id in enumerate( row_ids ) }
+
+    matrix = np.lib.format.open_memmap( matrix_filepaths[ "values" ], mode='w+', dtype=np.float32,
+                                        shape=( len( row_ids ), len( column_ids ) ), fortran_order=True )
+    max_field = max( row_field, value_field ) + 1
+    for column, filepath in enumerate( filepaths ):
+        if verbose:
+            print( "\tFilling column {}".format( column_ids[ column ] ) )
+        positions = [ ]
+        values = [ ]
+        with bed.open_bed( filepath ) as data:
+            for line in data:
+                fields = line.split( "\t", max_field )
+                positions.append( row_index[ fields[ row_field ] ] )
+                values.append( fields[ value_field ] )
+        column_values = np.full( len( row_ids ), np.nan, dtype=np.float32 )
+        column_values[ np.array( positions, dtype=np.int64 ) ] = np.array( values, dtype=np.float32 )
+        matrix[ :, column ] = column_values
+    matrix.flush()
+
+    # Dump rows and columns ids
+    with open( matrix_filepaths[ "rows" ], 'w' ) as rows:
+        rows.writelines( '{}\n'.format( row_id ) for row_id in row_ids )
+    with open( matrix_filepaths[ "columns" ], 'w' ) as columns:
+        columns.writelines( '{}\n'.format( column_id ) for column_id in column_ids )
+    return matrix, row_ids
+
+# Load a matrix as a read-only memory-mapped array with its row and column ids
+def load_matrix( matrix_prefix ):
+    matrix_filepaths = get_matrix_filepaths( matrix_prefix )
+    matrix = np.load( matrix_filepaths[ "values" ], mmap_mode='r' )
+    with open( matrix_filepaths[ "rows" ] ) as rows:
+        row_ids = [ row_id.rstrip( "\n" ) for row_id in rows ]
+    with open( matrix_filepaths[ "columns" ] ) as columns:
+        column_ids = [ column_id.rstrip( "\n" ) for column_id in columns ]
+    return matrix, row_ids, column_ids
+
+# Export a matrix to a tab-separated file
+# The matrix is read in blocks of "block_size" rows, missing values are reported as NA
+def export_tsv( matrix, row_ids, column_ids, tsv_filepath, row_header="id", block_size=10000 ):
+    with open( tsv_filepath, 'w', buffering=1048576 ) as tsv:
+        tsv.write( '{}\n'.format( '\t'.join( [ row_header ] + list( column_ids ) ) ) )
+        for block_start in range( 0, len( row_ids ), block_size ):
+            block = np.asarray( matrix[ block_start : block_start + block_size, : ] )
+            block = np.where( np.isnan( block ), "NA", block.astype( str ) )
+            tsv.write( ''.join( '{}\t{}\n'.format( row_id, '\t'.join( values ) )
+                                for row_id, values in zip( row_ids[ block_start : block_start + block_size ], block.tolist() ) ) )
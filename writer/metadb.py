@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+__author__ = ('Fabio Cumbo (fabio.cumbo@unitn.it)')
+__version__ = '0.01'
+__date__ = 'Oct 21, 2020'
+
+import os, sqlite3
+
+# The metadata database collects the content of all the .meta files
+# Attributes are stored once, aliquots and patients are linked to their values through attribute ids
+# Biospecimen values are stored by aliquot uuid, clinical values by patient uuid
+SCHEMA = (
+    'CREATE TABLE attributes ( id INTEGER PRIMARY KEY, name TEXT UNIQUE );'
+    'CREATE TABLE aliquots ( aliquot_uuid TEXT PRIMARY KEY, patient_uuid TEXT );'
+    'CREATE TABLE aliquot_metadata ( aliquot_uuid TEXT, attribute INTEGER, value TEXT );'
+    'CREATE TABLE patient_metadata ( patient_uuid TEXT, attribute INTEGER, value TEXT );'
+)
+
+# Indices are created once all the metadata have been inserted
+INDICES = (
+    'CREATE INDEX aliquots_patient ON aliquots ( patient_uuid );'
+    'CREATE INDEX aliquot_metadata_attribute ON aliquot_metadata ( attribute, value );'
+    'CREATE INDEX aliquot_metadata_aliquot ON aliquot_metadata ( aliquot_uuid );'
+    'CREATE INDEX patient_metadata_attribute ON patient_metadata ( attribute, value );'
+    'CREATE INDEX patient_metadata_patient ON patient_metadata ( patient_uuid );'
+)
+
+# Define the path to the metadata database in the convert directory
+def get_db_filepath( convert_dir ):
+    return os.path.join( convert_dir, 'metadata.sqlite' )
+
+# Create an empty metadata database
+# It is written to a temporary file first and moved in place by close_db
+def create_db( db_filepath ):
+    tmp_db_filepath = '{}.tmp'.format( db_filepath )
+    if os.path.exists( tmp_db_filepath ):
+        os.unlink( tmp_db_filepath )
+    connection = sqlite3.connect( tmp_db_filepath )
+    connection.executescript( SCHEMA )
+    return { "connection": connection, "filepath": db_filepath, "tmp_filepath": tmp_db_filepath, "attributes": { } }
+
+# Define the id of an attribute, new attributes are added to the database
+def get_attribute_id( db, name ):
+    attribute_id = db[ "attributes" ].get( name )
+    if attribute_id is None:
+        attribute_id = len( db[ "attributes" ] )
+        db[ "connection" ].execute( 'INSERT INTO attributes VALUES ( ?, ? )', ( attribute_id, name ) )
+        db[ "attributes" ][ name ] = attribute_id
+    return attribute_id
+
+# Add the biospecimen metadata of an aliquot
+def add_aliquot( db, aliquot_uuid, patient_uuid, aliquot_data ):
+    db[ "connection" ].execute( 'INSERT OR REPLACE INTO aliquots VALUES ( ?, ? )', ( aliquot_uuid, patient_uuid ) )
+    db[ "connection" ].executemany( 'INSERT INTO aliquot_metadata VALUES ( ?, ?, ? )',
+                                    [ ( aliquot_uuid, get_attribute_id( db, key ), value ) for key, value in aliquot_data.items() ] )
+
+# Add the clinical metadata of a patient
+def add_patient( db, patient_uuid, patient_data ):
+    db[ "connection" ].executemany( 'INSERT INTO patient_metadata VALUES ( ?, ?, ? )',
+                                    [ ( patient_uuid, get_attribute_id( db, key ), value ) for key, value in patient_data.items() ] )
+
+# Index and close the metadata database, then move it in place
+def close_db( db ):
+    try:
+        db[ "connection" ].executescript( INDICES )
+        db[ "connection" ].commit()
+    finally:
+        db[ "connection" ].close()
+    os.replace( db[ "tmp_filepath" ], db[ "filepath" ] )
+
+# Select the attribute ids that match a name
+# Attributes are matched by their full name or by the last element of their key path, 
+# with or without its namespace prefix (e.g. "shared_stage:pathologic_stage" or "pathologic_stage")
+def match_attributes( connection, name ):
+    attribute_ids = [ ]
+    for attribute_id, attribute in connection.execute( 'SELECT id, name FROM attributes' ):
+        element = attribute.split( "__" )[ -1 ]
+        if name in ( attribute, element, element.split( ":" )[ -1 ] ):
+            attribute_ids.append( attribute_id )
+    return attribute_ids
+
+# Query the metadata database for the aliquots whose metadata match all the "conditions"
+# "conditions" is a dict <attribute, value or list of accepted values>
+# e.g. { "tissue_status": "tumoral", "pathologic_stage": [ "Stage IIIA", "Stage IIIB" ] }
+# Return the sorted list of aliquot uuids
+def query_aliquots( db_filepath, conditions ):
+    connection = sqlite3.connect( db_filepath )
+    try:
+        clauses = [ ]
+        params = [ ]
+        for name, values in conditions.items():
+            attribute_ids = match_attributes( connection, name )
+            if not attribute_ids:
+                return [ ]
+            values = [ values ] if isinstance( values, str ) else list( values )
+            attributes_placeholder = ', '.join( [ '?' ] * len( attribute_ids ) )
+            values_placeholder = ', '.join( [ '?' ] * len( values ) )
+            # Attributes can refer to both the aliquot and its patient
+            clauses.append( '( aliquot_uuid IN ( SELECT aliquot_uuid FROM aliquot_metadata '
+                                                'WHERE attribute IN ( {0} ) AND value IN ( {1} ) ) '
+                            'OR patient_uuid IN ( SELECT patient_uuid FROM patient_metadata '
+                                                 'WHERE attribute IN ( {0} ) AND value IN ( {1} ) ) )'.format( attributes_placeholder,
+                                                                                                              values_placeholder ) )
+            params.extend( attribute_ids + values + attribute_ids + values )
+        query = 'SELECT aliquot_uuid FROM aliquots'
+        if clauses:
+            query = '{} WHERE {}'.format( query, ' AND '.join( clauses ) )
+        return [ row[ 0 ] for row in connection.execute( '{} ORDER BY aliquot_uuid'.format( query ), params ) ]
+    finally:
+        connection.close()
+
+# Retrieve the metadata of an aliquot, the same reported in its .meta file
+def get_metadata( db_filepath, aliquot_uuid ):
+    connection = sqlite3.connect( db_filepath )
+    try:
+        rows = connection.execute( 'SELECT attributes.name, aliquot_metadata.value FROM aliquot_metadata '
+                                   'JOIN attributes ON attributes.id = aliquot_metadata.attribute '
+                                   'WHERE aliquot_uuid = ? '
+                                   'UNION ALL '
+                                   'SELECT attributes.name, patient_metadata.value FROM aliquots '
+                                   'JOIN patient_metadata ON patient_metadata.patient_uuid = aliquots.patient_uuid '
+                                   'JOIN attributes ON attributes.id = patient_metadata.attribute '
+                                   'WHERE aliquots.aliquot_uuid = ?', ( aliquot_uuid, aliquot_uuid ) )
+        return dict( rows )
+    finally:
+        connection.close()